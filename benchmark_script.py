@@ -0,0 +1,576 @@
+"""
+    Benchmarks/reports for the inference optimizations - they help decide whether a particular speed-up is worth it.
+    Some of them (model construction, activation checkpointing) use synthetic data, the latter is a training one.
+
+    The rest run on the cached validation split (the one used during training) so make sure you ran the training
+    script (or at least get_datasets_and_vocabs) for the dataset/language direction of the model you're benchmarking.
+
+"""
+
+
+import argparse
+import time
+import io
+import contextlib
+import subprocess
+import sys
+import json
+import tempfile
+import resource
+import signal
+
+
+import torch
+import torch.multiprocessing as mp
+from nltk.translate.bleu_score import corpus_bleu
+
+
+from translation_script import load_training_state, load_field_processors, load_baseline_transformer, get_worker_pool, translate_source_sentences_tokens
+from models.definitions.transformer_model import Transformer, AttentionBackend, ActivationCheckpointing, build_transformer_skeleton, materialize_transformer, META_DEVICE_CONSTRUCTION_SUPPORTED
+from utils.data_utils import get_data_loaders, get_masks_and_count_tokens, get_masks_and_count_tokens_src, DatasetType, LanguageDirection
+from utils.shortlist_utils import get_lexical_shortlist_state, LexicalShortlist
+from utils.quantization_utils import quantize_transformer
+from utils.optimizers_and_distributions import LabelSmoothingKLDivLoss
+from utils.continuous_batching_utils import ContinuousBatchingScheduler
+from utils.decoding_utils import greedy_decoding, DecodingMethod
+from utils.speculative_decoding_utils import speculative_greedy_decoding, NgramProposer, DraftModelProposer
+from utils.mmap_weights_utils import get_mmap_weights_path, load_mmap_weights, StorageDtype
+from utils.constants import *
+import utils.utils as utils
+
+
+def calculate_bleu_score_and_time(baseline_transformer, val_token_ids_loader, trg_field_processor, **kwargs):
+    ts = time.time()
+    bleu_score = utils.calculate_bleu_score(baseline_transformer, val_token_ids_loader, trg_field_processor, **kwargs)
+    return bleu_score, time.time() - ts
+
+
+def print_report(title, header, rows):
+    print(f'\n{"*" * 5} {title} {"*" * 5}')
+    print(' | '.join(header))
+    for row in rows:
+        print(' | '.join(row))
+
+
+def benchmark_lexical_shortlist(benchmark_config):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    _, val_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
+        benchmark_config['dataset_path'],
+        benchmark_config['language_direction'],
+        benchmark_config['dataset_name'],
+        benchmark_config['batch_size'],
+        device)
+    training_state = load_training_state(benchmark_config, device)
+    baseline_transformer = load_baseline_transformer(benchmark_config, training_state, src_field_processor, trg_field_processor, device)
+
+    # Baseline - scoring the whole target vocabulary
+    bleu_score, elapsed_time = calculate_bleu_score_and_time(baseline_transformer, val_token_ids_loader, trg_field_processor)
+    rows = [['full vocab', f'{len(trg_field_processor.vocab)}', f'{bleu_score:.4f}', f'{elapsed_time:.2f}']]
+
+    # Try out shortlists with a different number of candidates per source token (it's enough to build it only once)
+    shortlist_state = get_lexical_shortlist_state(benchmark_config)
+    for num_candidates_per_token in benchmark_config['num_candidates_per_token']:
+        lexical_shortlist = LexicalShortlist(shortlist_state, src_field_processor.vocab, trg_field_processor.vocab, device, num_candidates_per_token)
+        shortlist_sizes = [lexical_shortlist.get_vocab_shortlist(token_ids_batch.src).shape[0] for token_ids_batch in val_token_ids_loader]
+
+        bleu_score, elapsed_time = calculate_bleu_score_and_time(baseline_transformer, val_token_ids_loader, trg_field_processor, lexical_shortlist=lexical_shortlist)
+        rows.append([f'shortlist ({num_candidates_per_token} candidates/token)', f'{sum(shortlist_sizes) / len(shortlist_sizes):.1f}', f'{bleu_score:.4f}', f'{elapsed_time:.2f}'])
+
+    print_report('Lexical shortlist BLEU/speed trade-off', ['decoder generator', 'avg scored target tokens', 'BLEU-4', 'time [s]'], rows)
+
+
+def get_serialized_size_mb(model):
+    # Size of the state dict as it would end up on disk (a good proxy for the per-worker memory footprint)
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+
+def benchmark_quantization(benchmark_config):
+    device = torch.device("cpu")  # quantized kernels only run on the CPU so we compare both models on the CPU
+
+    _, val_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
+        benchmark_config['dataset_path'],
+        benchmark_config['language_direction'],
+        benchmark_config['dataset_name'],
+        benchmark_config['batch_size'],
+        device)
+    training_state = load_training_state(benchmark_config, device)
+    baseline_transformer = load_baseline_transformer(benchmark_config, training_state, src_field_processor, trg_field_processor, device)
+    quantized_transformer = quantize_transformer(baseline_transformer)
+
+    rows = []
+    bleu_scores, elapsed_times = [], []
+    for model_type, model in [('fp32', baseline_transformer), ('int8 (dynamic)', quantized_transformer)]:
+        bleu_score, elapsed_time = calculate_bleu_score_and_time(model, val_token_ids_loader, trg_field_processor)
+        bleu_scores.append(bleu_score)
+        elapsed_times.append(elapsed_time)
+        rows.append([model_type, f'{get_serialized_size_mb(model):.1f}', f'{bleu_score:.4f}', f'{elapsed_time:.2f}', f'{elapsed_times[0] / elapsed_time:.2f}x'])
+
+    print_report('Int8 dynamic quantization BLEU/speed trade-off', ['model', 'size [MB]', 'BLEU-4', 'time [s]', 'speedup'], rows)
+
+    # Accuracy guardrail - BLEU is in [0, 1] range here so e.g. max_bleu_drop=0.005 means half a BLEU point
+    bleu_drop = bleu_scores[0] - bleu_scores[1]
+    if bleu_drop > benchmark_config['max_bleu_drop']:
+        raise Exception(f'Quantized model lost {bleu_drop:.4f} BLEU (max allowed drop is {benchmark_config["max_bleu_drop"]}), do not deploy it.')
+    print(f'Quantized model is within the BLEU guardrail (drop = {bleu_drop:.4f}, max allowed = {benchmark_config["max_bleu_drop"]}).')
+
+
+def benchmark_continuous_batching(benchmark_config):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    max_pool_size = benchmark_config['max_pool_size']
+
+    _, val_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
+        benchmark_config['dataset_path'],
+        benchmark_config['language_direction'],
+        benchmark_config['dataset_name'],
+        benchmark_config['batch_size'],
+        device)
+    training_state = load_training_state(benchmark_config, device)
+    baseline_transformer = load_baseline_transformer(benchmark_config, training_state, src_field_processor, trg_field_processor, device)
+    pad_token_id = src_field_processor.vocab.stoi[PAD_TOKEN]
+
+    with torch.no_grad():
+        # Encode all of the validation sentences upfront (it's the same for both), we're comparing the decoding part
+        # Note: all of the requests arrive at the same time (worst case for queueing)
+        encoded_batches = []
+        for token_ids_batch in val_token_ids_loader:
+            src_mask, _ = get_masks_and_count_tokens_src(token_ids_batch.src, pad_token_id)
+            encoded_batches.append((baseline_transformer.encode(token_ids_batch.src, src_mask), src_mask))
+        num_sentences = sum(src_representations_batch.shape[0] for src_representations_batch, _ in encoded_batches)
+
+        # Static batching - max_pool_size sentences are decoded together, new ones have to wait for the whole batch
+        ts = time.time()
+        latencies = []
+        for src_representations_batch, src_mask in encoded_batches:
+            for i in range(0, src_representations_batch.shape[0], max_pool_size):
+                greedy_decoding(baseline_transformer, src_representations_batch[i:i+max_pool_size], src_mask[i:i+max_pool_size], trg_field_processor)
+                latencies.extend([time.time() - ts] * src_mask[i:i+max_pool_size].shape[0])
+        static_time = time.time() - ts
+        latencies.sort()
+
+        # Continuous batching - sentences join the pool as soon as there is a free slot
+        ts = time.time()
+        scheduler = ContinuousBatchingScheduler(baseline_transformer, trg_field_processor, max_pool_size)
+        for batch_id, (src_representations_batch, src_mask) in enumerate(encoded_batches):
+            scheduler.add_requests([(batch_id, i) for i in range(src_representations_batch.shape[0])], src_representations_batch, src_mask)
+        scheduler.run()
+        continuous_time = time.time() - ts
+        metrics = scheduler.get_metrics_summary()
+
+    rows = [
+        ['static', f'{num_sentences / static_time:.1f}', f'{sum(latencies) / len(latencies):.2f}', f'{latencies[int(0.95 * (len(latencies) - 1))]:.2f}'],
+        ['continuous', f'{num_sentences / continuous_time:.1f}', f'{metrics["avg_latency"]:.2f}', f'{metrics["p95_latency"]:.2f}']
+    ]
+    print_report(f'Static vs continuous batching (max {max_pool_size} sentences in flight)', ['batching', 'sentences/s', 'avg latency [s]', 'p95 latency [s]'], rows)
+    print_report('Continuous batching scheduler metrics', ['metric', 'value'], [[name, f'{value:.4f}'] for name, value in metrics.items()])
+
+
+def benchmark_speculative_decoding(benchmark_config):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    num_draft_tokens = benchmark_config['num_draft_tokens']
+
+    _, val_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
+        benchmark_config['dataset_path'],
+        benchmark_config['language_direction'],
+        benchmark_config['dataset_name'],
+        benchmark_config['batch_size'],
+        device)
+    training_state = load_training_state(benchmark_config, device)
+    baseline_transformer = load_baseline_transformer(benchmark_config, training_state, src_field_processor, trg_field_processor, device)
+    pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
+
+    # Proposers - source copy/n-gram lookup is free, a draft model has to be trained on the same dataset and vocabs
+    proposers = [('n-gram lookup', NgramProposer(src_field_processor.vocab, trg_field_processor.vocab))]
+    if benchmark_config['draft_model_name'] is not None:
+        draft_config = {**benchmark_config, 'model_name': benchmark_config['draft_model_name']}
+        draft_transformer = load_baseline_transformer(draft_config, load_training_state(draft_config, device), src_field_processor, trg_field_processor, device)
+        proposers.append((f'draft model ({benchmark_config["draft_model_name"]})', DraftModelProposer(draft_transformer, pad_token_id)))
+
+    with torch.no_grad():
+        gt_sentences_corpus = []
+        for token_ids_batch in val_token_ids_loader:
+            for target_sentence_ids in token_ids_batch.trg.tolist():
+                gt_sentences_corpus.append([[trg_field_processor.vocab.itos[id] for id in target_sentence_ids if id != pad_token_id]])
+
+        def translate_val_split(decoding_fn):
+            ts = time.time()
+            predicted_sentences_corpus = []
+            for token_ids_batch in val_token_ids_loader:
+                src_mask, _ = get_masks_and_count_tokens_src(token_ids_batch.src, pad_token_id)
+                src_representations_batch = baseline_transformer.encode(token_ids_batch.src, src_mask)
+                predicted_sentences_corpus.extend(decoding_fn(token_ids_batch.src, src_representations_batch, src_mask))
+            return predicted_sentences_corpus, time.time() - ts
+
+        # Baseline - regular greedy decoding, speculative decoding should produce the same translations
+        greedy_sentences, greedy_time = translate_val_split(lambda src_token_ids_batch, src_representations_batch, src_mask: greedy_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor))
+        rows = [['greedy', f'{corpus_bleu(gt_sentences_corpus, greedy_sentences):.4f}', f'{greedy_time:.2f}', '1.00x', '100.00%', '-', '1.00']]
+
+        for proposer_name, proposer in proposers:
+            stats = dict()
+            predicted_sentences, elapsed_time = translate_val_split(lambda src_token_ids_batch, src_representations_batch, src_mask: speculative_greedy_decoding(baseline_transformer, src_token_ids_batch, src_representations_batch, src_mask, trg_field_processor, proposer, num_draft_tokens, stats=stats))
+
+            num_identical = sum(predicted_sentence == greedy_sentence for predicted_sentence, greedy_sentence in zip(predicted_sentences, greedy_sentences))
+            acceptance_rate = stats['num_accepted_tokens'] / max(stats['num_drafted_tokens'], 1)
+            # Number of tokens a sentence gets per (main) decoder call, it's exactly 1 for greedy decoding
+            tokens_per_call = stats['num_generated_tokens'] / stats['num_sentence_decoder_calls']
+            rows.append([proposer_name, f'{corpus_bleu(gt_sentences_corpus, predicted_sentences):.4f}', f'{elapsed_time:.2f}', f'{greedy_time / elapsed_time:.2f}x', f'{100 * num_identical / len(greedy_sentences):.2f}%', f'{100 * acceptance_rate:.2f}%', f'{tokens_per_call:.2f}'])
+
+    print_report(f'Speculative decoding ({num_draft_tokens} draft tokens)', ['proposer', 'BLEU-4', 'time [s]', 'speedup', 'identical to greedy', 'acceptance rate', 'tokens/decoder call'], rows)
+
+
+def benchmark_worker_pool(benchmark_config):
+    device = torch.device("cpu")  # worker processes only run on the CPU
+
+    _, val_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
+        benchmark_config['dataset_path'],
+        benchmark_config['language_direction'],
+        benchmark_config['dataset_name'],
+        benchmark_config['batch_size'],
+        device)
+    training_state = load_training_state(benchmark_config, device)
+    baseline_transformer = load_baseline_transformer(benchmark_config, training_state, src_field_processor, trg_field_processor, device)
+    pad_token_id = src_field_processor.vocab.stoi[PAD_TOKEN]
+    lexical_shortlist = None
+
+    # Translate the validation source sentences the same way the translation script translates a file (greedy)
+    source_sentences_tokens = []
+    for token_ids_batch in val_token_ids_loader:
+        for source_sentence_ids in token_ids_batch.src.tolist():
+            source_sentences_tokens.append([src_field_processor.vocab.itos[id] for id in source_sentence_ids if id != pad_token_id])
+    translation_config = {**benchmark_config, 'decoding_method': DecodingMethod.GREEDY.name, 'max_length_a': None, 'max_length_b': None}
+
+    rows = []
+    reference_target_sentences_tokens = None
+    for workers_x_threads in benchmark_config['workers_x_threads']:
+        num_workers, num_threads_per_worker = [int(number) for number in workers_x_threads.split('x')]
+        translation_config.update({'num_workers': num_workers, 'num_threads_per_worker': num_threads_per_worker})
+
+        ts = time.time()
+        if num_workers == 0:  # translate in this process, only set the number of threads
+            torch.set_num_threads(num_threads_per_worker)
+        worker_pool = get_worker_pool(translation_config, baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist)
+        startup_time = time.time() - ts
+
+        ts = time.time()
+        target_sentences_tokens = translate_source_sentences_tokens(translation_config, baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist, source_sentences_tokens, worker_pool=worker_pool)
+        elapsed_time = time.time() - ts
+        if worker_pool is not None:
+            worker_pool.close()
+
+        # Sanity check - the translations shouldn't depend on how we parallelize the work
+        reference_target_sentences_tokens = target_sentences_tokens if reference_target_sentences_tokens is None else reference_target_sentences_tokens
+        num_identical = sum(a == b for a, b in zip(target_sentences_tokens, reference_target_sentences_tokens))
+        rows.append([workers_x_threads, f'{max(num_workers, 1) * num_threads_per_worker}', f'{startup_time:.2f}', f'{len(source_sentences_tokens) / elapsed_time:.1f}', f'{100 * num_identical / len(source_sentences_tokens):.2f}%'])
+
+    print_report(f'CPU worker pool sweep ({os.cpu_count()} cores, pinned = {benchmark_config["pin_workers_to_cores"]})', ['workers x threads', 'total threads', 'startup [s]', 'sentences/s', 'identical to the first config'], rows)
+
+
+def get_memory_usage_mb():
+    # Linux only - RssAnon is the private memory, RssFile and RssShmem are (potentially) shared with other processes
+    memory_usage = dict()
+    with open('/proc/self/status') as status_file:
+        for line in status_file:
+            name, value = line.split(':', 1)
+            if name in ['RssAnon', 'RssFile', 'RssShmem']:
+                memory_usage[name] = int(value.split()[0]) / 2**10  # kB -> MB
+    return memory_usage
+
+
+def measure_model_loading(benchmark_config, model_hyperparameters, keep_upcast_weights, result_queue):
+    # Runs in a fresh process so that nothing is loaded/allocated yet
+    device = torch.device("cpu")
+    ts = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):  # model metadata
+        training_state = load_training_state(benchmark_config, device)
+        training_state['model_hyperparameters'] = model_hyperparameters  # older models don't contain them
+        baseline_transformer = load_baseline_transformer(benchmark_config, training_state, None, None, device, keep_upcast_weights)
+    loading_time = time.time() - ts
+    memory_usage_after_loading = get_memory_usage_mb()
+
+    # The first forward pass touches all of the weights (and upcasts them if they're stored in reduced precision, the
+    # fp32 copy is either kept or freed right after every module's forward call - see keep_upcast_weights)
+    ts = time.time()
+    with torch.no_grad():
+        token_ids_batch = torch.randint(4, min(model_hyperparameters['src_vocab_size'], model_hyperparameters['trg_vocab_size']), (8, 30))
+        baseline_transformer(token_ids_batch, token_ids_batch, src_mask=None, trg_mask=None)
+    result_queue.put((loading_time, memory_usage_after_loading, time.time() - ts, get_memory_usage_mb()))
+
+
+def benchmark_mmap_weights(benchmark_config):
+    device = torch.device("cpu")  # weights are memory mapped into the CPU memory
+
+    # Create the memory mapped artifacts (if they don't exist yet) - they get created when loading the .pth model
+    training_state = load_training_state(benchmark_config, device)
+    src_field_processor, trg_field_processor = load_field_processors(benchmark_config, training_state)
+    for storage_dtype in StorageDtype:
+        load_baseline_transformer({**benchmark_config, 'mmap_weights_dtype': storage_dtype.name}, training_state, src_field_processor, trg_field_processor, device)
+    model_hyperparameters = load_mmap_weights(get_mmap_weights_path(benchmark_config['model_name'], StorageDtype.FLOAT32.name))['model_hyperparameters']
+
+    # Reduced precision weights get measured twice - upcast once (single process default, private fp32 copy) and
+    # upcast on every forward call (inference workers, the fp32 weights only exist during the module's forward call)
+    reduced_precision_dtype_names = [StorageDtype.FLOAT16.name, StorageDtype.BFLOAT16.name]
+    configurations = [(None, True)] + [(storage_dtype.name, True) for storage_dtype in StorageDtype] + [(dtype_name, False) for dtype_name in reduced_precision_dtype_names]
+
+    rows = []
+    context = mp.get_context('spawn')
+    for mmap_weights_dtype, keep_upcast_weights in configurations:
+        result_queue = context.Queue()
+        process = context.Process(target=measure_model_loading, args=({**benchmark_config, 'mmap_weights_dtype': mmap_weights_dtype}, model_hyperparameters, keep_upcast_weights, result_queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise Exception(f'Measuring the model loading ({mmap_weights_dtype}) failed, see the error above.')
+        loading_time, memory_usage_after_loading, forward_time, memory_usage_after_forward = result_queue.get()
+
+        if mmap_weights_dtype is None:
+            model_format, file_size = '.pth (torch.load)', os.path.getsize(os.path.join(BINARIES_PATH, benchmark_config['model_name']))
+        else:
+            model_format, file_size = f'mmap {mmap_weights_dtype.lower()}', os.path.getsize(get_mmap_weights_path(benchmark_config['model_name'], mmap_weights_dtype))
+            if mmap_weights_dtype in reduced_precision_dtype_names:
+                model_format += ' (upcast once)' if keep_upcast_weights else ' (upcast per forward)'
+
+        rows.append([
+            model_format, f'{file_size / 2**20:.1f}', f'{loading_time:.3f}', f'{memory_usage_after_loading["RssAnon"]:.1f}', f'{memory_usage_after_loading["RssFile"]:.1f}',
+            f'{forward_time:.3f}', f'{memory_usage_after_forward["RssAnon"]:.1f}', f'{memory_usage_after_forward["RssFile"]:.1f}'
+        ])
+
+    header = ['weights', 'file [MB]', 'load [s]', 'private RSS [MB]', 'shared file RSS [MB]', '1st forward [s]', 'private RSS after [MB]', 'shared file RSS after [MB]']
+    # Private RSS after the first forward is what every extra worker costs - reduced precision weights which are upcast
+    # once end up in private memory (the file's pages are no longer used), the inference workers upcast per forward
+    print_report('Model loading - cold start and per-process memory (private RSS after is what every extra worker costs)', header, rows)
+
+
+def benchmark_model_construction(benchmark_config):
+    # Synthetic checkpoints (no trained model needed) - construction time doesn't depend on the values of the weights
+    device = torch.device("cpu")
+    model_configs = {
+        'baseline': (BASELINE_MODEL_DIMENSION, BASELINE_MODEL_NUMBER_OF_HEADS, BASELINE_MODEL_NUMBER_OF_LAYERS, BASELINE_MODEL_DROPOUT_PROB),
+        'big': (BIG_MODEL_DIMENSION, BIG_MODEL_NUMBER_OF_HEADS, BIG_MODEL_NUMBER_OF_LAYERS, BIG_MODEL_DROPOUT_PROB)
+    }
+
+    rows = []
+    for model_config_name, (model_dimension, number_of_heads, number_of_layers, dropout_probability) in model_configs.items():
+        model_hyperparameters = {
+            "model_dimension": model_dimension,
+            "src_vocab_size": benchmark_config['vocab_size'],
+            "trg_vocab_size": benchmark_config['vocab_size'],
+            "number_of_heads": number_of_heads,
+            "number_of_layers": number_of_layers,
+            "dropout_probability": dropout_probability
+        }
+        state_dict = Transformer(**model_hyperparameters, initialize_weights=False).state_dict()
+
+        # Regular construction (allocate + xavier init) followed by copying the checkpoint into the model
+        regular_times = []
+        for _ in range(benchmark_config['num_construction_runs']):
+            ts = time.time()
+            baseline_transformer = Transformer(**model_hyperparameters).to(device)
+            baseline_transformer.load_state_dict(state_dict, strict=True)
+            regular_times.append(time.time() - ts)
+
+        skeleton_times = []
+        for _ in range(benchmark_config['num_construction_runs']):
+            ts = time.time()
+            baseline_transformer = materialize_transformer(build_transformer_skeleton(**model_hyperparameters), state_dict, device)
+            skeleton_times.append(time.time() - ts)
+
+        num_params = sum(tensor.numel() for tensor in state_dict.values())
+        rows.append([model_config_name, f'{num_params / 1e6:.1f}', f'{min(regular_times):.3f}', f'{min(skeleton_times):.3f}', f'{min(regular_times) / min(skeleton_times):.1f}x'])
+
+    construction_path = 'meta device' if META_DEVICE_CONSTRUCTION_SUPPORTED else 'skipped init (PyTorch < 2.1)'
+    header = ['model', 'params (+ buffers) [M]', 'regular [s]', f'{construction_path} [s]', 'speedup']
+    print_report(f'Model instantiation from a checkpoint (vocab size = {benchmark_config["vocab_size"]}, best of {benchmark_config["num_construction_runs"]} runs)', header, rows)
+
+
+def measure_training_step(benchmark_config, model_hyperparameters, activation_checkpointing, result_queue):
+    # Runs in a fresh process so that the peak memory (max RSS on CPU) belongs to this configuration only
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    pad_token_id = 1
+    baseline_transformer = Transformer(**model_hyperparameters, activation_checkpointing=activation_checkpointing).to(device).train()
+    label_smoothing_loss = LabelSmoothingKLDivLoss(BASELINE_MODEL_LABEL_SMOOTHING_VALUE, pad_token_id, model_hyperparameters['trg_vocab_size'])
+
+    # Synthetic batch of batch_size source/target tokens (sentences of 30 tokens, roughly the IWSLT average)
+    sentence_length = 30
+    num_sentences = max(benchmark_config['batch_size'] // sentence_length, 1)
+    src_token_ids_batch = torch.randint(4, model_hyperparameters['src_vocab_size'], (num_sentences, sentence_length), device=device)
+    trg_token_ids_batch = torch.randint(4, model_hyperparameters['trg_vocab_size'], (num_sentences, sentence_length + 1), device=device)
+    trg_token_ids_batch_input, trg_token_ids_batch_gt = trg_token_ids_batch[:, :-1], trg_token_ids_batch[:, 1:].reshape(-1, 1)
+    src_mask, trg_mask, _, num_trg_tokens = get_masks_and_count_tokens(src_token_ids_batch, trg_token_ids_batch_input, pad_token_id, device)
+
+    def training_step():
+        baseline_transformer.zero_grad(set_to_none=False)
+        predicted_log_distributions = baseline_transformer(src_token_ids_batch, trg_token_ids_batch_input, src_mask, trg_mask)
+        label_smoothing_loss(predicted_log_distributions, trg_token_ids_batch_gt).backward()
+
+    # Max RSS never goes down so the memory baseline has to be taken before the first step. The peak thus includes the
+    # gradients as well (same for every activation checkpointing configuration)
+    if device.type == 'cuda':
+        memory_baseline = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        memory_baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 2**10  # kB -> bytes (Linux)
+
+    training_step()  # warm up step, not timed
+    ts = time.time()
+    for _ in range(benchmark_config['num_training_steps']):
+        training_step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated() - memory_baseline
+    else:
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 2**10 - memory_baseline
+    step_time = (time.time() - ts) / benchmark_config['num_training_steps']
+
+    result_queue.put((peak_memory / 2**20, step_time, num_trg_tokens.item() / step_time))
+
+
+def benchmark_activation_checkpointing(benchmark_config):
+    # Training benchmark - synthetic batches (no dataset needed), a forward + backward pass per step (no optimizer)
+    model_configs = {
+        'baseline': (BASELINE_MODEL_DIMENSION, BASELINE_MODEL_NUMBER_OF_HEADS, BASELINE_MODEL_NUMBER_OF_LAYERS, BASELINE_MODEL_DROPOUT_PROB),
+        'big': (BIG_MODEL_DIMENSION, BIG_MODEL_NUMBER_OF_HEADS, BIG_MODEL_NUMBER_OF_LAYERS, BIG_MODEL_DROPOUT_PROB)
+    }
+
+    rows = []
+    context = mp.get_context('spawn')
+    for model_config_name, (model_dimension, number_of_heads, number_of_layers, dropout_probability) in model_configs.items():
+        model_hyperparameters = {
+            "model_dimension": model_dimension,
+            "src_vocab_size": benchmark_config['vocab_size'],
+            "trg_vocab_size": benchmark_config['vocab_size'],
+            "number_of_heads": number_of_heads,
+            "number_of_layers": number_of_layers,
+            "dropout_probability": dropout_probability
+        }
+        for activation_checkpointing in ActivationCheckpointing:
+            result_queue = context.Queue()
+            process = context.Process(target=measure_training_step, args=(benchmark_config, model_hyperparameters, activation_checkpointing.name, result_queue))
+            process.start()
+            process.join()
+            if process.exitcode == -signal.SIGKILL:  # killed by the OOM killer - that's exactly what we want to know
+                rows.append([model_config_name, activation_checkpointing.name, 'out of memory', '-', '-'])
+                continue
+            if process.exitcode != 0:
+                raise Exception(f'Measuring the training step ({model_config_name}, {activation_checkpointing.name}) failed, see the error above.')
+            peak_memory, step_time, tokens_per_second = result_queue.get()
+            rows.append([model_config_name, activation_checkpointing.name, f'{peak_memory:.0f}', f'{step_time:.3f}', f'{tokens_per_second:.0f}'])
+
+    device_name = 'GPU' if torch.cuda.is_available() else 'CPU'
+    header = ['model', 'activation checkpointing', 'peak memory above weights [MB]', 'step time [s]', 'target tokens/s']
+    print_report(f'Activation checkpointing - training step ({device_name}, batch size = {benchmark_config["batch_size"]} tokens, vocab size = {benchmark_config["vocab_size"]})', header, rows)
+
+
+# Slow to import dependencies which the translation (entry point) shouldn't need
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'git', 'nltk', 'spacy']
+
+
+def benchmark_startup(benchmark_config):
+    # Everything runs in fresh processes (that's what batch jobs/autoscaled workers do), we take the best of a few runs
+    repo_path = os.path.dirname(os.path.abspath(__file__))
+    num_runs = benchmark_config['num_startup_runs']
+
+    def run(command):
+        elapsed_times = []
+        for _ in range(num_runs):
+            ts = time.time()
+            output = subprocess.run(command, cwd=repo_path, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+            elapsed_times.append(time.time() - ts)
+        return min(elapsed_times), output
+
+    import_code = f'import sys, time, json; ts = time.time(); import translation_script; print(json.dumps([time.time() - ts, [name for name in {HEAVY_MODULES} if name in sys.modules]]))'
+    _, output = run([sys.executable, '-c', import_code])
+    import_time, imported_heavy_modules = json.loads(output)
+    print_report('Importing the translation script', ['import time [s]', 'heavy modules imported'], [[f'{import_time:.3f}', ', '.join(imported_heavy_modules) if len(imported_heavy_modules) > 0 else 'none']])
+
+    # Process start to the first translation - a single sentence file (pre-tokenized input doesn't need spaCy at all)
+    model_args = ['--model_name', benchmark_config['model_name'], '--dataset_name', benchmark_config['dataset_name'], '--language_direction', benchmark_config['language_direction'], '--dataset_path', benchmark_config['dataset_path']]
+    variants = [
+        ('raw text', []),
+        ('pre-tokenized', ['--pretokenized']),
+        ('pre-tokenized + mmap weights', ['--pretokenized', '--mmap_weights_dtype', StorageDtype.FLOAT32.name])
+    ]
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        input_path = os.path.join(tmp_dir_path, 'input.txt')
+        with open(input_path, 'w', encoding='utf-8') as input_file:
+            input_file.write(benchmark_config['source_sentence'] + '\n')
+
+        for variant_name, variant_args in variants:
+            command = [sys.executable, 'translation_script.py', '--input_file', input_path, '--output_file', os.path.join(tmp_dir_path, 'output.txt')] + model_args + variant_args
+            subprocess.run(command, cwd=repo_path, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)  # warm up (creates the artifacts, fills the page cache)
+            elapsed_time, _ = run(command)
+            rows.append([variant_name, f'{elapsed_time:.2f}'])
+
+    print_report(f'Process start to the first translation (best of {num_runs} runs)', ['input', 'time [s]'], rows)
+
+
+BENCHMARKS = {
+    'lexical_shortlist': benchmark_lexical_shortlist,
+    'quantization': benchmark_quantization,
+    'continuous_batching': benchmark_continuous_batching,
+    'speculative_decoding': benchmark_speculative_decoding,
+    'worker_pool': benchmark_worker_pool,
+    'mmap_weights': benchmark_mmap_weights,
+    'startup': benchmark_startup,
+    'model_construction': benchmark_model_construction,
+    'activation_checkpointing': benchmark_activation_checkpointing
+}
+
+
+if __name__ == "__main__":
+    #
+    # modifiable args - feel free to play with these (only small subset is exposed by design to avoid cluttering)
+    #
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", choices=list(BENCHMARKS.keys()), help="which benchmark to run", default='lexical_shortlist')
+    parser.add_argument("--model_name", type=str, help="transformer model name", default=r'iwslt_e2g.pth')
+
+    # Keep these 2 in sync with the model you pick via model_name
+    parser.add_argument("--dataset_name", type=str, choices=[el.name for el in DatasetType], help='which dataset the model was trained on', default=DatasetType.IWSLT.name)
+    parser.add_argument("--language_direction", type=str, choices=[el.name for el in LanguageDirection], help='which direction to translate', default=LanguageDirection.E2G.name)
+    parser.add_argument("--dataset_path", type=str, help='cache files and datasets are stored here', default=DATA_DIR_PATH)
+    parser.add_argument("--batch_size", type=int, help="target number of tokens in a src/trg batch", default=1500)
+
+    parser.add_argument("--attention_backend", choices=[el.name for el in AttentionBackend], help="attention implementation", default=AttentionBackend.SDPA.name)
+
+    # Lexical shortlist benchmark args
+    parser.add_argument("--num_candidates_per_token", type=int, nargs='+', help="shortlist sizes to try out", default=[5, 10, 20, 50])
+
+    # Continuous batching benchmark args
+    parser.add_argument("--max_pool_size", type=int, help="max number of sentences decoded at the same time", default=64)
+
+    # Speculative decoding benchmark args
+    parser.add_argument("--num_draft_tokens", type=int, help="number of tokens proposed per verification step", default=4)
+    parser.add_argument("--draft_model_name", type=str, help="smaller model (same dataset/vocabs) used as a proposer", default=None)
+
+    # Worker pool benchmark args (0xT means no workers, translate in the main process with T threads)
+    parser.add_argument("--workers_x_threads", type=str, nargs='+', help="configurations to sweep, e.g. 1x8 2x4 4x2 8x1", default=['0x1', '1x4', '2x2', '4x1'])
+    parser.add_argument("--pin_workers_to_cores", action='store_true', help="pin every worker to its own set of CPU cores")
+
+    # Startup benchmark args
+    parser.add_argument("--source_sentence", type=str, help="sentence translated by the fresh processes", default="How are you doing today?")
+    parser.add_argument("--num_startup_runs", type=int, help="number of fresh processes per configuration (best one counts)", default=3)
+
+    # Model construction benchmark args
+    parser.add_argument("--vocab_size", type=int, help="src/trg vocab size of the synthetic checkpoints", default=36000)
+    parser.add_argument("--num_construction_runs", type=int, help="number of runs per construction path (best one counts)", default=3)
+
+    # Activation checkpointing benchmark args (vocab_size is shared with the model construction benchmark)
+    parser.add_argument("--num_training_steps", type=int, help="number of measured training steps per configuration", default=3)
+
+    # Quantization benchmark args
+    parser.add_argument("--max_bleu_drop", type=float, help="max allowed BLEU drop of the int8 model (BLEU in [0, 1])", default=0.005)
+    args = parser.parse_args()
+
+    # Wrapping benchmark configuration into a dictionary
+    benchmark_config = dict()
+    for arg in vars(args):
+        benchmark_config[arg] = getattr(args, arg)
+    benchmark_config['visualize_attention'] = False  # only used by the translation script
+    benchmark_config['quantize'] = False  # benchmarks which need the quantized model quantize the fp32 one themselves
+    benchmark_config['mmap_weights_dtype'] = None  # benchmarks which need the memory mapped weights set it themselves
+
+    BENCHMARKS[benchmark_config['benchmark']](benchmark_config)
@@ -14,18 +14,36 @@
 
 import math
 import copy
+import functools
+import enum
+import inspect
 
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 from utils.constants import *
 
 
+class AttentionBackend(enum.Enum):
+    REFERENCE = 0,  # step by step implementation from the paper, the only one which can log attention weights
+    SDPA = 1,  # PyTorch's scaled_dot_product_attention (fused kernels), falls back to REFERENCE on older PyTorch
+    CHUNKED = 2  # processes queries in chunks so that the peak memory doesn't grow with the (query) sequence length
+
+
+class ActivationCheckpointing(enum.Enum):
+    NONE = 0,  # keep all of the activations for the backward pass (fastest)
+    LAYER = 1,  # keep only every encoder/decoder layer's input, recompute the rest of the layer during backward
+    SUBLAYER = 2  # same but per sublayer (attention/point-wise net) - keeps more activations, recomputes less
+
+
 class Transformer(nn.Module):
 
-    def __init__(self, model_dimension, src_vocab_size, trg_vocab_size, number_of_heads, number_of_layers, dropout_probability, log_attention_weights=False):
+    def __init__(self, model_dimension, src_vocab_size, trg_vocab_size, number_of_heads, number_of_layers, dropout_probability, log_attention_weights=False,
+                 attention_backend=AttentionBackend.SDPA.name, attention_chunk_size=64, initialize_weights=True, activation_checkpointing=ActivationCheckpointing.NONE.name):
         super().__init__()
 
         # Embeds source/target token ids into embedding vectors
@@ -38,17 +56,30 @@ class Transformer(nn.Module):
         self.trg_pos_embedding = PositionalEncoding(model_dimension, dropout_probability)
 
         # All of these will get deep-copied multiple times internally
-        mha = MultiHeadedAttention(model_dimension, number_of_heads, dropout_probability, log_attention_weights)
+        mha = MultiHeadedAttention(model_dimension, number_of_heads, dropout_probability, log_attention_weights, attention_backend, attention_chunk_size)
+        src_mha = MultiHeadedAttention(model_dimension, number_of_heads, dropout_probability, log_attention_weights, attention_backend, attention_chunk_size, self_attention=False)
         pwn = PositionwiseFeedForwardNet(model_dimension, dropout_probability)
         encoder_layer = EncoderLayer(model_dimension, dropout_probability, mha, pwn)
-        decoder_layer = DecoderLayer(model_dimension, dropout_probability, mha, pwn)
+        decoder_layer = DecoderLayer(model_dimension, dropout_probability, mha, src_mha, pwn)
 
         self.encoder = Encoder(encoder_layer, number_of_layers)
         self.decoder = Decoder(decoder_layer, number_of_layers)
 
         # Converts final target token representations into log probabilities vectors of the target vocab size
         self.decoder_generator = DecoderGenerator(model_dimension, trg_vocab_size)
-        self.init_params()
+        if initialize_weights:  # pointless if we're about to load the weights anyway (see build_transformer_skeleton)
+            self.init_params()
+
+        self.set_activation_checkpointing(activation_checkpointing)
+
+    def set_activation_checkpointing(self, activation_checkpointing):
+        # Trades compute for memory during training - only the inputs of the checkpointed modules are kept for backward
+        # and everything in between gets recomputed (see checkpoint_if_enabled), it has no effect during inference
+        for module in self.modules():
+            if isinstance(module, (EncoderLayer, DecoderLayer)):
+                module.checkpoint_activations = activation_checkpointing == ActivationCheckpointing.LAYER.name
+            elif isinstance(module, SublayerLogic):
+                module.checkpoint_activations = activation_checkpointing == ActivationCheckpointing.SUBLAYER.name
 
     def init_params(self, default_initialization=False):
         # Not mentioned in the paper, but other implementations used xavier.
@@ -56,12 +87,16 @@ class Transformer(nn.Module):
         # a model's perf, with normalization layers, to be so much dependent on the choice of weight initialization.
         if not default_initialization:
             for name, p in self.named_parameters():
-                if p.dim() > 1:
+                if name.endswith(('.qkv_net.weight', '.kv_net.weight')):
+                    # Fused projections are initialized as if they were separate (D, D) query/key/value matrices
+                    for p_chunk in p.split(p.shape[1]):
+                        nn.init.xavier_uniform_(p_chunk)
+                elif p.dim() > 1:
                     nn.init.xavier_uniform_(p)
 
-    def forward(self, src_token_ids_batch, trg_token_ids_batch, src_mask, trg_mask):
+    def forward(self, src_token_ids_batch, trg_token_ids_batch, src_mask, trg_mask, generator_positions=None, apply_generator=True):
         src_representations_batch = self.encode(src_token_ids_batch, src_mask)
-        trg_log_probs = self.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask)
+        trg_log_probs = self.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask, generator_positions=generator_positions, apply_generator=apply_generator)
         return trg_log_probs
 
     # Modularized into encode/decode functions for optimizing the decoding/translation process (see translation script)
@@ -72,20 +107,53 @@ class Transformer(nn.Module):
 
         return src_representations_batch
 
-    def decode(self, trg_token_ids_batch, src_representations_batch, trg_mask, src_mask):
+    def decode(self, trg_token_ids_batch, src_representations_batch, trg_mask, src_mask, decoder_cache=None, generator_positions=None, shortlist_linear=None, apply_generator=True):
+        # If we have a decoder cache the tokens we pass in are the newest ones only (usually a single token per sentence)
+        # so their positions start right after the tokens whose keys/values are already cached
+        start_position = 0 if decoder_cache is None else decoder_cache.next_positions
+
         trg_embeddings_batch = self.trg_embedding(trg_token_ids_batch)  # get embedding vectors for trg token ids
-        trg_embeddings_batch = self.trg_pos_embedding(trg_embeddings_batch)  # add positional embedding
+        trg_embeddings_batch = self.trg_pos_embedding(trg_embeddings_batch, start_position)  # add positional embedding
         # Shape (B, T, D), where B - batch size, T - longest target token-sequence length and D - model dimension
-        trg_representations_batch = self.decoder(trg_embeddings_batch, src_representations_batch, trg_mask, src_mask)
+        trg_representations_batch = self.decoder(trg_embeddings_batch, src_representations_batch, trg_mask, src_mask, decoder_cache)
+        if decoder_cache is not None and decoder_cache.positions is not None:
+            decoder_cache.positions = decoder_cache.positions + trg_token_ids_batch.shape[1]
+
+        # Optimization - decoder generator is the most expensive part of the decoder (V is usually in the tens of
+        # thousands) so only run it for the positions we actually need:
+        # 'last' - only the last token of every target sentence (decoding), shape goes from (B, T, D) to (B, D)
+        # boolean mask of shape (B, T) or (B*T,) - e.g. only non-pad tokens (training), shape (N, D), N - num of Trues
+        # None - all of the positions, shape (B*T, D) which is a suitable format for passing it into KL div loss
+        if generator_positions == 'last':
+            trg_representations_batch = trg_representations_batch[:, -1]
+        elif generator_positions is not None:
+            trg_representations_batch = trg_representations_batch.reshape(-1, trg_representations_batch.shape[-1])[generator_positions.reshape(-1)]
+        else:
+            trg_representations_batch = trg_representations_batch.reshape(-1, trg_representations_batch.shape[-1])
+
+        # The caller runs the decoder generator itself e.g. fused with the loss (see chunked_loss_utils.py)
+        if not apply_generator:
+            return trg_representations_batch
+
+        # After this line we'll have a shape (B, V), (N, V) or (B*T, V), where V - target vocab size, decoder generator
+        # does a simple linear projection followed by log softmax. If we have a vocab shortlist (see DecoderGenerator's
+        # get_shortlist_linear) V gets replaced by K and the log probs are normalized over the K shortlisted tokens
+        trg_log_probs = self.decoder_generator(trg_representations_batch, shortlist_linear)
 
-        # After this line we'll have a shape (B, T, V), where V - target vocab size, decoder generator does a simple
-        # linear projection followed by log softmax
-        trg_log_probs = self.decoder_generator(trg_representations_batch)
+        return trg_log_probs  # the reason I use log here is that PyTorch's nn.KLDivLoss expects log probabilities
 
-        # Reshape into (B*T, V) as that's a suitable format for passing it into KL div loss
-        trg_log_probs = trg_log_probs.reshape(-1, trg_log_probs.shape[-1])
+    def init_decoder_cache(self, src_representations_batch=None):
+        # Create a cache which you then keep passing into decode (see greedy_decoding in decoding_utils.py)
+        decoder_cache = DecoderCache(len(self.decoder.decoder_layers))
 
-        return trg_log_probs  # the reason I use log here is that PyTorch's nn.KLDivLoss expects log probabilities
+        # Source token representations don't change during decoding so we can project them into source-attending MHA
+        # keys/values only once per sentence (otherwise it's done lazily during the first decode call)
+        if src_representations_batch is not None:
+            for decoder_layer, layer_cache in zip(self.decoder.decoder_layers, decoder_cache.layer_caches):
+                mha = decoder_layer.src_multi_headed_attention
+                layer_cache['src']['key'], layer_cache['src']['value'] = mha.project_key_value(src_representations_batch)
+
+        return decoder_cache
 
 
 #
@@ -110,7 +178,7 @@ class Encoder(nn.Module):
         # Forward pass through the encoder stack
         for encoder_layer in self.encoder_layers:
             # src_mask's role is to mask/ignore padded token representations in the multi-headed self-attention module
-            src_representations_batch = encoder_layer(src_representations_batch, src_mask)
+            src_representations_batch = checkpoint_if_enabled(encoder_layer, src_representations_batch, src_mask)
 
         # Not mentioned explicitly in the paper (a consequence of using LayerNorm before instead of after the sublayer
         # check out the SublayerLogic module)
@@ -128,6 +196,7 @@ class EncoderLayer(nn.Module):
         self.pointwise_net = pointwise_net
 
         self.model_dimension = model_dimension
+        self.checkpoint_activations = False
 
     def forward(self, src_representations_batch, src_mask):
         # Define anonymous (lambda) function which only takes src_representations_batch (srb) as input,
@@ -135,8 +204,8 @@ class EncoderLayer(nn.Module):
         encoder_self_attention = lambda srb: self.multi_headed_attention(query=srb, key=srb, value=srb, mask=src_mask)
 
         # Self-attention MHA sublayer followed by point-wise feed forward net sublayer
-        src_representations_batch = self.sublayers[0](src_representations_batch, encoder_self_attention)
-        src_representations_batch = self.sublayers[1](src_representations_batch, self.pointwise_net)
+        src_representations_batch = checkpoint_if_enabled(self.sublayers[0], src_representations_batch, encoder_self_attention)
+        src_representations_batch = checkpoint_if_enabled(self.sublayers[1], src_representations_batch, self.pointwise_net)
 
         return src_representations_batch
 
@@ -155,14 +224,15 @@ class Decoder(nn.Module):
         self.decoder_layers = get_clones(decoder_layer, number_of_layers)
         self.norm = nn.LayerNorm(decoder_layer.model_dimension)
 
-    def forward(self, trg_embeddings_batch, src_representations_batch, trg_mask, src_mask):
+    def forward(self, trg_embeddings_batch, src_representations_batch, trg_mask, src_mask, decoder_cache=None):
         # Just update the naming so as to reflect the semantics of what this var will become
         trg_representations_batch = trg_embeddings_batch
 
         # Forward pass through the decoder stack
-        for decoder_layer in self.decoder_layers:
+        for layer_id, decoder_layer in enumerate(self.decoder_layers):
+            layer_cache = None if decoder_cache is None else decoder_cache.layer_caches[layer_id]
             # Target mask masks pad tokens as well as future tokens (current target token can't look forward)
-            trg_representations_batch = decoder_layer(trg_representations_batch, src_representations_batch, trg_mask, src_mask)
+            trg_representations_batch = checkpoint_if_enabled(decoder_layer, trg_representations_batch, src_representations_batch, trg_mask, src_mask, layer_cache)
 
         # Not mentioned explicitly in the paper (a consequence of using LayerNorm before instead of after the sublayer
         # check out the SublayerLogic module)
@@ -171,29 +241,35 @@ class Decoder(nn.Module):
 
 class DecoderLayer(nn.Module):
 
-    def __init__(self, model_dimension, dropout_probability, multi_headed_attention, pointwise_net):
+    def __init__(self, model_dimension, dropout_probability, multi_headed_attention, src_multi_headed_attention, pointwise_net):
         super().__init__()
         num_of_sublayers_decoder = 3
         self.sublayers = get_clones(SublayerLogic(model_dimension, dropout_probability), num_of_sublayers_decoder)
 
+        assert multi_headed_attention.self_attention and not src_multi_headed_attention.self_attention, \
+            f'Expected a self-attention MHA and a source-attending MHA.'
         self.trg_multi_headed_attention = copy.deepcopy(multi_headed_attention)
-        self.src_multi_headed_attention = copy.deepcopy(multi_headed_attention)
+        self.src_multi_headed_attention = copy.deepcopy(src_multi_headed_attention)
         self.pointwise_net = pointwise_net
 
         self.model_dimension = model_dimension
+        self.checkpoint_activations = False
 
-    def forward(self, trg_representations_batch, src_representations_batch, trg_mask, src_mask):
+    def forward(self, trg_representations_batch, src_representations_batch, trg_mask, src_mask, layer_cache=None):
         # Define anonymous (lambda) function which only takes trg_representations_batch (trb - funny name I know)
         # as input - this way we have a uniform interface for the sublayer logic.
         # The inputs which are not passed into lambdas are "cached" here that's why the thing works.
         srb = src_representations_batch  # simple/short alias
-        decoder_trg_self_attention = lambda trb: self.trg_multi_headed_attention(query=trb, key=trb, value=trb, mask=trg_mask)
-        decoder_src_attention = lambda trb: self.src_multi_headed_attention(query=trb, key=srb, value=srb, mask=src_mask)
+        # During decoding the self-attention MHA appends keys/values of the newest tokens to the ones cached so far,
+        # whereas the source-attending MHA keys/values are static (projected source representations) and just reused
+        trg_kv_cache, src_kv_cache = (None, None) if layer_cache is None else (layer_cache['trg'], layer_cache['src'])
+        decoder_trg_self_attention = lambda trb: self.trg_multi_headed_attention(query=trb, key=trb, value=trb, mask=trg_mask, kv_cache=trg_kv_cache)
+        decoder_src_attention = lambda trb: self.src_multi_headed_attention(query=trb, key=srb, value=srb, mask=src_mask, kv_cache=src_kv_cache)
 
         # Self-attention MHA sublayer followed by a source-attending MHA and point-wise feed forward net sublayer
-        trg_representations_batch = self.sublayers[0](trg_representations_batch, decoder_trg_self_attention)
-        trg_representations_batch = self.sublayers[1](trg_representations_batch, decoder_src_attention)
-        trg_representations_batch = self.sublayers[2](trg_representations_batch, self.pointwise_net)
+        trg_representations_batch = checkpoint_if_enabled(self.sublayers[0], trg_representations_batch, decoder_trg_self_attention)
+        trg_representations_batch = checkpoint_if_enabled(self.sublayers[1], trg_representations_batch, decoder_src_attention)
+        trg_representations_batch = checkpoint_if_enabled(self.sublayers[2], trg_representations_batch, self.pointwise_net)
 
         return trg_representations_batch
 
@@ -211,6 +287,7 @@ class SublayerLogic(nn.Module):
         super().__init__()
         self.norm = nn.LayerNorm(model_dimension)
         self.dropout = nn.Dropout(p=dropout_probability)
+        self.checkpoint_activations = False
 
     def forward(self, representations_batch, sublayer_module):
         # Residual connection between input and sublayer output, details: Page 7, Chapter 5.4 "Regularization",
@@ -224,13 +301,32 @@ class DecoderGenerator(nn.Module):
         self.linear = nn.Linear(model_dimension, vocab_size)
 
         # -1 stands for apply the log-softmax along the last dimension i.e. over the vocab dimension as the output from
-        # the linear layer has shape (B, T, V), B - batch size, T - max target token-sequence, V - target vocab size
+        # the linear layer has shape (N, V), N - number of target tokens (see Transformer.decode), V - target vocab size
         # again using log softmax as PyTorch's nn.KLDivLoss expects log probabilities (just a technical detail)
         self.log_softmax = nn.LogSoftmax(dim=-1)
 
-    def forward(self, trg_representations_batch):
-        # Project from D (model dimension) into V (target vocab size) and apply the log softmax along V dimension
-        return self.log_softmax(self.linear(trg_representations_batch))
+    def forward(self, trg_representations_batch, shortlist_linear=None):
+        # Project from D (model dimension) into V (target vocab size) and apply the log softmax along V dimension, or
+        # only into the K shortlisted target tokens if we got a shortlist linear layer (see get_shortlist_linear)
+        linear = self.linear if shortlist_linear is None else shortlist_linear
+        return self.log_softmax(linear(trg_representations_batch))
+
+    def get_shortlist_linear(self, vocab_shortlist):
+        """
+            Linear layer which only projects into the shortlisted target tokens (sorted ids of shape (K,), see
+            shortlist_utils.py). The weight/bias rows get selected here so call it once per batch (every decoding step
+            uses the same shortlist) and pass the result into decode. Int8 quantized weights stay quantized.
+
+        """
+        if callable(self.linear.weight):  # dynamically quantized linear layer (see quantization_utils.py)
+            shortlist_linear = type(self.linear)(self.linear.in_features, vocab_shortlist.shape[0], dtype=torch.qint8)
+            shortlist_linear.set_weight_bias(self.linear.weight().index_select(0, vocab_shortlist), self.linear.bias().index_select(0, vocab_shortlist))
+            return shortlist_linear
+
+        # The rows get upcast if the weights are stored in reduced precision (see mmap_weights_utils.py)
+        shortlist_weight = self.linear.weight.index_select(0, vocab_shortlist).float()
+        shortlist_bias = self.linear.bias.index_select(0, vocab_shortlist).float()
+        return functools.partial(F.linear, weight=shortlist_weight, bias=shortlist_bias)
 
 
 class PositionwiseFeedForwardNet(nn.Module):
@@ -274,10 +370,12 @@ class MultiHeadedAttention(nn.Module):
 
         Optimization notes:
 
-        qkv_nets could be replaced by Parameter(torch.empty(3 * model_dimension, model_dimension)) and one more matrix
-        for bias, which would make the implementation a bit more optimized. For the sake of easier understanding though,
-        I'm doing it like this - using 3 "feed forward nets" (without activation/identity hence the quotation marks).
-        Conceptually both implementations are the same.
+        Conceptually we have 3 "feed forward nets" (without activation/identity hence the quotation marks) which project
+        query, key and value. In self-attention query, key and value are the same tensor so I fuse the 3 nets into a
+        single (3 * model_dimension, model_dimension) qkv_net - a single bigger matrix multiplication is faster than
+        3 smaller ones. In the source-attending MHA keys and values both come from the encoder so only those 2 get
+        fused into kv_net (and there is a separate q_net). Older checkpoints with qkv_nets.{0,1,2} are converted
+        when loading the state dict (check out _load_from_state_dict).
 
         PyTorch's query/key/value are of different shape namely (max token sequence length, batch size, model dimension)
         whereas I'm using (batch size, max token sequence length, model dimension) because it's easier to understand
@@ -291,14 +389,21 @@ class MultiHeadedAttention(nn.Module):
 
     """
 
-    def __init__(self, model_dimension, number_of_heads, dropout_probability, log_attention_weights):
+    def __init__(self, model_dimension, number_of_heads, dropout_probability, log_attention_weights, attention_backend=AttentionBackend.SDPA.name,
+                 attention_chunk_size=64, self_attention=True):
         super().__init__()
         assert model_dimension % number_of_heads == 0, f'Model dimension must be divisible by the number of heads.'
 
         self.head_dimension = int(model_dimension / number_of_heads)
         self.number_of_heads = number_of_heads
 
-        self.qkv_nets = get_clones(nn.Linear(model_dimension, model_dimension), 3)  # identity activation hence "nets"
+        # identity activation hence "nets"
+        self.self_attention = self_attention
+        if self_attention:
+            self.qkv_net = nn.Linear(model_dimension, 3 * model_dimension)
+        else:
+            self.q_net = nn.Linear(model_dimension, model_dimension)
+            self.kv_net = nn.Linear(model_dimension, 2 * model_dimension)
         self.out_projection_net = nn.Linear(model_dimension, model_dimension)
 
         self.attention_dropout = nn.Dropout(p=dropout_probability)  # no pun intended, not explicitly mentioned in paper
@@ -307,7 +412,38 @@ class MultiHeadedAttention(nn.Module):
         self.log_attention_weights = log_attention_weights  # should we log attention weights
         self.attention_weights = None  # for visualization purposes, I cache the weights here (translation_script.py)
 
+        assert attention_backend in [el.name for el in AttentionBackend], f'Unknown attention backend {attention_backend}.'
+        self.attention_backend = attention_backend
+        self.attention_chunk_size = attention_chunk_size
+
     def attention(self, query, key, value, mask):
+        # Only the reference implementation materializes the attention weights so we use it whenever we need to log them
+        use_sdpa = self.attention_backend == AttentionBackend.SDPA.name and hasattr(F, 'scaled_dot_product_attention')
+        use_chunked = self.attention_backend == AttentionBackend.CHUNKED.name
+
+        if self.log_attention_weights or not (use_sdpa or use_chunked):
+            return self.reference_attention(query, key, value, mask)
+        elif use_sdpa:
+            # Same semantics for the boolean mask - True means we attend to that token
+            dropout_probability = self.attention_dropout.p if self.training else 0.
+            return F.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=dropout_probability), None
+        else:
+            return self.chunked_attention(query, key, value, mask), None
+
+    def chunked_attention(self, query, key, value, mask):
+        # Exactly the same math as the reference attention but we only ever have scores of shape (B, NH, chunk, S/T)
+        # instead of (B, NH, S/T, S/T) in memory (at inference time, during training autograd keeps them for backward)
+        intermediate_token_representations_chunks = []
+        for chunk_start in range(0, query.shape[2], self.attention_chunk_size):
+            chunk_end = chunk_start + self.attention_chunk_size
+            # mask shape = (B, 1, 1, S) gets broad-casted over all queries, (B, 1, T, T) needs to be chunked as well
+            mask_chunk = mask[:, :, chunk_start:chunk_end] if mask is not None and mask.shape[2] > 1 else mask
+            intermediate_token_representations_chunk, _ = self.reference_attention(query[:, :, chunk_start:chunk_end], key, value, mask_chunk)
+            intermediate_token_representations_chunks.append(intermediate_token_representations_chunk)
+
+        return torch.cat(intermediate_token_representations_chunks, dim=2)
+
+    def reference_attention(self, query, key, value, mask):
         # Step 1: Scaled dot-product attention, Page 4, Chapter 3.2.1 "Scaled Dot-Product Attention"
         # Notation: B - batch size, S/T max src/trg token-sequence length, NH - number of heads, HD - head dimension
         # query/key/value shape = (B, NH, S/T, HD), scores shape = (B, NH, S, S), (B, NH, T, T) or (B, NH, T, S)
@@ -318,7 +454,7 @@ class MultiHeadedAttention(nn.Module):
         # to locations corresponding to those tokens (force softmax to output 0 probability on those locations).
         # mask shape = (B, 1, 1, S) or (B, 1, T, T) will get broad-casted (copied) as needed to match scores shape
         if mask is not None:
-            scores.masked_fill_(mask == torch.tensor(False), float("-inf"))
+            scores.masked_fill_(torch.logical_not(mask), float("-inf"))
 
         # Step 3: Calculate the attention weights - how much should we attend to surrounding token representations
         attention_weights = self.softmax(scores)
@@ -333,20 +469,50 @@ class MultiHeadedAttention(nn.Module):
 
         return intermediate_token_representations, attention_weights  # attention weights for visualization purposes
 
-    def forward(self, query, key, value, mask):
+    def split_heads(self, projected, num_of_projections):
+        # Shape goes from (B, S/T, N*NH*HD) over (B, S/T, N, NH, HD) to N tensors of shape (B, NH, S/T, HD), where N is
+        # the number of fused projections (3 for qkv_net, 2 for kv_net and 1 for q_net), NH*HD=D (model dimension)
+        batch_size = projected.shape[0]
+        projected = projected.view(batch_size, -1, num_of_projections, self.number_of_heads, self.head_dimension)
+        return projected.permute(2, 0, 3, 1, 4).unbind(0)
+
+    def project_key_value(self, key_value):
+        # Only used by the source-attending MHA, keys and values are both projected from the encoder's output
+        return self.split_heads(self.kv_net(key_value), 2)
+
+    def forward(self, query, key, value, mask, kv_cache=None):
         batch_size = query.shape[0]
 
         # Step 1: Input linear projection
         # Notation: B - batch size, NH - number of heads, S/T - max src/trg token-sequence length, HD - head dimension
-        # Shape goes from (B, S/T, NH*HD) over (B, S/T, NH, HD) to (B, NH, S/T, HD) (NH*HD=D where D is model dimension)
-        query, key, value = [net(x).view(batch_size, -1, self.number_of_heads, self.head_dimension).transpose(1, 2)
-                             for net, x in zip(self.qkv_nets, (query, key, value))]
+        if self.self_attention:
+            assert query is key and key is value, f'Self-attention expects the same query, key and value tensor.'
+            query, key, value = self.split_heads(self.qkv_net(query), 3)
+
+            # Step 1.5: Optionally (decoding) prepend the keys/values of the previous tokens and cache the concatenated
+            # ones. Old tokens can't look ahead so their keys/values never change, no need to recompute them every step.
+            if kv_cache is not None:
+                if 'key' in kv_cache:
+                    key = torch.cat((kv_cache['key'], key), dim=2)
+                    value = torch.cat((kv_cache['value'], value), dim=2)
+                kv_cache['key'], kv_cache['value'] = key, value
+        else:
+            assert key is value, f'Source-attending MHA expects the same key and value tensor.'
+            query, = self.split_heads(self.q_net(query), 1)
+
+            # Step 1.5: Keys/values (projected encoder outputs) are static during decoding - project them only once
+            if kv_cache is not None and 'key' in kv_cache:
+                key, value = kv_cache['key'], kv_cache['value']
+            else:
+                key, value = self.project_key_value(key)
+                if kv_cache is not None:
+                    kv_cache['key'], kv_cache['value'] = key, value
 
         # Step 2: Apply attention - compare query with key and use that to combine values (see the function for details)
         intermediate_token_representations, attention_weights = self.attention(query, key, value, mask)
 
         # Potentially, for visualization purposes, log the attention weights, turn off during training though!
-        # I had memory problems when I leave this on by default
+        # I had memory problems when I leave this on by default (also it forces the slower reference attention backend)
         if self.log_attention_weights:
             self.attention_weights = attention_weights
 
@@ -359,6 +525,21 @@ class MultiHeadedAttention(nn.Module):
 
         return token_representations
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Convert older checkpoints (e.g. iwslt_e2g.pth) which have separate query/key/value nets (qkv_nets.{0,1,2})
+        # into the fused format, concatenating along the output dimension gives exactly the same projections
+        for param_name in ['weight', 'bias']:
+            legacy_names = [f'{prefix}qkv_nets.{i}.{param_name}' for i in range(3)]
+            if all(legacy_name in state_dict for legacy_name in legacy_names):
+                query_param, key_param, value_param = [state_dict.pop(legacy_name) for legacy_name in legacy_names]
+                if self.self_attention:
+                    state_dict[f'{prefix}qkv_net.{param_name}'] = torch.cat((query_param, key_param, value_param), dim=0)
+                else:
+                    state_dict[f'{prefix}q_net.{param_name}'] = query_param
+                    state_dict[f'{prefix}kv_net.{param_name}'] = torch.cat((key_param, value_param), dim=0)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 #
 # Input modules
@@ -404,24 +585,188 @@ class PositionalEncoding(nn.Module):
         # these are not trainable (not model's parameters) so they otherwise would be excluded from the state_dict
         self.register_buffer('positional_encodings_table', positional_encodings_table)
 
-    def forward(self, embeddings_batch):
+    def forward(self, embeddings_batch, start_position=0):
         assert embeddings_batch.ndim == 3 and embeddings_batch.shape[-1] == self.positional_encodings_table.shape[1], \
             f'Expected (batch size, max token sequence length, model dimension) got {embeddings_batch.shape}'
 
         # embedding_batch's shape = (B, S/T, D), where S/T max src/trg token-sequence length, D - model dimension
         # So here we get (S/T, D) shape which will get broad-casted to (B, S/T, D) when we try and add it to embeddings
-        positional_encodings = self.positional_encodings_table[:embeddings_batch.shape[1]]
+        # (start_position is non-zero only during cached decoding where we only pass in the newest target tokens)
+        if torch.is_tensor(start_position):
+            # Continuous batching - every sequence is at a different position, shape (B,) -> encodings shape (B, T, D)
+            positions = start_position.unsqueeze(1) + torch.arange(embeddings_batch.shape[1], device=start_position.device)
+            positional_encodings = self.positional_encodings_table[positions]
+        else:
+            positional_encodings = self.positional_encodings_table[start_position:start_position + embeddings_batch.shape[1]]
 
         # (stated in the paper) Applying dropout to the sum of positional encodings and token embeddings
         # Page 7, Chapter 5.4 "Regularization"
         return self.dropout(embeddings_batch + positional_encodings)
 
 
+#
+# Decoding cache
+#
+
+
+class DecoderCache:
+    """
+        Holds keys/values of the already decoded target tokens for every decoder layer.
+
+        Each decoder layer gets a dict - 'trg' entry is used by the self-attention MHA (keys/values of shape
+        (B, NH, T, HD) which grow by the number of newly passed target tokens on every decode call) and 'src' entry
+        is used by the source-attending MHA (keys/values of shape (B, NH, S, HD) which never change).
+
+    """
+
+    def __init__(self, number_of_layers):
+        self.layer_caches = [{'trg': dict(), 'src': dict()} for _ in range(number_of_layers)]
+
+        # Continuous batching (see continuous_batching_utils.py) - sequences in the batch are at different decoding
+        # steps so their target keys/values are left padded (aligned to the right) and this holds the position of the
+        # next token of every sequence, shape (B,). None means that all of the sequences are at the same step.
+        self.positions = None
+
+    @property
+    def num_cached_tokens(self):
+        trg_kv_cache = self.layer_caches[0]['trg']
+        return trg_kv_cache['key'].shape[2] if 'key' in trg_kv_cache else 0
+
+    @property
+    def next_positions(self):
+        return self.num_cached_tokens if self.positions is None else self.positions
+
+    def reorder(self, indices):
+        # Pick (and potentially repeat) cached keys/values along the batch dimension, e.g. to follow the surviving
+        # hypotheses in beam search or to drop the sentences that were already fully decoded
+        for layer_cache in self.layer_caches:
+            for kv_cache in layer_cache.values():
+                for name, tensor in kv_cache.items():
+                    kv_cache[name] = tensor.index_select(0, indices)
+        if self.positions is not None:
+            self.positions = self.positions.index_select(0, indices)
+
+    def slice_trg(self, start, end=None):
+        # Keep only the target keys/values of tokens [start, end), e.g. to drop the left padding nobody needs anymore
+        for layer_cache in self.layer_caches:
+            trg_kv_cache = layer_cache['trg']
+            for name, tensor in trg_kv_cache.items():
+                trg_kv_cache[name] = tensor[:, :, start:end]
+
+    def compact_trg(self, keep_mask):
+        """
+            Keeps only the target keys/values where keep_mask (shape (B, T)) is True, e.g. to drop the rejected draft
+            tokens during speculative decoding. Sequences can keep different numbers of tokens so the kept ones get
+            aligned to the right (left padding, same as with continuous batching) - it's up to the caller to mask out
+            the padding. Returns the indices (shape (B, T')) of the kept tokens so that the caller can gather its own
+            per token state (positions where the index points to a dropped token are the new left padding).
+
+        """
+        num_tokens = keep_mask.shape[1]
+        num_kept_tokens = int(keep_mask.sum(dim=1).max().item())
+
+        # Sorting puts the dropped tokens first and keeps the kept ones in their original order
+        sort_keys = torch.where(keep_mask, torch.arange(num_tokens, device=keep_mask.device), -1)
+        indices = torch.argsort(sort_keys, dim=1)[:, num_tokens - num_kept_tokens:]
+
+        for layer_cache in self.layer_caches:
+            trg_kv_cache = layer_cache['trg']
+            for name, tensor in trg_kv_cache.items():
+                trg_kv_cache[name] = tensor.gather(2, indices.view(indices.shape[0], 1, -1, 1).expand(-1, tensor.shape[1], -1, tensor.shape[3]))
+
+        return indices
+
+    @staticmethod
+    def concatenate(decoder_caches):
+        """
+            Concatenates the caches along the batch dimension (e.g. sequences joining the batch during continuous
+            batching). Target keys/values get left padded and source keys/values right padded (with zeros) to the same
+            length - it's up to the caller to mask out the padded positions. Expects the source keys/values to be set.
+
+        """
+        decoder_cache = DecoderCache(len(decoder_caches[0].layer_caches))
+        num_cached_tokens = max(cache.num_cached_tokens for cache in decoder_caches)
+
+        for layer_id, layer_cache in enumerate(decoder_cache.layer_caches):
+            for name in ['key', 'value']:
+                # Shape = (B, NH, S, HD), where B - batch size, NH - number of heads, S - source length, HD - head dim
+                src_tensors = [cache.layer_caches[layer_id]['src'][name] for cache in decoder_caches]
+                src_length = max(src_tensor.shape[2] for src_tensor in src_tensors)
+                layer_cache['src'][name] = torch.cat([F.pad(src_tensor, (0, 0, 0, src_length - src_tensor.shape[2])) for src_tensor in src_tensors])
+
+                if num_cached_tokens > 0:
+                    # Empty caches (sequences which didn't start decoding yet) don't have target keys/values yet
+                    trg_tensors = [cache.layer_caches[layer_id]['trg'].get(name, src_tensor[:, :, :0]) for cache, src_tensor in zip(decoder_caches, src_tensors)]
+                    layer_cache['trg'][name] = torch.cat([F.pad(trg_tensor, (0, 0, num_cached_tokens - trg_tensor.shape[2], 0)) for trg_tensor in trg_tensors])
+
+        # Positions of the next tokens, for caches without explicit positions all of the sequences are at the same step
+        positions = []
+        for cache in decoder_caches:
+            cache_positions = cache.positions
+            if cache_positions is None:
+                src_key = cache.layer_caches[0]['src']['key']
+                cache_positions = torch.full((src_key.shape[0],), cache.num_cached_tokens, dtype=torch.long, device=src_key.device)
+            positions.append(cache_positions)
+        decoder_cache.positions = torch.cat(positions)
+
+        return decoder_cache
+
+
 #
 # Helper model functions
 #
 
 
+# torch.device as a context manager (PyTorch 2.0) and load_state_dict's assign argument (PyTorch 2.1)
+META_DEVICE_CONSTRUCTION_SUPPORTED = hasattr(torch.device, '__enter__') and 'assign' in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def build_transformer_skeleton(**transformer_kwargs):
+    """
+        Regular construction allocates and initializes all of the weights (xavier, deep copied layers, positional
+        encodings tables...) only for load_state_dict to overwrite them right away.
+
+        Here the model is built on the meta device instead - tensors have shapes but no storage, so nothing gets
+        allocated or computed. Use materialize_transformer to turn the checkpoint tensors into the model's weights.
+        Older PyTorch versions fall back to the regular (CPU) construction minus the weight initialization.
+
+    """
+    if META_DEVICE_CONSTRUCTION_SUPPORTED:
+        with torch.device('meta'):
+            return Transformer(**transformer_kwargs, initialize_weights=False)
+    return Transformer(**transformer_kwargs, initialize_weights=False)
+
+
+def materialize_transformer(transformer_skeleton, state_dict, device):
+    # With a meta skeleton the checkpoint tensors become the weights directly (no copies), expects the full state dict
+    if META_DEVICE_CONSTRUCTION_SUPPORTED:
+        transformer_skeleton.load_state_dict(state_dict, strict=True, assign=True)
+    else:
+        transformer_skeleton.load_state_dict(state_dict, strict=True)
+    return transformer_skeleton.to(device)
+
+
+def allocate_transformer_skeleton(transformer_skeleton, device):
+    # Allocates zeroed weights, e.g. quantization needs real tensors before loading a state dict. Zeroed and not empty
+    # as garbage memory can contain NaNs which break quantization's observers (still way cheaper than the xavier init)
+    if META_DEVICE_CONSTRUCTION_SUPPORTED:
+        transformer_skeleton = transformer_skeleton.to_empty(device=device)
+        with torch.no_grad():
+            for tensor in list(transformer_skeleton.parameters()) + list(transformer_skeleton.buffers()):
+                tensor.zero_()
+        return transformer_skeleton
+    return transformer_skeleton.to(device)
+
+
+def checkpoint_if_enabled(module, *inputs):
+    # Activation checkpointing (training only) - the module's intermediate activations aren't kept for backward but
+    # recomputed. The RNG state gets stashed and restored so that the recomputation drops the very same dropout units.
+    # Non-reentrant variant as the sublayer lambdas capture tensors which require grads (e.g. source representations)
+    if module.checkpoint_activations and module.training and torch.is_grad_enabled():
+        return checkpoint(module, *inputs, use_reentrant=False, preserve_rng_state=True)
+    return module(*inputs)
+
+
 def get_clones(module, num_of_deep_copies):
     # Create deep copies so that we can tweak each module's weights independently
     return nn.ModuleList([copy.deepcopy(module) for _ in range(num_of_deep_copies)])
@@ -447,6 +792,7 @@ def analyze_state_dict_shapes_and_names(model):
 # Testing the correctness of the transformer model - feel free to ignore - I used it during model development
 if __name__ == "__main__":
     use_big_transformer = False
+    torch.manual_seed(0)  # the checks below run randomly initialized models, keep them reproducible
 
     # Dummy data
     src_vocab_size = 11
@@ -472,3 +818,111 @@ if __name__ == "__main__":
     print(f'Size of the {"big" if use_big_transformer else "baseline"} transformer = {count_parameters(transformer)}')
 
     out = transformer(src_token_ids_batch, trg_token_ids_batch, src_mask=None, trg_mask=None)
+
+    # Dummy target vocab for the decoding checks below
+    from types import SimpleNamespace
+    trg_itos = [PAD_TOKEN, BOS_TOKEN, EOS_TOKEN] + [f'token_{i}' for i in range(trg_vocab_size - 3)]
+    trg_field_processor = SimpleNamespace(vocab=SimpleNamespace(itos=trg_itos, stoi={token: i for i, token in enumerate(trg_itos)}))
+    pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
+
+    # Verify that cached decoding gives the same log probabilities as a single uncached decode call - padded source
+    # sentences, both the self-attention and the source-attending (projected upfront or lazily) caches over many steps,
+    # token by token and with multiple tokens per decode call (e.g. speculative decoding's verification)
+    transformer.eval()
+    with torch.no_grad():
+        num_trg_tokens = 12
+        src_token_ids_batch = torch.randint(3, 10, size=(4, 9))
+        src_token_ids_batch[1, 5:] = pad_token_id
+        src_token_ids_batch[2, 2:] = pad_token_id
+        src_mask = (src_token_ids_batch != pad_token_id).view(4, 1, 1, -1)
+        trg_token_ids_batch = torch.randint(3, 10, size=(4, num_trg_tokens))
+        trg_mask = torch.tril(torch.ones((1, 1, num_trg_tokens, num_trg_tokens), dtype=torch.bool))  # no-look-forward mask
+
+        src_representations_batch = transformer.encode(src_token_ids_batch, src_mask)
+        uncached_log_probs = transformer.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask).view(4, num_trg_tokens, -1)
+
+        for name, decoder_cache, step_sizes in [
+            ('token by token', transformer.init_decoder_cache(src_representations_batch), [1] * num_trg_tokens),
+            ('token by token, lazy source keys/values', transformer.init_decoder_cache(), [1] * num_trg_tokens),
+            ('multiple tokens per call', transformer.init_decoder_cache(src_representations_batch), [5, 1, 3, 1, 2])
+        ]:
+            cached_log_probs = []
+            for step_size in step_sizes:
+                start = decoder_cache.num_cached_tokens
+                step_trg_mask = trg_mask[:, :, start:start + step_size, :start + step_size]
+                step_log_probs = transformer.decode(trg_token_ids_batch[:, start:start + step_size], src_representations_batch, step_trg_mask, src_mask, decoder_cache)
+                cached_log_probs.append(step_log_probs.view(4, step_size, -1))
+            cached_log_probs = torch.cat(cached_log_probs, dim=1)
+            assert torch.allclose(uncached_log_probs, cached_log_probs, atol=1e-5), f'Cached decoding ({name}) differs from uncached decoding, max abs diff = {(uncached_log_probs - cached_log_probs).abs().max()}.'
+            print(f'Cached decoding ({name}, {num_trg_tokens} tokens) matches uncached decoding.')
+
+    # Verify that speculative greedy decoding gives the same output as greedy decoding both when the draft model
+    # disagrees with the main model (randomly initialized, smaller one) so that 2+ draft tokens get rejected and when
+    # it's a copy of the main model so that all of the draft tokens get accepted (multiple tokens per decoder call)
+    from utils.decoding_utils import greedy_decoding
+    from utils.speculative_decoding_utils import speculative_greedy_decoding, DraftModelProposer
+
+    draft_transformer = Transformer(model_dimension=32, src_vocab_size=src_vocab_size, trg_vocab_size=trg_vocab_size, number_of_heads=4, number_of_layers=1, dropout_probability=0.).eval()
+
+    with torch.no_grad():
+        src_token_ids_batch = torch.randint(3, 10, size=(5, 7))
+        src_token_ids_batch[0, 4:] = pad_token_id
+        src_token_ids_batch[3, 2:] = pad_token_id
+        src_mask = (src_token_ids_batch != pad_token_id).view(5, 1, 1, -1)
+        src_representations_batch = transformer.encode(src_token_ids_batch, src_mask)
+
+        greedy_tokens = greedy_decoding(transformer, src_representations_batch, src_mask, trg_field_processor, max_target_tokens=30)
+        for draft_name, draft_model, num_draft_tokens in [('random', draft_transformer, 4), ('copy', copy.deepcopy(transformer), 1), ('copy', copy.deepcopy(transformer), 3), ('copy', copy.deepcopy(transformer), 4)]:
+            stats = dict()
+            speculative_tokens = speculative_greedy_decoding(transformer, src_token_ids_batch, src_representations_batch, src_mask, trg_field_processor, DraftModelProposer(draft_model, pad_token_id), num_draft_tokens=num_draft_tokens, max_target_tokens=30, stats=stats)
+            assert speculative_tokens == greedy_tokens, f'Speculative decoding ({draft_name} draft model, k={num_draft_tokens}) differs from greedy decoding.'
+            if draft_name == 'copy':
+                assert stats['num_accepted_tokens'] == stats['num_drafted_tokens'], f'Copy of the main model got only {stats["num_accepted_tokens"]}/{stats["num_drafted_tokens"]} draft tokens accepted.'
+            print(f'Speculative decoding ({draft_name} draft model, k={num_draft_tokens}, {stats["num_accepted_tokens"]}/{stats["num_drafted_tokens"]} draft tokens accepted) matches greedy decoding.')
+
+        # Verify that continuous batching gives the same output as greedy decoding - requests keep joining the pool while
+        # other sequences are mid-decoding (different positions, left padded caches) and the pool can't fit all of them
+        from utils.continuous_batching_utils import ContinuousBatchingScheduler
+
+        num_requests = 12
+        request_src_token_ids_batch = torch.randint(3, 10, size=(num_requests, 7))
+        for request_id in range(num_requests):
+            request_src_token_ids_batch[request_id, request_id % 6 + 2:] = pad_token_id
+        request_src_mask = (request_src_token_ids_batch != pad_token_id).view(num_requests, 1, 1, -1)
+        request_src_representations_batch = transformer.encode(request_src_token_ids_batch, request_src_mask)
+        request_greedy_tokens = greedy_decoding(transformer, request_src_representations_batch, request_src_mask, trg_field_processor, max_target_tokens=30)
+
+        scheduler = ContinuousBatchingScheduler(transformer, trg_field_processor, max_pool_size=4, max_target_tokens=30)
+        continuous_batching_tokens = dict()
+        for request_id in range(0, num_requests, 2):  # 2 new requests every 3 steps
+            assert request_id == 0 or scheduler.num_in_flight > 0, 'Expected the requests to join while others are being decoded.'
+            indices = torch.tensor([request_id, request_id + 1])
+            scheduler.add_requests(indices.tolist(), request_src_representations_batch.index_select(0, indices), request_src_mask.index_select(0, indices))
+            for _ in range(3):
+                continuous_batching_tokens.update(scheduler.step())
+        continuous_batching_tokens.update(scheduler.run())
+        continuous_batching_tokens = [continuous_batching_tokens[request_id] for request_id in range(num_requests)]
+        assert continuous_batching_tokens == request_greedy_tokens, f'Continuous batching differs from greedy decoding:\n{continuous_batching_tokens}\n{request_greedy_tokens}'
+        print(f'Continuous batching ({num_requests} requests joining mid-run, {scheduler.num_steps} steps) matches greedy decoding.')
+
+        # Verify that greedy decoding (finished sentences get removed from the batch, checked every 8 steps, per sentence
+        # max lengths) gives the same output as the plain step by step loop which re-decodes the whole batch every step
+        max_length_coefficients = (2, 3)  # max length = 2 * S + 3, i.e. 11, 17, 17, 7 and 17 target tokens
+        greedy_tokens = greedy_decoding(transformer, src_representations_batch, src_mask, trg_field_processor, max_target_tokens=30, max_length_coefficients=max_length_coefficients)
+
+        num_src_tokens_per_sentence = src_mask.view(5, -1).sum(dim=-1).tolist()
+        max_target_tokens_per_sentence = [min(int(max_length_coefficients[0] * num_src_tokens + max_length_coefficients[1]), 30) for num_src_tokens in num_src_tokens_per_sentence]
+        trg_token_ids_batch = torch.full((5, 1), trg_field_processor.vocab.stoi[BOS_TOKEN])
+        for num_of_trg_tokens in range(1, max(max_target_tokens_per_sentence) + 1):
+            trg_mask = (trg_token_ids_batch != pad_token_id).view(5, 1, 1, -1) & torch.tril(torch.ones((num_of_trg_tokens, num_of_trg_tokens), dtype=torch.bool))
+            predicted_log_distributions = transformer.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask).view(5, num_of_trg_tokens, -1)
+            trg_token_ids_batch = torch.cat((trg_token_ids_batch, torch.argmax(predicted_log_distributions[:, -1], dim=-1, keepdim=True)), dim=1)
+
+        plain_greedy_tokens = []
+        for token_ids, max_target_tokens_of_sentence in zip(trg_token_ids_batch.tolist(), max_target_tokens_per_sentence):
+            target_sentence_tokens = [trg_itos[token_id] for token_id in token_ids[:max_target_tokens_of_sentence + 1]]
+            plain_greedy_tokens.append(target_sentence_tokens[:target_sentence_tokens.index(EOS_TOKEN) + 1] if EOS_TOKEN in target_sentence_tokens else target_sentence_tokens)
+        assert greedy_tokens == plain_greedy_tokens, f'Greedy decoding differs from the plain greedy loop:\n{greedy_tokens}\n{plain_greedy_tokens}'
+        # Otherwise the check wouldn't cover the per sentence max lengths (random weights rarely predict the EOS token)
+        assert any(EOS_TOKEN not in tokens and len(tokens) == max_target_tokens + 1 for tokens, max_target_tokens in zip(plain_greedy_tokens, max_target_tokens_per_sentence)), 'No sentence got cut at its max length.'
+        print(f'Greedy decoding (per sentence max lengths {max_target_tokens_per_sentence}) matches the plain greedy loop.')
@@ -8,59 +8,114 @@
 
 import argparse
 import time
+import random
+import contextlib
 
 
 import torch
-from torch import nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import Adam
-from torch.utils.tensorboard import SummaryWriter
 
 
-from utils.optimizers_and_distributions import CustomLRAdamOptimizer, LabelSmoothingDistribution
-from models.definitions.transformer_model import Transformer
+from utils.optimizers_and_distributions import CustomLRAdamOptimizer, LabelSmoothingKLDivLoss
+from utils.chunked_loss_utils import chunked_generator_label_smoothing_loss
+from utils.distributed_utils import get_free_port, init_distributed_training, get_training_steps
+from models.definitions.transformer_model import Transformer, AttentionBackend, ActivationCheckpointing
 from utils.data_utils import get_data_loaders, get_masks_and_count_tokens, get_src_and_trg_batches, DatasetType, LanguageDirection
 import utils.utils as utils
 from utils.constants import *
 
 
 # Global vars for logging purposes
-num_of_trg_tokens_processed = 0
+num_of_trg_tokens_processed, num_of_train_steps_processed = [0, 0]
 bleu_scores = []
 global_train_step, global_val_step = [0, 0]
-writer = SummaryWriter()  # (tensorboard) writer will output to ./runs/ directory by default
+writer = None  # (tensorboard) writer, created on first use and only by the main process (see get_writer)
+
+
+def get_writer():
+    global writer
+    if writer is None:
+        from torch.utils.tensorboard import SummaryWriter  # imported lazily, pulls in tensorboard
+        writer = SummaryWriter()  # will output to ./runs/ directory by default
+    return writer
 
 
 # Simple decorator function so that I don't have to pass these arguments every time I call get_train_val_loop
-def get_train_val_loop(baseline_transformer, custom_lr_optimizer, kl_div_loss, label_smoothing, pad_token_id, time_start):
+def get_train_val_loop(training_config, baseline_transformer, custom_lr_optimizer, label_smoothing_loss, pad_token_id, src_field_processor, trg_field_processor, time_start, rank=0, world_size=1):
+    # In the distributed mode baseline_transformer is wrapped into DistributedDataParallel, which is only needed for the
+    # training forward passes (that's where it hooks in the gradient all-reduce) - use the plain model everywhere else
+    model = baseline_transformer.module if isinstance(baseline_transformer, DistributedDataParallel) else baseline_transformer
+    is_main_process = rank == 0
+
+    # When every batch is its own optimizer step the loss is normalized by B*T (historical behaviour, see below),
+    # otherwise (gradient accumulation or multiple processes) by the number of target tokens of the whole step
+    normalize_by_step_tokens = world_size > 1 or training_config['tokens_per_step'] is not None
 
     def train_val_loop(is_train, token_ids_loader, epoch):
-        global num_of_trg_tokens_processed, global_train_step, global_val_step, writer
+        global num_of_trg_tokens_processed, num_of_train_steps_processed, global_train_step, global_val_step
 
         if is_train:
             baseline_transformer.train()
         else:
-            baseline_transformer.eval()
+            model.eval()
 
-        device = next(baseline_transformer.parameters()).device
+        device = next(model.parameters()).device
+
+        # Every step is a list of batches (of this process) whose gradients get accumulated before the optimizer step,
+        # the LR schedule thus advances once per such step (see get_training_steps in distributed_utils.py)
+        if is_train:
+            steps = get_training_steps(token_ids_loader, pad_token_id, rank, world_size, training_config['tokens_per_step'])
+        else:
+            steps = (([token_ids_batch], None) for token_ids_batch in token_ids_loader)
 
         #
         # Main loop - start of the CORE PART
         #
-        for batch_idx, token_ids_batch in enumerate(token_ids_loader):
-            src_token_ids_batch, trg_token_ids_batch_input, trg_token_ids_batch_gt = get_src_and_trg_batches(token_ids_batch)
-            src_mask, trg_mask, num_src_tokens, num_trg_tokens = get_masks_and_count_tokens(src_token_ids_batch, trg_token_ids_batch_input, pad_token_id, device)
-
-            # log because the KL loss expects log probabilities (just an implementation detail)
-            predicted_log_distributions = baseline_transformer(src_token_ids_batch, trg_token_ids_batch_input, src_mask, trg_mask)
-            smooth_target_distributions = label_smoothing(trg_token_ids_batch_gt)  # these are regular probabilities
-
+        for step_idx, (token_ids_batches, num_step_trg_tokens) in enumerate(steps):
             if is_train:
                 custom_lr_optimizer.zero_grad()  # clean the trainable weights gradients in the computational graph
 
-            loss = kl_div_loss(predicted_log_distributions, smooth_target_distributions)
+            step_loss = 0.
+            for batch_idx, token_ids_batch in enumerate(token_ids_batches):
+                # DDP all-reduces the gradients during backward - we only need that once, for the last batch of the step
+                is_last_batch = batch_idx == len(token_ids_batches) - 1
+                sync_context = baseline_transformer.no_sync() if is_train and world_size > 1 and not is_last_batch else contextlib.nullcontext()
+
+                with sync_context:
+                    src_token_ids_batch, trg_token_ids_batch_input, trg_token_ids_batch_gt = get_src_and_trg_batches(token_ids_batch)
+                    src_mask, trg_mask, num_src_tokens, num_trg_tokens = get_masks_and_count_tokens(src_token_ids_batch, trg_token_ids_batch_input, pad_token_id, device)
+
+                    # Pad target tokens have all-zero target distributions and thus don't contribute to the loss, so we
+                    # don't even run the (expensive) decoder generator for them
+                    non_pad_positions = trg_token_ids_batch_gt.view(-1) != pad_token_id
+
+                    transformer = baseline_transformer if is_train else model
+                    if training_config['loss_chunk_size'] is None:
+                        # log because the KL loss expects log probabilities (just an implementation detail)
+                        predicted_log_distributions = transformer(src_token_ids_batch, trg_token_ids_batch_input, src_mask, trg_mask, non_pad_positions)
+                        loss = label_smoothing_loss(predicted_log_distributions, trg_token_ids_batch_gt[non_pad_positions])
+                    else:
+                        # Same loss but the (N, V) log probabilities are never materialized at once (lower peak memory)
+                        trg_representations_batch = transformer(src_token_ids_batch, trg_token_ids_batch_input, src_mask, trg_mask, non_pad_positions, apply_generator=False)
+                        loss = chunked_generator_label_smoothing_loss(model.decoder_generator, trg_representations_batch, trg_token_ids_batch_gt[non_pad_positions], label_smoothing_loss, training_config['loss_chunk_size'])
+
+                    if is_train and normalize_by_step_tokens:
+                        # Normalized by the actual number of (non-pad) target tokens of the whole step (all processes),
+                        # times world_size as DDP averages the gradients over the processes (instead of summing them)
+                        loss = loss * world_size / num_step_trg_tokens
+                    else:
+                        # Equivalent to the "batchmean" reduction over all of the (B*T) target tokens, pad tokens included
+                        loss = loss / trg_token_ids_batch_gt.shape[0]
+
+                    if is_train:
+                        loss.backward()  # compute the gradients for every trainable weight in the computational graph
+
+                step_loss += loss.item()
 
             if is_train:
-                loss.backward()  # compute the gradients for every trainable weight in the computational graph
                 custom_lr_optimizer.step()  # apply the gradients to weights
 
             # End of CORE PART
@@ -71,33 +126,47 @@ def get_train_val_loop(baseline_transformer, custom_lr_optimizer, kl_div_loss, l
 
             if is_train:
                 global_train_step += 1
-                num_of_trg_tokens_processed += num_trg_tokens
+                num_of_trg_tokens_processed += num_step_trg_tokens  # tokens of the whole step i.e. of all processes
+                num_of_train_steps_processed += 1
 
-                if training_config['enable_tensorboard']:
-                    writer.add_scalar('training_loss', loss.item(), global_train_step)
+                if world_size > 1:  # every process only has its own share of the step's loss
+                    step_loss_tensor = torch.tensor(step_loss)
+                    dist.all_reduce(step_loss_tensor)
+                    step_loss = step_loss_tensor.item() / world_size
 
-                if training_config['console_log_freq'] is not None and batch_idx % training_config['console_log_freq'] == 0:
+                if is_main_process and training_config['enable_tensorboard']:
+                    get_writer().add_scalar('training_loss', step_loss, global_train_step)
+
+                if is_main_process and training_config['console_log_freq'] is not None and step_idx % training_config['console_log_freq'] == 0:
                     print(f'Transformer training: time elapsed= {(time.time() - time_start):.2f} [s] '
-                          f'| epoch={epoch + 1} | batch= {batch_idx + 1} '
-                          f'| target tokens/batch= {num_of_trg_tokens_processed / training_config["console_log_freq"]}')
+                          f'| epoch={epoch + 1} | step= {step_idx + 1} | optimizer step= {global_train_step} '
+                          f'| target tokens/step (all processes, avg)= {num_of_trg_tokens_processed / num_of_train_steps_processed:.1f}')
 
-                    num_of_trg_tokens_processed = 0
+                    num_of_trg_tokens_processed, num_of_train_steps_processed = [0, 0]
 
                 # Save model checkpoint
-                if training_config['checkpoint_freq'] is not None and (epoch + 1) % training_config['checkpoint_freq'] == 0 and batch_idx == 0:
+                if is_main_process and training_config['checkpoint_freq'] is not None and (epoch + 1) % training_config['checkpoint_freq'] == 0 and step_idx == 0:
                     ckpt_model_name = f"transformer_ckpt_epoch_{epoch + 1}.pth"
-                    torch.save(utils.get_training_state(training_config, baseline_transformer), os.path.join(CHECKPOINTS_PATH, ckpt_model_name))
+                    torch.save(utils.get_training_state(training_config, model, src_field_processor, trg_field_processor), os.path.join(CHECKPOINTS_PATH, ckpt_model_name))
             else:
                 global_val_step += 1
 
-                if training_config['enable_tensorboard']:
-                    writer.add_scalar('val_loss', loss.item(), global_val_step)
+                if is_main_process and training_config['enable_tensorboard']:
+                    get_writer().add_scalar('val_loss', step_loss, global_val_step)
 
     return train_val_loop
 
 
-def train_transformer(training_config):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU, I hope so!
+def train_transformer(training_config, rank=0, world_size=1):
+    # Multiple processes - CPU only (gloo backend), see distributed_utils.py
+    is_main_process = rank == 0
+    if world_size > 1:
+        init_distributed_training(rank, world_size)
+        # Every process has to see the same batches in the same order (torchtext shuffles using Python's random module)
+        random.seed(0)
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU, I hope so!
 
     # Step 1: Prepare data loaders
     train_token_ids_loader, val_token_ids_loader, src_field_processor, trg_field_processor = get_data_loaders(
@@ -112,47 +181,68 @@ def train_transformer(training_config):
     trg_vocab_size = len(trg_field_processor.vocab)
 
     # Step 2: Prepare the model (original transformer) and push to GPU
+    # Hyperparameters are saved together with the model so that the translation script can rebuild it on its own
+    training_config['model_hyperparameters'] = {
+        "model_dimension": BASELINE_MODEL_DIMENSION,
+        "src_vocab_size": src_vocab_size,
+        "trg_vocab_size": trg_vocab_size,
+        "number_of_heads": BASELINE_MODEL_NUMBER_OF_HEADS,
+        "number_of_layers": BASELINE_MODEL_NUMBER_OF_LAYERS,
+        "dropout_probability": BASELINE_MODEL_DROPOUT_PROB
+    }
     baseline_transformer = Transformer(
-        model_dimension=BASELINE_MODEL_DIMENSION,
-        src_vocab_size=src_vocab_size,
-        trg_vocab_size=trg_vocab_size,
-        number_of_heads=BASELINE_MODEL_NUMBER_OF_HEADS,
-        number_of_layers=BASELINE_MODEL_NUMBER_OF_LAYERS,
-        dropout_probability=BASELINE_MODEL_DROPOUT_PROB
+        **training_config['model_hyperparameters'],
+        attention_backend=training_config['attention_backend'],
+        activation_checkpointing=training_config['activation_checkpointing']
     ).to(device)
 
     # Step 3: Prepare other training related utilities
-    kl_div_loss = nn.KLDivLoss(reduction='batchmean')  # gives better BLEU score than "mean"
-
-    # Makes smooth target distributions as opposed to conventional one-hot distributions
-    # My feeling is that this is a really dummy and arbitrary heuristic but time will tell.
-    label_smoothing = LabelSmoothingDistribution(BASELINE_MODEL_LABEL_SMOOTHING_VALUE, pad_token_id, trg_vocab_size, device)
+    # KL divergence against smooth target distributions as opposed to conventional one-hot distributions, computed
+    # without materializing the (B*T, V) target distributions. Summed and then divided by the number of target tokens,
+    # gives better BLEU than "mean". My feeling is that this is a really dummy and arbitrary heuristic but time will tell.
+    label_smoothing_loss = LabelSmoothingKLDivLoss(BASELINE_MODEL_LABEL_SMOOTHING_VALUE, pad_token_id, trg_vocab_size)
 
     # Check out playground.py for an intuitive visualization of how the LR changes with time/training steps, easy stuff.
+    # Every process makes the same number of optimizer steps so the LR schedule stays in sync across the processes.
     custom_lr_optimizer = CustomLRAdamOptimizer(
                 Adam(baseline_transformer.parameters(), betas=(0.9, 0.98), eps=1e-9),
                 BASELINE_MODEL_DIMENSION,
                 training_config['num_warmup_steps']
             )
 
+    # DDP broadcasts the main process' (initial) weights to the other processes so that all of the replicas start equal
+    model = baseline_transformer
+    if world_size > 1:
+        baseline_transformer = DistributedDataParallel(baseline_transformer)
+
     # The decorator function makes things cleaner since there is a lot of redundancy between the train and val loops
-    train_val_loop = get_train_val_loop(baseline_transformer, custom_lr_optimizer, kl_div_loss, label_smoothing, pad_token_id, time.time())
+    train_val_loop = get_train_val_loop(training_config, baseline_transformer, custom_lr_optimizer, label_smoothing_loss, pad_token_id, src_field_processor, trg_field_processor, time.time(), rank, world_size)
 
     # Step 4: Start the training
     for epoch in range(training_config['num_of_epochs']):
         # Training loop
         train_val_loop(is_train=True, token_ids_loader=train_token_ids_loader, epoch=epoch)
 
-        # Validation loop
-        with torch.no_grad():
-            train_val_loop(is_train=False, token_ids_loader=val_token_ids_loader, epoch=epoch)
+        # Validation loop - the replicas are identical so only the main process does it (the others wait for it)
+        if is_main_process:
+            with torch.no_grad():
+                train_val_loop(is_train=False, token_ids_loader=val_token_ids_loader, epoch=epoch)
 
-            bleu_score = utils.calculate_bleu_score(baseline_transformer, val_token_ids_loader, trg_field_processor)
-            if training_config['enable_tensorboard']:
-                writer.add_scalar('bleu_score', bleu_score, epoch)
+                bleu_score = utils.calculate_bleu_score(model, val_token_ids_loader, trg_field_processor)
+                if training_config['enable_tensorboard']:
+                    get_writer().add_scalar('bleu_score', bleu_score, epoch)
 
     # Save the latest transformer in the binaries directory
-    torch.save(utils.get_training_state(training_config, baseline_transformer), os.path.join(BINARIES_PATH, utils.get_available_binary_name()))
+    if is_main_process:
+        torch.save(utils.get_training_state(training_config, model, src_field_processor, trg_field_processor), os.path.join(BINARIES_PATH, utils.get_available_binary_name()))
+
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+def train_transformer_process(rank, training_config):
+    # Entry point of the processes started by torch.multiprocessing.spawn (it passes in the rank as the 1st argument)
+    train_transformer(training_config, rank, training_config['num_processes'])
 
 
 if __name__ == "__main__":
@@ -170,6 +260,17 @@ if __name__ == "__main__":
     parser.add_argument("--num_of_epochs", type=int, help="number of training epochs", default=20)
     # You should adjust this for your particular machine (I have RTX 2080 with 8 GBs of VRAM so 1500 fits nicely!)
     parser.add_argument("--batch_size", type=int, help="target number of tokens in a src/trg batch", default=1500)
+    parser.add_argument("--attention_backend", choices=[el.name for el in AttentionBackend], help="attention implementation", default=AttentionBackend.SDPA.name)
+    # E.g. 1024 - bounds the decoder generator + loss memory so that you can bump up the batch size (slightly slower)
+    parser.add_argument("--loss_chunk_size", type=int, help="compute the generator + loss this many target tokens at a time", default=None)
+    # The paper used ~25000 target tokens per step (the LR schedule was tuned for that), e.g. --batch_size 1500 with
+    # --tokens_per_step 25000 accumulates the gradients of ~17 batches before making a single optimizer step
+    parser.add_argument("--tokens_per_step", type=int, help="accumulate gradients until this many target tokens per optimizer step", default=None)
+    # Recompute (instead of keep) the activations during backward - less memory i.e. bigger batches but slower steps
+    parser.add_argument("--activation_checkpointing", choices=[el.name for el in ActivationCheckpointing], help="activation checkpointing granularity", default=ActivationCheckpointing.NONE.name)
+
+    # Data parallel training (CPU, gloo) - use torchrun instead for multiple nodes, e.g. torchrun --nnodes 2 ...
+    parser.add_argument("--num_processes", type=int, help="number of data parallel training processes", default=1)
 
     # Data related args
     parser.add_argument("--dataset_name", choices=[el.name for el in DatasetType], help='which dataset to use for training', default=DatasetType.IWSLT.name)
@@ -189,4 +290,11 @@ if __name__ == "__main__":
     training_config['num_warmup_steps'] = num_warmup_steps
 
     # Train the original transformer model
-    train_transformer(training_config)
+    if 'WORLD_SIZE' in os.environ:  # launched by torchrun (e.g. multiple nodes), it also sets MASTER_ADDR/MASTER_PORT
+        train_transformer(training_config, int(os.environ['RANK']), int(os.environ['WORLD_SIZE']))
+    elif training_config['num_processes'] > 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', str(get_free_port()))
+        mp.spawn(train_transformer_process, args=(training_config,), nprocs=training_config['num_processes'])
+    else:
+        train_transformer(training_config)
@@ -0,0 +1,154 @@
+"""
+    Small client for the local translation server (see translation_server.py), it doubles as the server's smoke test.
+
+    Translate using an already running server:
+        python translation_client.py --url http://127.0.0.1:8000 --source_sentences "How are you doing today?" "I am fine."
+
+    Smoke test - starts the server on a free port (all of the unknown args get passed to it, e.g. --model_name), checks
+    /translate, /translate_batch (incl. a request which doesn't fit into a single micro-batch) and /stats, stops it:
+        python translation_client.py --smoke_test --model_name iwslt_e2g.pth
+
+    Note: only the standard library is used.
+
+"""
+
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def request(url, path, payload=None):
+    # POST if there is a payload, GET otherwise. Returns (HTTP status code, parsed JSON response)
+    data = None if payload is None else json.dumps(payload).encode('utf-8')
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url + path, data=data, method='GET' if payload is None else 'POST')) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def translate(url, source_sentence):
+    status, response = request(url, '/translate', {"source_sentence": source_sentence})
+    assert status == 200, f'/translate failed ({status}): {response}'
+    return response['translation']
+
+
+def translate_batch(url, source_sentences):
+    status, response = request(url, '/translate_batch', {"source_sentences": source_sentences})
+    assert status == 200, f'/translate_batch failed ({status}): {response}'
+    return response['translations']
+
+
+def get_stats(url):
+    status, response = request(url, '/stats')
+    assert status == 200, f'/stats failed ({status}): {response}'
+    return response
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(url, server_process, timeout):
+    # The server first has to load the model (and maybe download it) so give it some time
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server_process.poll() is not None:
+            raise Exception(f'Translation server exited with code {server_process.returncode} before it started listening.')
+        try:
+            return get_stats(url)
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.5)
+    raise Exception(f'Translation server did not start listening within {timeout} seconds.')
+
+
+def run_smoke_test(client_config, server_args):
+    port = get_free_port()
+    url = f'http://127.0.0.1:{port}'
+    max_batch_tokens = client_config['smoke_test_max_batch_tokens']
+    server_process = subprocess.Popen(
+        [sys.executable, 'translation_server.py', '--port', str(port), '--max_batch_tokens', str(max_batch_tokens)] + server_args,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+
+    try:
+        stats = wait_for_server(url, server_process, client_config['server_startup_timeout'])
+
+        source_sentences = [
+            'How are you doing today?',
+            'I am fine, thank you.',
+            'The weather is nice.',
+            'This is a much longer sentence which on its own has more tokens than fit into a single micro batch of the server.',
+            'Good night!'
+        ]
+
+        # Concurrent single sentence requests get coalesced into micro-batches
+        with ThreadPoolExecutor(len(source_sentences)) as executor:
+            translations = list(executor.map(lambda source_sentence: translate(url, source_sentence), source_sentences))
+        assert all(isinstance(translation, str) for translation in translations), f'Unexpected translations: {translations}'
+        print(f'/translate OK ({len(translations)} concurrent requests)')
+
+        # The whole request has more source tokens than max_batch_tokens so it gets split into multiple micro-batches
+        # (with --continuous_batching there are no micro-batches, the sentences join the pool of in-flight sentences)
+        previous_stats = get_stats(url)
+        batch_translations = translate_batch(url, source_sentences)
+        stats = get_stats(url)
+        assert batch_translations == translations, f'/translate_batch and /translate disagree:\n{batch_translations}\n{translations}'
+        if 'num_translated_batches' in stats:
+            num_batches = stats['num_translated_batches'] - previous_stats['num_translated_batches']
+            assert num_batches > 1, f'Expected the request to be split into multiple micro-batches, got {num_batches}.'
+            print(f'/translate_batch OK (same translations, {num_batches} micro-batches with max {max_batch_tokens} tokens each)')
+        else:
+            print(f'/translate_batch OK (same translations, {stats["num_decoding_steps"] - previous_stats["num_decoding_steps"]} continuous batching decoding steps)')
+
+        assert stats['num_translated_sentences'] == 2 * len(source_sentences), f'Unexpected stats: {stats}'
+        print(f'/stats OK {stats}')
+
+        # Malformed requests and unknown endpoints
+        assert request(url, '/translate', {"wrong_key": "Hello"})[0] == 400
+        assert request(url, '/translate_batch', {"source_sentences": [1, 2]})[0] == 400
+        assert request(url, '/unknown_endpoint')[0] == 404
+        print('Error handling OK')
+    finally:
+        server_process.terminate()
+        server_process.wait()
+
+    print('Translation server smoke test passed.')
+
+
+if __name__ == "__main__":
+    #
+    # modifiable args - feel free to play with these (only small subset is exposed by design to avoid cluttering)
+    #
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source_sentences", type=str, nargs='+', help="sentences to translate (using an already running server)", default=["How are you doing today?"])
+    parser.add_argument("--url", type=str, help="address of an already running translation server", default='http://127.0.0.1:8000')
+
+    # Smoke test related args, all of the unknown args get passed to the server
+    parser.add_argument("--smoke_test", action='store_true', help="start the server on a free port and check all of the endpoints")
+    parser.add_argument("--smoke_test_max_batch_tokens", type=int, help="small token budget so that requests span multiple micro-batches", default=16)
+    parser.add_argument("--server_startup_timeout", type=float, help="max time (seconds) to wait for the server to load the model", default=300)
+    args, server_args = parser.parse_known_args()
+
+    # Wrapping client configuration into a dictionary
+    client_config = dict()
+    for arg in vars(args):
+        client_config[arg] = getattr(args, arg)
+
+    if client_config['smoke_test']:
+        run_smoke_test(client_config, server_args)
+    elif len(server_args) > 0:
+        parser.error(f'unrecognized arguments: {" ".join(server_args)}')
+    else:
+        for source_sentence, translation in zip(client_config['source_sentences'], translate_batch(client_config['url'], client_config['source_sentences'])):
+            print(f'{source_sentence} -> {translation}')
@@ -1,60 +1,209 @@
 import argparse
+import sys
+import time
+import itertools
+import contextlib
+import functools
 
 
 import torch
 from torchtext.data import Example
 
 
-from models.definitions.transformer_model import Transformer
-from utils.data_utils import get_datasets_and_vocabs, get_masks_and_count_tokens_src, DatasetType, LanguageDirection
+from models.definitions.transformer_model import AttentionBackend, build_transformer_skeleton, materialize_transformer, allocate_transformer_skeleton
+from utils.data_utils import get_datasets_and_vocabs, get_field_processors_from_training_state, get_vocab_state, get_masks_and_count_tokens_src, get_masks_and_count_tokens_trg, DatasetType, LanguageDirection
 from utils.constants import *
-from utils.visualization_utils import visualize_attention
 from utils.decoding_utils import greedy_decoding, get_beam_decoder, DecodingMethod
 from utils.utils import print_model_metadata
 from utils.resource_downloader import download_models
+from utils.shortlist_utils import get_lexical_shortlist
+from utils.quantization_utils import get_quantized_model_path, quantize_transformer, save_quantized_transformer, load_quantized_transformer
+from utils.translation_cache_utils import get_checkpoint_hash, TranslationCache
+from utils.worker_pool_utils import InferenceWorkerPool
+from utils.mmap_weights_utils import get_mmap_weights_path, save_mmap_weights, load_mmap_weights, assign_mmap_weights, StorageDtype
 
 
-# Super easy to add translation for a batch of sentences passed as a .txt file for example
-def translate_a_single_sentence(translation_config):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")  # checking whether you have a GPU
+def get_model_path(translation_config):
+    # Optimization - int8 quantized model (CPU only), the quantized artifact is created from the fp32 model only once
+    quantized_model_path = get_quantized_model_path(translation_config['model_name'])
+    if translation_config['quantize'] and os.path.exists(quantized_model_path):
+        return quantized_model_path
 
-    # Step 1: Prepare the field processor (tokenizer, numericalizer)
+    model_path = os.path.join(BINARIES_PATH, translation_config['model_name'])
+    if not os.path.exists(model_path):
+        print(f'Model {model_path} does not exist, attempting to download.')
+        model_path = download_models(translation_config)
+
+    return model_path
+
+
+def get_mmap_weights_path_if_used(translation_config):
+    # Memory mapped weights are only used for the fp32 (i.e. not quantized) model
+    if translation_config['mmap_weights_dtype'] is None or translation_config['quantize']:
+        return None
+    return get_mmap_weights_path(translation_config['model_name'], translation_config['mmap_weights_dtype'])
+
+
+def load_training_state(translation_config, device):
+    # Optimization - memory mapped weights (see mmap_weights_utils.py), the artifact is created from the .pth only once
+    mmap_weights_path = get_mmap_weights_path_if_used(translation_config)
+    if mmap_weights_path is not None and os.path.exists(mmap_weights_path):
+        return load_mmap_weights(mmap_weights_path)
+
+    return torch.load(get_model_path(translation_config), map_location=device)
+
+
+def get_translation_cache(translation_config):
+    # Has to be called after the model got loaded (the binary could've been downloaded/quantized during loading)
+    if not translation_config['use_translation_cache']:
+        return None
+
+    checkpoint_hash = get_checkpoint_hash(get_model_path(translation_config))
+    return TranslationCache(checkpoint_hash, translation_config, translation_config['translation_cache_size'], translation_config['translation_cache_path'])
+
+
+def get_vocabs_path(model_name):
+    # Vocabs rebuilt for older models are stored alongside the model binary, e.g. iwslt_e2g.pth -> iwslt_e2g_vocabs.pth
+    return os.path.join(BINARIES_PATH, f'{os.path.splitext(model_name)[0]}_vocabs.pth')
+
+
+def load_field_processors(translation_config, training_state):
+    # Optimization - the vocabs are bundled with the model, no need to read the whole training dataset
+    if 'src_vocab' in training_state:
+        return get_field_processors_from_training_state(training_state)
+
+    # Older models don't bundle them, we rebuild them only once and store them in a separate file (the model binary
+    # itself is never modified). Note: the vocab state is plain Python (lists/strings) so it doesn't depend on the device
+    vocabs_path = get_vocabs_path(translation_config['model_name'])
+    if os.path.exists(vocabs_path):
+        return get_field_processors_from_training_state(torch.load(vocabs_path))
+
+    print(f'Model {translation_config["model_name"]} does not contain the vocabs, building them from the datasets.')
     _, _, src_field_processor, trg_field_processor = get_datasets_and_vocabs(
         translation_config['dataset_path'],
         translation_config['language_direction'],
         translation_config['dataset_name'] == DatasetType.IWSLT.name
     )
-    assert src_field_processor.vocab.stoi[PAD_TOKEN] == trg_field_processor.vocab.stoi[PAD_TOKEN]
-    pad_token_id = src_field_processor.vocab.stoi[PAD_TOKEN]  # needed for constructing masks
+    vocabs_state = {
+        "language_direction": translation_config['language_direction'],
+        "src_vocab": get_vocab_state(src_field_processor),
+        "trg_vocab": get_vocab_state(trg_field_processor)
+    }
+    torch.save(vocabs_state, vocabs_path)
+    print(f'Saved the vocabs to {vocabs_path}, they will be used from the next run on.')
 
-    # Step 2: Prepare the model
-    baseline_transformer = Transformer(
-        model_dimension=BASELINE_MODEL_DIMENSION,
-        src_vocab_size=len(src_field_processor.vocab),
-        trg_vocab_size=len(trg_field_processor.vocab),
-        number_of_heads=BASELINE_MODEL_NUMBER_OF_HEADS,
-        number_of_layers=BASELINE_MODEL_NUMBER_OF_LAYERS,
-        dropout_probability=BASELINE_MODEL_DROPOUT_PROB,
-        log_attention_weights=True
-    ).to(device)
+    return src_field_processor, trg_field_processor
 
-    model_path = os.path.join(BINARIES_PATH, translation_config['model_name'])
-    if not os.path.exists(model_path):
-        print(f'Model {model_path} does not exist, attempting to download.')
-        model_path = download_models(translation_config)
 
-    model_state = torch.load(model_path)
-    print_model_metadata(model_state)
-    baseline_transformer.load_state_dict(model_state["state_dict"], strict=True)
+def load_baseline_transformer(translation_config, training_state, src_field_processor, trg_field_processor, device, keep_upcast_weights=True):
+    # Older models don't contain the hyperparameters, they were all trained using the baseline ones
+    model_hyperparameters = training_state.get('model_hyperparameters')
+    if model_hyperparameters is None:
+        model_hyperparameters = {
+            "model_dimension": BASELINE_MODEL_DIMENSION,
+            "src_vocab_size": len(src_field_processor.vocab),
+            "trg_vocab_size": len(trg_field_processor.vocab),
+            "number_of_heads": BASELINE_MODEL_NUMBER_OF_HEADS,
+            "number_of_layers": BASELINE_MODEL_NUMBER_OF_LAYERS,
+            "dropout_probability": BASELINE_MODEL_DROPOUT_PROB
+        }
+    # Nothing gets allocated/initialized here, the weights come straight from the checkpoint (see materialize_transformer)
+    baseline_transformer = build_transformer_skeleton(
+        **model_hyperparameters,
+        log_attention_weights=translation_config['visualize_attention'],  # only log them if we need them (slower)
+        attention_backend=translation_config['attention_backend']
+    )
+
+    print_model_metadata(training_state)
+    if training_state.get('quantized', False):
+        return load_quantized_transformer(allocate_transformer_skeleton(baseline_transformer, device), training_state)
+
+    if training_state.get('mmap_weights', False) and device.type == 'cpu':
+        assign_mmap_weights(baseline_transformer, training_state["state_dict"], keep_upcast_weights)  # zero copy
+    elif training_state.get('mmap_weights', False):
+        # The reduced precision weights would get assigned as they are, the model expects fp32 ones
+        state_dict = {name: tensor.float() for name, tensor in training_state["state_dict"].items()}
+        baseline_transformer = materialize_transformer(baseline_transformer, state_dict, device)
+    else:
+        baseline_transformer = materialize_transformer(baseline_transformer, training_state["state_dict"], device)
     baseline_transformer.eval()
 
+    mmap_weights_path = get_mmap_weights_path_if_used(translation_config)
+    if mmap_weights_path is not None and not training_state.get('mmap_weights', False):
+        # Store the hyperparameters as well (older models don't contain them) so that the artifact is self-contained
+        metadata = {key: value for key, value in training_state.items() if key != 'state_dict'}
+        metadata['model_hyperparameters'] = model_hyperparameters
+        save_mmap_weights(metadata, baseline_transformer.state_dict(), mmap_weights_path, translation_config['mmap_weights_dtype'])
+        print(f'Saved the memory mapped weights to {mmap_weights_path}, they will be used from the next run on.')
+
+    if translation_config['quantize']:
+        quantized_transformer = quantize_transformer(baseline_transformer)
+        quantized_model_path = get_quantized_model_path(translation_config['model_name'])
+        save_quantized_transformer(training_state, quantized_transformer, quantized_model_path)
+        print(f'Saved the quantized model to {quantized_model_path}.')
+        return quantized_transformer
+
+    return baseline_transformer
+
+
+def get_translation_device(translation_config):
+    # Quantized kernels and the worker processes only run on the CPU, otherwise check whether you have a GPU
+    if translation_config['quantize'] or translation_config.get('num_workers', 0) > 0:
+        return torch.device("cpu")
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def load_translation_resources(translation_config, device):
+    # Step 1: Prepare the field processor (tokenizer, numericalizer)
+    training_state = load_training_state(translation_config, device)
+    src_field_processor, trg_field_processor = load_field_processors(translation_config, training_state)
+    assert src_field_processor.vocab.stoi[PAD_TOKEN] == trg_field_processor.vocab.stoi[PAD_TOKEN]
+
+    # Step 2: Prepare the model (and optionally the lexical shortlist - only score plausible target tokens)
+    baseline_transformer = load_baseline_transformer(translation_config, training_state, src_field_processor, trg_field_processor, device)
+    lexical_shortlist = None
+    if translation_config['use_lexical_shortlist']:
+        lexical_shortlist = get_lexical_shortlist(translation_config, src_field_processor, trg_field_processor, device)
+
+    return baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist
+
+
+def decode_batch(translation_config, baseline_transformer, trg_field_processor, src_representations_batch, src_mask, vocab_shortlist=None):
+    if DecodingMethod[translation_config['decoding_method']] == DecodingMethod.GREEDY:
+        # Source-length-aware stopping, max target length = a * S + b, where S is the number of source tokens
+        max_length_coefficients = None
+        if translation_config['max_length_a'] is not None:
+            max_length_coefficients = (translation_config['max_length_a'], translation_config['max_length_b'])
+        return greedy_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor, vocab_shortlist=vocab_shortlist, max_length_coefficients=max_length_coefficients)
+    else:
+        beam_decoding = get_beam_decoder(translation_config)
+        return beam_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor, vocab_shortlist=vocab_shortlist)
+
+
+def translate_a_single_sentence(translation_config):
+    device = get_translation_device(translation_config)
+
+    baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist = load_translation_resources(translation_config, device)
+    pad_token_id = src_field_processor.vocab.stoi[PAD_TOKEN]  # needed for constructing masks
+    translation_cache = get_translation_cache(translation_config)
+
     # Step 3: Prepare the input sentence
     source_sentence = translation_config['source_sentence']
-    ex = Example.fromlist([source_sentence], fields=[('src', src_field_processor)])  # tokenize the sentence
-
-    source_sentence_tokens = ex.src
+    if translation_config['pretokenized']:
+        source_sentence_tokens = source_sentence.split()  # no need to load the spaCy model
+    else:
+        ex = Example.fromlist([source_sentence], fields=[('src', src_field_processor)])  # tokenize the sentence
+        source_sentence_tokens = ex.src
     print(f'Source sentence tokens = {source_sentence_tokens}')
 
+    # Optimization - we may have translated this sentence already (attention visualization needs the forward pass)
+    if translation_cache is not None and not translation_config['visualize_attention']:
+        cached_target_sentence_tokens = translation_cache.get(source_sentence_tokens)
+        if cached_target_sentence_tokens is not None:
+            print(f'Translation (cached) | Target sentence tokens = {[cached_target_sentence_tokens]}')
+            translation_cache.close()
+            return
+
     # Numericalize and convert to cuda tensor
     src_token_ids_batch = src_field_processor.process([source_sentence_tokens], device)
 
@@ -64,18 +213,180 @@ def translate_a_single_sentence(translation_config):
         src_representations_batch = baseline_transformer.encode(src_token_ids_batch, src_mask)
 
         # Step 5: Decoding process
-        if translation_config['decoding_method'] == DecodingMethod.GREEDY:
-            target_sentence_tokens = greedy_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor)
-        else:
-            beam_decoding = get_beam_decoder(translation_config)
-            target_sentence_tokens = beam_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor)
+        vocab_shortlist = None if lexical_shortlist is None else lexical_shortlist.get_vocab_shortlist(src_token_ids_batch)
+        target_sentence_tokens = decode_batch(translation_config, baseline_transformer, trg_field_processor, src_representations_batch, src_mask, vocab_shortlist)
         print(f'Translation | Target sentence tokens = {target_sentence_tokens}')
+        if translation_cache is not None:
+            translation_cache.put([source_sentence_tokens], target_sentence_tokens)
+            translation_cache.close()
 
         # Step 6: Potentially visualize the encoder/decoder attention weights
         if translation_config['visualize_attention']:
+            from utils.visualization_utils import visualize_attention  # imported lazily, matplotlib/seaborn are slow to import
+
+            # Cached decoding only passes the latest token through the decoder so the logged decoder attention weights
+            # belong to that last token, do one more (uncached) pass over the whole translation to log all of them
+            trg_token_ids_batch = torch.tensor([[trg_field_processor.vocab.stoi[token] for token in target_sentence_tokens[0][:-1]]], device=device)
+            trg_mask, _ = get_masks_and_count_tokens_trg(trg_token_ids_batch, pad_token_id)
+            baseline_transformer.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask, generator_positions='last')
+
             visualize_attention(baseline_transformer, source_sentence_tokens, target_sentence_tokens)
 
 
+def get_token_budgeted_batches(source_sentences_tokens, batch_size):
+    """
+        Groups the sentences into batches of similar length sentences - that way we don't waste compute on padding.
+
+        batch_size is the max number of (padded) source tokens in a batch, the same semantics as in the training script.
+        Yields lists of indices (into source_sentences_tokens), a batch has at least 1 sentence no matter how long it is.
+
+    """
+    sorted_indices = sorted(range(len(source_sentences_tokens)), key=lambda index: len(source_sentences_tokens[index]))
+
+    batch_indices = []
+    for index in sorted_indices:
+        # Sentences are sorted by length so the current sentence is the longest one in the batch
+        if len(batch_indices) > 0 and (len(batch_indices) + 1) * len(source_sentences_tokens[index]) > batch_size:
+            yield batch_indices
+            batch_indices = []
+        batch_indices.append(index)
+
+    if len(batch_indices) > 0:
+        yield batch_indices
+
+
+def translate_a_batch(translation_config, baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist, batch_source_sentences_tokens):
+    # Returns the raw decoder outputs (they start with BOS and usually end with EOS)
+    device = next(baseline_transformer.parameters()).device
+    pad_token_id = src_field_processor.vocab.stoi[PAD_TOKEN]
+
+    with torch.no_grad():
+        # Numericalize (and pad) the whole batch at once
+        src_token_ids_batch = src_field_processor.process(batch_source_sentences_tokens, device)
+        src_mask, _ = get_masks_and_count_tokens_src(src_token_ids_batch, pad_token_id)
+        src_representations_batch = baseline_transformer.encode(src_token_ids_batch, src_mask)
+
+        vocab_shortlist = None if lexical_shortlist is None else lexical_shortlist.get_vocab_shortlist(src_token_ids_batch)
+        return decode_batch(translation_config, baseline_transformer, trg_field_processor, src_representations_batch, src_mask, vocab_shortlist)
+
+
+def translate_source_sentences_tokens(translation_config, baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist, source_sentences_tokens, translation_cache=None, worker_pool=None):
+    # Optimization - every distinct sentence gets translated only once (and only if we don't have it in the cache)
+    occurrences = dict()  # source sentence tokens -> indices of all of its occurrences
+    for index, source_sentence_tokens in enumerate(source_sentences_tokens):
+        if len(source_sentence_tokens) > 0:  # empty lines stay empty
+            occurrences.setdefault(tuple(source_sentence_tokens), []).append(index)
+
+    # Raw decoder outputs (they start with BOS and usually end with EOS) of every distinct sentence
+    raw_target_sentences_tokens = dict()
+    if translation_cache is not None:
+        for source_sentence_tokens in occurrences:
+            cached_target_sentence_tokens = translation_cache.get(list(source_sentence_tokens))
+            if cached_target_sentence_tokens is not None:
+                raw_target_sentences_tokens[source_sentence_tokens] = cached_target_sentence_tokens
+    sentences_to_translate = [list(tokens) for tokens in occurrences if tokens not in raw_target_sentences_tokens]
+
+    # Optimization - batches can be translated in parallel by the worker processes (see worker_pool_utils.py)
+    batches = [[sentences_to_translate[index] for index in batch_indices] for batch_indices in get_token_budgeted_batches(sentences_to_translate, translation_config['batch_size'])]
+    if worker_pool is not None:
+        batches_target_sentences_tokens = worker_pool.translate_batches(batches)
+    else:
+        batches_target_sentences_tokens = [translate_a_batch(translation_config, baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist, batch) for batch in batches]
+
+    for batch_source_sentences_tokens, batch_target_sentences_tokens in zip(batches, batches_target_sentences_tokens):
+        for source_sentence_tokens, target_sentence_tokens in zip(batch_source_sentences_tokens, batch_target_sentences_tokens):
+            raw_target_sentences_tokens[tuple(source_sentence_tokens)] = target_sentence_tokens
+        if translation_cache is not None:
+            translation_cache.put(batch_source_sentences_tokens, batch_target_sentences_tokens)
+
+    # Restore the original order (and duplicates)
+    target_sentences_tokens = [[] for _ in range(len(source_sentences_tokens))]
+    for source_sentence_tokens, indices in occurrences.items():
+        target_sentence_tokens = [token for token in raw_target_sentences_tokens[source_sentence_tokens] if token not in [BOS_TOKEN, EOS_TOKEN]]
+        for index in indices:
+            target_sentences_tokens[index] = list(target_sentence_tokens)
+
+    return target_sentences_tokens
+
+
+# Inference workers which use the memory mapped weights load the model themselves (see get_worker_pool), only once
+worker_baseline_transformer = None
+
+
+def translate_a_batch_with_mmap_weights(translation_config, src_field_processor, trg_field_processor, lexical_shortlist, batch_source_sentences_tokens):
+    global worker_baseline_transformer
+    if worker_baseline_transformer is None:
+        with contextlib.redirect_stdout(sys.stderr):  # translations may be going to stdout, keep it clean of metadata
+            training_state = load_mmap_weights(get_mmap_weights_path_if_used(translation_config))
+            # Reduced precision weights only get upcast during the forward calls, a private fp32 copy of the weights
+            # in every worker would defeat the purpose of sharing the page cache pages
+            worker_baseline_transformer = load_baseline_transformer(translation_config, training_state, src_field_processor, trg_field_processor, torch.device("cpu"), keep_upcast_weights=False)
+
+    return translate_a_batch(translation_config, worker_baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist, batch_source_sentences_tokens)
+
+
+def get_worker_pool(translation_config, baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist):
+    if translation_config['num_workers'] == 0:
+        return None
+
+    mmap_weights_path = get_mmap_weights_path_if_used(translation_config)
+    if mmap_weights_path is not None and os.path.exists(mmap_weights_path):
+        # Every worker maps the weights file itself so they all share the same page cache pages (moving the memory
+        # mapped weights into shared memory would copy them)
+        translate_fn = functools.partial(translate_a_batch_with_mmap_weights, translation_config, src_field_processor, trg_field_processor, lexical_shortlist)
+    else:
+        # All of the workers read the very same (shared memory) weights instead of having their own copy
+        baseline_transformer.share_memory()
+        translate_fn = functools.partial(translate_a_batch, translation_config, baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist)
+
+    return InferenceWorkerPool(translate_fn, translation_config['num_workers'], translation_config['num_threads_per_worker'], translation_config['pin_workers_to_cores'])
+
+
+def translate_a_file(translation_config):
+    device = get_translation_device(translation_config)
+
+    input_file = sys.stdin if translation_config['input_file'] == '-' else open(translation_config['input_file'], encoding='utf-8')
+    output_file = sys.stdout if translation_config['output_file'] is None else open(translation_config['output_file'], 'w', encoding='utf-8')
+
+    # Translations may be going to stdout so keep it clean of any logging
+    with contextlib.redirect_stdout(sys.stderr):
+        baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist = load_translation_resources(translation_config, device)
+        translation_cache = get_translation_cache(translation_config)
+        worker_pool = get_worker_pool(translation_config, baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist)
+
+    # Stream the input in chunks - we only sort (and batch) within a chunk so that we can write the results incrementally
+    ts = time.time()
+    num_translated_sentences = 0
+    while True:
+        source_sentences = list(itertools.islice(input_file, translation_config['chunk_size']))
+        if len(source_sentences) == 0:
+            break
+
+        if translation_config['pretokenized']:
+            source_sentences_tokens = [source_sentence.split() for source_sentence in source_sentences]
+        else:
+            source_sentences_tokens = [src_field_processor.preprocess(source_sentence.strip()) for source_sentence in source_sentences]
+        target_sentences_tokens = translate_source_sentences_tokens(translation_config, baseline_transformer, src_field_processor, trg_field_processor, lexical_shortlist, source_sentences_tokens, translation_cache, worker_pool)
+
+        for target_sentence_tokens in target_sentences_tokens:
+            output_file.write(' '.join(target_sentence_tokens) + '\n')
+        output_file.flush()
+
+        num_translated_sentences += len(source_sentences)
+        print(f'Translated {num_translated_sentences} sentences, {num_translated_sentences / (time.time() - ts):.1f} sentences/s.', file=sys.stderr)
+
+    if translation_cache is not None:
+        print(f'Translation cache stats: {translation_cache.get_stats()}', file=sys.stderr)
+        translation_cache.close()
+    if worker_pool is not None:
+        worker_pool.close()
+
+    if input_file is not sys.stdin:
+        input_file.close()
+    if output_file is not sys.stdout:
+        output_file.close()
+
+
 if __name__ == "__main__":
     #
     # modifiable args - feel free to play with these (only small subset is exposed by design to avoid cluttering)
@@ -92,11 +403,33 @@ if __name__ == "__main__":
     parser.add_argument("--dataset_path", type=str, help='download dataset to this path', default=DATA_DIR_PATH)
 
     # Decoding related args
-    parser.add_argument("--decoding_method", type=str, help="pick between different decoding methods", default=DecodingMethod.GREEDY)
-    parser.add_argument("--beam_size", type=int, help="used only in case decoding method is chosen", default=4)
-    parser.add_argument("--length_penalty_coefficient", type=int, help="length penalty for the beam search", default=0.6)
+    parser.add_argument("--decoding_method", choices=[el.name for el in DecodingMethod], help="pick between different decoding methods", default=DecodingMethod.GREEDY.name)
+    parser.add_argument("--beam_size", type=int, help="used only in case beam decoding method is chosen", default=4)
+    parser.add_argument("--length_penalty_coefficient", type=float, help="length penalty for the beam search", default=0.6)
+    parser.add_argument("--max_length_a", type=float, help="greedy: max target length = a * source length + b", default=None)
+    parser.add_argument("--max_length_b", type=int, help="greedy: used only if max_length_a is set", default=10)
+    parser.add_argument("--use_lexical_shortlist", action='store_true', help="only score plausible target tokens (faster)")
+    parser.add_argument("--quantize", action='store_true', help="use int8 dynamically quantized model (CPU only, faster)")
+
+    parser.add_argument("--attention_backend", choices=[el.name for el in AttentionBackend], help="attention implementation", default=AttentionBackend.SDPA.name)
+    parser.add_argument("--mmap_weights_dtype", choices=[el.name for el in StorageDtype], help="memory map the weights stored in this dtype (faster startup, less memory)", default=None)
 
     parser.add_argument("--visualize_attention", type=bool, help="should visualize encoder/decoder attention", default=False)
+    parser.add_argument("--pretokenized", action='store_true', help="input is already tokenized (whitespace separated tokens)")
+
+    # Batch (file) translation related args - source_sentence is ignored if input_file is set
+    parser.add_argument("--input_file", type=str, help="file with a source sentence per line ('-' for stdin)", default=None)
+    parser.add_argument("--output_file", type=str, help="translations are written here (stdout if not set)", default=None)
+    parser.add_argument("--batch_size", type=int, help="max number of (padded) source tokens in a batch", default=1500)
+    parser.add_argument("--chunk_size", type=int, help="number of sentences sorted by length and written out together", default=10000)
+    parser.add_argument("--num_workers", type=int, help="translate batches in this many (CPU) worker processes, 0 - no workers", default=0)
+    parser.add_argument("--num_threads_per_worker", type=int, help="number of intra-op (torch) threads of every worker", default=1)
+    parser.add_argument("--pin_workers_to_cores", action='store_true', help="pin every worker to its own set of CPU cores")
+
+    # Translation (result) cache related args
+    parser.add_argument("--use_translation_cache", action='store_true', help="reuse translations of repeated sentences")
+    parser.add_argument("--translation_cache_size", type=int, help="max number of translations kept in memory", default=10000)
+    parser.add_argument("--translation_cache_path", type=str, help="persist the cache in this (SQLite) file, e.g. translations.db", default=None)
     args = parser.parse_args()
 
     # Wrapping training configuration into a dictionary
@@ -104,5 +437,8 @@ if __name__ == "__main__":
     for arg in vars(args):
         translation_config[arg] = getattr(args, arg)
 
-    # Translate the given source sentence
-    translate_a_single_sentence(translation_config)
+    # Translate the given file (or stdin) or the given source sentence
+    if translation_config['input_file'] is not None:
+        translate_a_file(translation_config)
+    else:
+        translate_a_single_sentence(translation_config)
@@ -0,0 +1,346 @@
+"""
+    Local HTTP translation server - the model is loaded only once and concurrent requests get coalesced into batches.
+
+    Endpoints (JSON in, JSON out):
+        POST /translate         {"source_sentence": "How are you doing today?"} -> {"translation": "..."}
+        POST /translate_batch   {"source_sentences": ["...", "..."]}           -> {"translations": ["...", "..."]}
+        GET  /stats             number of translated sentences/batches (handy to check that micro-batching kicks in)
+
+    Example: curl -X POST localhost:8000/translate -d '{"source_sentence": "How are you doing today?"}'
+
+    Micro-batching: the first request that arrives opens a batch, we then wait for at most max_wait_ms for other
+    requests to join it (or until the batch has max_batch_tokens source tokens) and translate the whole batch at once.
+    Sentences of a /translate_batch request are batched the same way (together with the sentences of other requests).
+
+    Continuous batching (--continuous_batching, greedy decoding only): instead of translating the micro-batch as a whole
+    the sentences join the pool of in-flight sentences at the very next decoding step and leave it as soon as they're
+    done, so a short sentence never waits for the longest one of its batch (see continuous_batching_utils.py).
+
+    Note: only the standard library is used (asyncio) so no web framework is needed.
+
+"""
+
+
+import argparse
+import asyncio
+import json
+import sys
+from http import HTTPStatus
+
+
+import torch
+
+
+from translation_script import get_translation_device, load_translation_resources, get_translation_cache, translate_source_sentences_tokens
+from models.definitions.transformer_model import AttentionBackend
+from utils.data_utils import DatasetType, LanguageDirection, get_masks_and_count_tokens_src
+from utils.decoding_utils import DecodingMethod
+from utils.continuous_batching_utils import ContinuousBatchingScheduler
+from utils.mmap_weights_utils import StorageDtype
+from utils.constants import *
+
+
+class MicroBatcher:
+    """
+        Collects the (tokenized) source sentences of concurrent requests and passes them in batches to translate_fn.
+
+        translate_fn is blocking (it runs the model) so it's executed in a worker thread, that way the event loop can
+        keep on accepting the new requests (and forming the next batch) while the current batch is being translated.
+
+    """
+
+    def __init__(self, translate_fn, max_wait_time, max_batch_tokens):
+        self.translate_fn = translate_fn
+        self.max_wait_time = max_wait_time
+        self.max_batch_tokens = max_batch_tokens
+        self.queue = asyncio.Queue()
+
+        self.num_translated_sentences = 0
+        self.num_translated_batches = 0
+
+    async def translate(self, source_sentence_tokens):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((source_sentence_tokens, future))
+        return await future
+
+    async def get_next_batch(self, pending_request):
+        loop = asyncio.get_running_loop()
+
+        # Block until the first request arrives - it opens the batch
+        batch = [pending_request if pending_request is not None else await self.queue.get()]
+        num_batch_tokens = len(batch[0][0])
+
+        deadline = loop.time() + self.max_wait_time
+        while num_batch_tokens < self.max_batch_tokens:
+            try:
+                request = await asyncio.wait_for(self.queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+
+            # The request doesn't fit into the token budget, it will open the next batch
+            if num_batch_tokens + len(request[0]) > self.max_batch_tokens:
+                return batch, request
+
+            batch.append(request)
+            num_batch_tokens += len(request[0])
+
+        return batch, None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        pending_request = None
+
+        while True:
+            batch, pending_request = await self.get_next_batch(pending_request)
+            source_sentences_tokens = [source_sentence_tokens for source_sentence_tokens, _ in batch]
+
+            try:
+                target_sentences_tokens = await loop.run_in_executor(None, self.translate_fn, source_sentences_tokens)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), target_sentence_tokens in zip(batch, target_sentences_tokens):
+                if not future.done():  # client could have disconnected in the meantime
+                    future.set_result(target_sentence_tokens)
+
+            self.num_translated_sentences += len(batch)
+            self.num_translated_batches += 1
+
+    def get_stats(self):
+        return {"num_translated_sentences": self.num_translated_sentences, "num_translated_batches": self.num_translated_batches}
+
+
+class ContinuousBatcher:
+    """
+        Same interface as MicroBatcher but the batch gets re-formed at every decoding step: the requests which arrived
+        in the meantime are encoded and join the pool of in-flight sentences, the finished ones leave it right away.
+
+        Every model call (encoding the new requests, a decoding step) is executed in a worker thread, one at a time.
+
+    """
+
+    def __init__(self, encode_fn, create_scheduler_fn, translation_cache):
+        self.encode_fn = encode_fn
+        self.create_scheduler_fn = create_scheduler_fn
+        self.translation_cache = translation_cache
+        self.scheduler = create_scheduler_fn()
+        self.queue = asyncio.Queue()
+
+        self.num_translated_sentences = 0
+        self.num_decoding_steps = 0
+
+    async def translate(self, source_sentence_tokens):
+        # Empty sentences stay empty and cached ones don't have to be decoded at all
+        if len(source_sentence_tokens) == 0:
+            return []
+        if self.translation_cache is not None:
+            cached_target_sentence_tokens = self.translation_cache.get(source_sentence_tokens)
+            if cached_target_sentence_tokens is not None:
+                return [token for token in cached_target_sentence_tokens if token not in [BOS_TOKEN, EOS_TOKEN]]
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((source_sentence_tokens, future))
+        return await future
+
+    def decoding_step(self):
+        with torch.no_grad():  # grad mode is per thread
+            return self.scheduler.step()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        requests = dict()  # request id -> (source sentence tokens, future) of the requests which joined the scheduler
+        next_request_id = 0
+
+        while True:
+            # Block only if there's nothing to decode, otherwise just grab whatever arrived during the last step
+            new_requests = [] if self.scheduler.has_work else [await self.queue.get()]
+            while not self.queue.empty():
+                new_requests.append(self.queue.get_nowait())
+
+            try:
+                if len(new_requests) > 0:
+                    request_ids = list(range(next_request_id, next_request_id + len(new_requests)))
+                    next_request_id += len(new_requests)
+                    requests.update(zip(request_ids, new_requests))
+                    await loop.run_in_executor(None, self.encode_fn, self.scheduler, request_ids, [source_sentence_tokens for source_sentence_tokens, _ in new_requests])
+
+                finished_sequences = await loop.run_in_executor(None, self.decoding_step)
+            except Exception as e:
+                # The pool is in an unknown state - fail all of the in-flight requests and start over with an empty one
+                for _, future in requests.values():
+                    if not future.done():
+                        future.set_exception(e)
+                requests.clear()
+                self.scheduler = self.create_scheduler_fn()
+                continue
+
+            self.num_decoding_steps += 1
+            for request_id, target_sentence_tokens in finished_sequences:
+                source_sentence_tokens, future = requests.pop(request_id)
+                if self.translation_cache is not None:
+                    self.translation_cache.put([source_sentence_tokens], [target_sentence_tokens])
+                if not future.done():  # client could have disconnected in the meantime
+                    future.set_result([token for token in target_sentence_tokens if token not in [BOS_TOKEN, EOS_TOKEN]])
+                self.num_translated_sentences += 1
+
+    def get_stats(self):
+        return {"num_translated_sentences": self.num_translated_sentences, "num_decoding_steps": self.num_decoding_steps, "scheduler": self.scheduler.get_metrics_summary()}
+
+
+class TranslationServer:
+
+    def __init__(self, server_config):
+        self.server_config = server_config
+        self.device = get_translation_device(server_config)
+
+        self.baseline_transformer, self.src_field_processor, self.trg_field_processor, self.lexical_shortlist = load_translation_resources(server_config, self.device)
+        self.translation_cache = get_translation_cache(server_config)
+        self.batcher = None  # asyncio objects have to be created inside of the running event loop, see serve
+
+    def translate_source_sentences_tokens(self, source_sentences_tokens):
+        return translate_source_sentences_tokens(
+            self.server_config,
+            self.baseline_transformer,
+            self.src_field_processor,
+            self.trg_field_processor,
+            self.lexical_shortlist,
+            source_sentences_tokens,
+            self.translation_cache
+        )
+
+    def encode_source_sentences_tokens(self, scheduler, request_ids, source_sentences_tokens):
+        # Continuous batching - the new requests are encoded together and then join the scheduler's pool one by one
+        pad_token_id = self.src_field_processor.vocab.stoi[PAD_TOKEN]
+        with torch.no_grad():
+            src_token_ids_batch = self.src_field_processor.process(source_sentences_tokens, self.device)
+            src_mask, _ = get_masks_and_count_tokens_src(src_token_ids_batch, pad_token_id)
+            scheduler.add_requests(request_ids, self.baseline_transformer.encode(src_token_ids_batch, src_mask), src_mask)
+
+    def create_scheduler(self):
+        # Only keep the metrics of the latest requests/steps, the server runs indefinitely
+        return ContinuousBatchingScheduler(self.baseline_transformer, self.trg_field_processor, self.server_config['max_pool_size'], metrics_window=10000)
+
+    async def translate(self, source_sentence):
+        if not isinstance(source_sentence, str):
+            raise ValueError(f'Expected a string, got {type(source_sentence).__name__}.')
+
+        source_sentence_tokens = self.src_field_processor.preprocess(source_sentence.strip())
+        target_sentence_tokens = await self.batcher.translate(source_sentence_tokens)
+        return ' '.join(target_sentence_tokens)
+
+    async def route(self, method, path, body):
+        if method == 'POST' and path == '/translate':
+            return HTTPStatus.OK, {"translation": await self.translate(json.loads(body)['source_sentence'])}
+
+        if method == 'POST' and path == '/translate_batch':
+            source_sentences = json.loads(body)['source_sentences']
+            return HTTPStatus.OK, {"translations": await asyncio.gather(*[self.translate(source_sentence) for source_sentence in source_sentences])}
+
+        if method == 'GET' and path == '/stats':
+            return HTTPStatus.OK, {
+                **self.batcher.get_stats(),
+                "translation_cache": None if self.translation_cache is None else self.translation_cache.get_stats()
+            }
+
+        return HTTPStatus.NOT_FOUND, {"error": f'{method} {path} is not supported.'}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            # Minimal HTTP/1.1 parsing - request line, headers and a body of Content-Length bytes
+            method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = dict()
+            while True:
+                header_line = (await reader.readline()).decode('latin-1')
+                if header_line.strip() == '':
+                    break
+                name, value = header_line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            status, response = await self.route(method, path, body)
+        except (ValueError, KeyError, TypeError, asyncio.IncompleteReadError) as e:  # JSONDecodeError is a ValueError
+            status, response = HTTPStatus.BAD_REQUEST, {"error": repr(e)}
+        except Exception as e:
+            status, response = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": repr(e)}
+
+        payload = json.dumps(response, ensure_ascii=False).encode('utf-8')
+        writer.write(
+            f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+            f'Content-Type: application/json; charset=utf-8\r\n'
+            f'Content-Length: {len(payload)}\r\n'
+            f'Connection: close\r\n\r\n'.encode('latin-1') + payload
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def serve(self):
+        if self.server_config['continuous_batching']:
+            self.batcher = ContinuousBatcher(self.encode_source_sentences_tokens, self.create_scheduler, self.translation_cache)
+        else:
+            self.batcher = MicroBatcher(self.translate_source_sentences_tokens, self.server_config['max_wait_ms'] / 1000, self.server_config['max_batch_tokens'])
+        batcher_task = asyncio.ensure_future(self.batcher.run())
+        server = await asyncio.start_server(self.handle_connection, self.server_config['host'], self.server_config['port'])
+        print(f'Translation server listening on http://{self.server_config["host"]}:{self.server_config["port"]}', file=sys.stderr)
+
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                batcher_task.cancel()
+
+
+if __name__ == "__main__":
+    #
+    # modifiable args - feel free to play with these (only small subset is exposed by design to avoid cluttering)
+    #
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, help="address to listen on", default='127.0.0.1')
+    parser.add_argument("--port", type=int, help="port to listen on", default=8000)
+    parser.add_argument("--model_name", type=str, help="transformer model name", default=r'iwslt_e2g.pth')
+
+    # Keep these 2 in sync with the model you pick via model_name
+    parser.add_argument("--dataset_name", type=str, choices=[el.name for el in DatasetType], help='which dataset the model was trained on', default=DatasetType.IWSLT.name)
+    parser.add_argument("--language_direction", type=str, choices=[el.name for el in LanguageDirection], help='which direction to translate', default=LanguageDirection.E2G.name)
+    parser.add_argument("--dataset_path", type=str, help='cache files and datasets are stored here', default=DATA_DIR_PATH)
+
+    # Micro-batching related args
+    parser.add_argument("--max_wait_ms", type=float, help="max time a request waits for others to join its batch", default=10)
+    parser.add_argument("--max_batch_tokens", type=int, help="max number of source tokens in a batch", default=1500)
+    parser.add_argument("--continuous_batching", action='store_true', help="re-form the batch at every decoding step (greedy decoding only)")
+    parser.add_argument("--max_pool_size", type=int, help="continuous batching: max number of sentences decoded together", default=64)
+
+    # Decoding related args
+    parser.add_argument("--decoding_method", choices=[el.name for el in DecodingMethod], help="pick between different decoding methods", default=DecodingMethod.GREEDY.name)
+    parser.add_argument("--beam_size", type=int, help="used only in case beam decoding method is chosen", default=4)
+    parser.add_argument("--length_penalty_coefficient", type=float, help="length penalty for the beam search", default=0.6)
+    parser.add_argument("--max_length_a", type=float, help="greedy: max target length = a * source length + b", default=None)
+    parser.add_argument("--max_length_b", type=int, help="greedy: used only if max_length_a is set", default=10)
+    parser.add_argument("--use_lexical_shortlist", action='store_true', help="only score plausible target tokens (faster)")
+    parser.add_argument("--quantize", action='store_true', help="use int8 dynamically quantized model (CPU only, faster)")
+    parser.add_argument("--attention_backend", choices=[el.name for el in AttentionBackend], help="attention implementation", default=AttentionBackend.SDPA.name)
+    parser.add_argument("--mmap_weights_dtype", choices=[el.name for el in StorageDtype], help="memory map the weights stored in this dtype (faster startup, less memory)", default=None)
+
+    # Translation (result) cache related args
+    parser.add_argument("--use_translation_cache", action='store_true', help="reuse translations of repeated sentences")
+    parser.add_argument("--translation_cache_size", type=int, help="max number of translations kept in memory", default=10000)
+    parser.add_argument("--translation_cache_path", type=str, help="persist the cache in this (SQLite) file, e.g. translations.db", default=None)
+    args = parser.parse_args()
+
+    # The continuous batching scheduler implements plain greedy decoding (see continuous_batching_utils.py)
+    if args.continuous_batching and (args.decoding_method != DecodingMethod.GREEDY.name or args.use_lexical_shortlist or args.max_length_a is not None):
+        parser.error('--continuous_batching only supports greedy decoding without --use_lexical_shortlist and --max_length_a.')
+
+    # Wrapping server configuration into a dictionary
+    server_config = dict()
+    for arg in vars(args):
+        server_config[arg] = getattr(args, arg)
+    server_config['visualize_attention'] = False  # only used by the translation script
+    server_config['batch_size'] = server_config['max_batch_tokens']  # a micro-batch is translated as a single batch
+
+    asyncio.run(TranslationServer(server_config).serve())
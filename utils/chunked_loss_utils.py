@@ -0,0 +1,78 @@
+"""
+    Chunked decoder generator + label smoothed loss - the decoder generator produces (N, V) logits and log probabilities
+    (N - number of target tokens, V - target vocab size) and autograd keeps them around for the backward pass. With big
+    token batches and WMT-sized vocabs those are by far the biggest activations of the whole model.
+
+    Here the vocab projection, log softmax and the loss are computed for chunk_size target tokens at a time and nothing
+    of size (N, V) is kept for backward - the backward pass recomputes every chunk's log probabilities (it's a single
+    matmul, cheap compared to the rest of the model) and turns them into gradients right away.
+    Peak memory thus scales with chunk_size * V instead of N * V.
+
+    Gradients - the loss is the KL divergence against the smooth target distribution t (see LabelSmoothingKLDivLoss) so
+    w.r.t. the logits it's simply: p * sum(t) - t, where p = softmax(logits) and t is all 0s for pad target tokens.
+
+"""
+
+
+import torch
+import torch.nn.functional as F
+
+
+class ChunkedGeneratorLabelSmoothingLoss(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx, trg_representations_batch, linear_weight, linear_bias, trg_token_ids_batch, label_smoothing_loss, chunk_size):
+        loss = trg_representations_batch.new_zeros(())
+        for start in range(0, trg_representations_batch.shape[0], chunk_size):
+            log_probs_chunk = F.linear(trg_representations_batch[start:start+chunk_size], linear_weight, linear_bias).log_softmax(dim=-1)
+            loss += label_smoothing_loss(log_probs_chunk, trg_token_ids_batch[start:start+chunk_size])
+
+        ctx.save_for_backward(trg_representations_batch, linear_weight, linear_bias, trg_token_ids_batch)
+        ctx.label_smoothing_loss = label_smoothing_loss
+        ctx.chunk_size = chunk_size
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        trg_representations_batch, linear_weight, linear_bias, trg_token_ids_batch = ctx.saved_tensors
+        label_smoothing_loss = ctx.label_smoothing_loss
+        confidence_value = label_smoothing_loss.confidence_value
+        smoothing_value_per_token = label_smoothing_loss.smoothing_value_per_token
+        pad_token_id = label_smoothing_loss.pad_token_id
+        # Sum of the (non-pad) smooth target distribution, it's 1 (up to floating point noise)
+        target_distribution_sum = confidence_value + smoothing_value_per_token * (linear_weight.shape[0] - 2)
+
+        grad_trg_representations_batch = torch.empty_like(trg_representations_batch)
+        grad_linear_weight = torch.zeros_like(linear_weight)
+        grad_linear_bias = torch.zeros_like(linear_bias)
+        for start in range(0, trg_representations_batch.shape[0], ctx.chunk_size):
+            trg_representations_chunk = trg_representations_batch[start:start+ctx.chunk_size]
+            trg_token_ids_chunk = trg_token_ids_batch[start:start+ctx.chunk_size]
+
+            # Recompute the probabilities, all of the following ops are in-place so only a single (chunk_size, V) tensor
+            # gets allocated: p * sum(t) - t where t = smoothing_value_per_token everywhere except for the ground truth
+            # token (confidence_value) and the pad token (0)
+            grad_logits_chunk = F.linear(trg_representations_chunk, linear_weight, linear_bias).softmax(dim=-1)
+            grad_logits_chunk.mul_(target_distribution_sum).sub_(smoothing_value_per_token)
+            grad_logits_chunk[:, pad_token_id] += smoothing_value_per_token
+            grad_logits_chunk.scatter_add_(1, trg_token_ids_chunk, grad_logits_chunk.new_full(trg_token_ids_chunk.shape, smoothing_value_per_token - confidence_value))
+
+            # Pad target tokens don't contribute to the loss
+            grad_logits_chunk.masked_fill_(trg_token_ids_chunk == pad_token_id, 0.)
+            grad_logits_chunk.mul_(grad_loss)
+
+            grad_trg_representations_batch[start:start+ctx.chunk_size] = grad_logits_chunk @ linear_weight
+            grad_linear_weight.addmm_(grad_logits_chunk.t(), trg_representations_chunk)
+            grad_linear_bias += grad_logits_chunk.sum(dim=0)
+
+        return grad_trg_representations_batch, grad_linear_weight, grad_linear_bias, None, None, None
+
+
+def chunked_generator_label_smoothing_loss(decoder_generator, trg_representations_batch, trg_token_ids_batch, label_smoothing_loss, chunk_size):
+    """
+        Same value and gradients as label_smoothing_loss(decoder_generator(trg_representations_batch), trg_token_ids_batch)
+        i.e. the summed KL divergence. Shapes: trg_representations_batch (N, D), trg_token_ids_batch (N, 1).
+
+    """
+    linear = decoder_generator.linear
+    return ChunkedGeneratorLabelSmoothingLoss.apply(trg_representations_batch, linear.weight, linear.bias, trg_token_ids_batch, label_smoothing_loss, chunk_size)
@@ -0,0 +1,201 @@
+"""
+    Continuous (iteration-level) batching for greedy decoding.
+
+    greedy_decoding holds a batch until its slowest sentence is done, here we instead keep a pool of in-flight sequences
+    and we re-form the batch at every decoding step: fully decoded sequences leave the pool and the newly arrived
+    (already encoded) requests join it right away - nobody waits for the longest sentence of somebody else's batch.
+
+    Sequences in the pool are at different decoding steps so every sequence has its own position (see DecoderCache's
+    positions) and the target keys/values of the shorter ones are left padded (and masked out) - see DecoderCache's
+    concatenate for the details.
+
+    Used by the translation server (--continuous_batching) and benchmarked against static batching in benchmark_script.py.
+
+"""
+
+
+import time
+from collections import deque
+
+
+import torch
+import torch.nn.functional as F
+
+
+from .constants import *
+from models.definitions.transformer_model import DecoderCache
+
+
+class ContinuousBatchingScheduler:
+
+    def __init__(self, baseline_transformer, trg_field_processor, max_pool_size=64, max_target_tokens=100, metrics_window=None):
+        self.baseline_transformer = baseline_transformer
+        self.trg_field_processor = trg_field_processor
+        self.max_pool_size = max_pool_size
+        self.max_target_tokens = max_target_tokens
+
+        self.device = next(baseline_transformer.parameters()).device
+        self.pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
+        self.eos_token_id = trg_field_processor.vocab.stoi[EOS_TOKEN]
+        self.bos_token_id = trg_field_processor.vocab.stoi[BOS_TOKEN]
+
+        # Encoded requests which didn't join the pool yet - (request id, src representations, src mask, arrival time)
+        self.waiting_requests = deque()
+
+        # In-flight sequences (everything is in the same order), notation: B - pool size, S - longest source sentence,
+        # T - number of cached target tokens (the longest running sequence)
+        self.request_ids = []
+        self.arrival_times = []
+        self.token_ids = []  # python lists of predicted token ids of every sequence
+        self.latest_token_ids_batch = None  # (B, 1)
+        self.src_mask = None  # (B, 1, 1, S)
+        self.trg_mask = None  # (B, T), False for the left padding (and the predicted pad tokens - same as greedy)
+        self.decoder_cache = None
+
+        # Only the latest metrics_window entries are kept (if set) so that a long-running server doesn't keep on growing
+        self.num_steps = 0
+        self.metrics = {
+            "queueing_times": deque(maxlen=metrics_window),  # time between a request's arrival and it joining the pool
+            "latencies": deque(maxlen=metrics_window),  # time between a request's arrival and it being fully decoded
+            "pool_sizes": deque(maxlen=metrics_window),  # number of sequences decoded in every step
+            "valid_cache_fractions": deque(maxlen=metrics_window)  # fraction of target keys/values which are not padding in every step
+        }
+
+    @property
+    def num_in_flight(self):
+        return len(self.request_ids)
+
+    @property
+    def has_work(self):
+        return self.num_in_flight > 0 or len(self.waiting_requests) > 0
+
+    def add_requests(self, request_ids, src_representations_batch, src_mask):
+        # Every (right padded) source sentence in the batch becomes a separate request, we strip the padding as
+        # the sentence will end up in a pool with other sentences anyway
+        arrival_time = time.time()
+        num_src_tokens_per_sentence = src_mask.view(src_mask.shape[0], -1).sum(dim=-1).tolist()
+        for i, (request_id, num_src_tokens) in enumerate(zip(request_ids, num_src_tokens_per_sentence)):
+            self.waiting_requests.append((request_id, src_representations_batch[i:i+1, :num_src_tokens], src_mask[i:i+1, ..., :num_src_tokens], arrival_time))
+
+    def admit_waiting_requests(self):
+        num_admitted = min(len(self.waiting_requests), self.max_pool_size - self.num_in_flight)
+        if num_admitted == 0:
+            return
+
+        admitted_requests = [self.waiting_requests.popleft() for _ in range(num_admitted)]
+        admission_time = time.time()
+
+        # Pad the source sentences of the admitted requests to the same length and project them into the source keys/values
+        src_length = max(src_representations.shape[1] for _, src_representations, _, _ in admitted_requests)
+        src_representations_batch = torch.cat([F.pad(src_representations, (0, 0, 0, src_length - src_representations.shape[1])) for _, src_representations, _, _ in admitted_requests])
+        src_mask = torch.cat([F.pad(request_src_mask, (0, src_length - request_src_mask.shape[-1])) for _, _, request_src_mask, _ in admitted_requests])
+        decoder_cache = self.baseline_transformer.init_decoder_cache(src_representations_batch)
+
+        # The admitted sequences start with the beginning of the sentence token and have no cached target tokens yet
+        latest_token_ids_batch = torch.full((num_admitted, 1), self.bos_token_id, dtype=torch.long, device=self.device)
+        for request_id, _, _, arrival_time in admitted_requests:
+            self.request_ids.append(request_id)
+            self.arrival_times.append(arrival_time)
+            self.token_ids.append([])
+            self.metrics['queueing_times'].append(admission_time - arrival_time)
+
+        if self.decoder_cache is None:
+            self.decoder_cache = DecoderCache.concatenate([decoder_cache])
+            self.latest_token_ids_batch = latest_token_ids_batch
+            self.src_mask = src_mask
+            self.trg_mask = torch.zeros((num_admitted, 0), dtype=torch.bool, device=self.device)
+        else:
+            src_length = max(src_length, self.src_mask.shape[-1])
+            self.decoder_cache = DecoderCache.concatenate([self.decoder_cache, decoder_cache])
+            self.latest_token_ids_batch = torch.cat((self.latest_token_ids_batch, latest_token_ids_batch))
+            self.src_mask = torch.cat((F.pad(self.src_mask, (0, src_length - self.src_mask.shape[-1])), F.pad(src_mask, (0, src_length - src_mask.shape[-1]))))
+            self.trg_mask = torch.cat((self.trg_mask, torch.zeros((num_admitted, self.trg_mask.shape[1]), dtype=torch.bool, device=self.device)))
+
+    def step(self):
+        """
+            Admits the waiting requests (as many as fit into the pool) and does a single decoding step for the whole pool.
+
+            Returns a list of (request id, target sentence tokens) of the sequences that got fully decoded in this step.
+
+        """
+        self.admit_waiting_requests()
+        if self.num_in_flight == 0:
+            return []
+
+        # The latest token can attend to all of the previous (cached) tokens and itself, but not to the (left) padding
+        self.trg_mask = torch.cat((self.trg_mask, self.latest_token_ids_batch != self.pad_token_id), dim=1)
+        self.num_steps += 1
+        self.metrics['pool_sizes'].append(self.num_in_flight)
+        self.metrics['valid_cache_fractions'].append((self.decoder_cache.positions + 1).sum().item() / self.trg_mask.numel())
+
+        # Source keys/values are cached so we don't need the source representations. Shape = (B, V)
+        trg_mask = self.trg_mask.view(self.num_in_flight, 1, 1, -1)
+        predicted_log_distributions = self.baseline_transformer.decode(self.latest_token_ids_batch, None, trg_mask, self.src_mask, self.decoder_cache, 'last')
+        self.latest_token_ids_batch = torch.argmax(predicted_log_distributions, dim=-1, keepdim=True)
+
+        # Figure out which sequences are done (EOS or max length) - we have to sync with the device every step anyway
+        # since the pool gets re-formed every step
+        finished_sequences = []
+        active_positions = []
+        for position, token_id in enumerate(self.latest_token_ids_batch.view(-1).tolist()):
+            self.token_ids[position].append(token_id)
+            if token_id == self.eos_token_id or len(self.token_ids[position]) == self.max_target_tokens:
+                finished_sequences.append(position)
+            else:
+                active_positions.append(position)
+
+        if len(finished_sequences) == 0:
+            return []
+
+        # Remove the fully decoded sequences from the pool
+        finish_time = time.time()
+        itos = self.trg_field_processor.vocab.itos
+        results = []
+        for position in finished_sequences:
+            results.append((self.request_ids[position], [BOS_TOKEN] + [itos[token_id] for token_id in self.token_ids[position]]))
+            self.metrics['latencies'].append(finish_time - self.arrival_times[position])
+
+        self.request_ids = [self.request_ids[position] for position in active_positions]
+        self.arrival_times = [self.arrival_times[position] for position in active_positions]
+        self.token_ids = [self.token_ids[position] for position in active_positions]
+        if len(active_positions) == 0:
+            self.latest_token_ids_batch, self.src_mask, self.trg_mask, self.decoder_cache = None, None, None, None
+            return results
+
+        active_positions = torch.tensor(active_positions, device=self.device)
+        self.latest_token_ids_batch = self.latest_token_ids_batch.index_select(0, active_positions)
+        self.src_mask = self.src_mask.index_select(0, active_positions)
+        self.trg_mask = self.trg_mask.index_select(0, active_positions)
+        self.decoder_cache.reorder(active_positions)
+
+        # Drop the left padding that none of the remaining sequences need (the longest running sequence might have left)
+        num_padding_tokens = self.trg_mask.shape[1] - self.decoder_cache.positions.max().item()
+        if num_padding_tokens > 0:
+            self.trg_mask = self.trg_mask[:, num_padding_tokens:]
+            self.decoder_cache.slice_trg(num_padding_tokens)
+
+        return results
+
+    def run(self):
+        # Decode until both the pool and the waiting queue are empty, returns {request id: target sentence tokens}
+        results = dict()
+        while self.has_work:
+            results.update(self.step())
+        return results
+
+    def get_metrics_summary(self):
+        def percentile(values, p):
+            return sorted(values)[min(len(values) - 1, int(p / 100 * len(values)))] if len(values) > 0 else 0.
+
+        def mean(values):
+            return sum(values) / len(values) if len(values) > 0 else 0.
+
+        return {
+            "num_steps": self.num_steps,
+            "avg_pool_utilization": mean(self.metrics['pool_sizes']) / self.max_pool_size,
+            "avg_valid_cache_fraction": mean(self.metrics['valid_cache_fractions']),
+            "avg_queueing_time": mean(self.metrics['queueing_times']),
+            "p95_queueing_time": percentile(self.metrics['queueing_times'], 95),
+            "avg_latency": mean(self.metrics['latencies']),
+            "p95_latency": percentile(self.metrics['latencies'], 95)
+        }
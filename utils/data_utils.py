@@ -1,13 +1,14 @@
 import time
 import os
 import enum
+import functools
+from collections import defaultdict
 
 
 import torch
 from torchtext.data import Dataset, BucketIterator, Field, Example
 from torchtext.data.utils import interleave_keys
 from torchtext import datasets
-import spacy
 
 
 from .constants import BOS_TOKEN, EOS_TOKEN, PAD_TOKEN, DATA_DIR_PATH
@@ -109,34 +110,64 @@ def save_cache(cache_path, dataset):
 #
 
 
-def get_datasets_and_vocabs(dataset_path, language_direction, use_iwslt=True, use_caching_mechanism=True):
-    german_to_english = language_direction == LanguageDirection.G2E.name
-    spacy_de = spacy.load('de_core_news_sm')
-    spacy_en = spacy.load('en_core_web_sm')
+def get_cache_paths(dataset_path, language_direction, use_iwslt=True):
+    prefix = 'de_en' if language_direction == LanguageDirection.G2E.name else 'en_de'
+    prefix += '_iwslt' if use_iwslt else '_wmt14'
+    train_cache_path = os.path.join(dataset_path, f'{prefix}_train_cache.csv')
+    val_cache_path = os.path.join(dataset_path, f'{prefix}_val_cache.csv')
+    test_cache_path = os.path.join(dataset_path, f'{prefix}_test_cache.csv')
 
-    def tokenize_de(text):
-        return [tok.text for tok in spacy_de.tokenizer(text)]
+    return train_cache_path, val_cache_path, test_cache_path
 
-    def tokenize_en(text):
-        return [tok.text for tok in spacy_en.tokenizer(text)]
 
-    # batch first set to true as my transformer is expecting that format (that's consistent with the format
-    # used in  computer vision), namely (B, C, H, W) -> batch size, number of channels, height and width
+@functools.lru_cache(maxsize=None)
+def load_spacy_model(spacy_model_name):
+    import spacy  # imported lazily, it's slow to import and many code paths never tokenize anything
+    return spacy.load(spacy_model_name)
+
+
+class SpacyTokenizer:
+    """
+        Loads the spaCy model lazily on the first call - the cached datasets are already tokenized (so is pre-tokenized
+        input) and translation only ever tokenizes the source language, so usually at most one model gets loaded.
+
+        Unlike a closure over the loaded spaCy model this can be pickled (e.g. sent to the inference workers).
+
+    """
+
+    def __init__(self, spacy_model_name):
+        self.spacy_model_name = spacy_model_name
+
+    def __call__(self, text):
+        return [tok.text for tok in load_spacy_model(self.spacy_model_name).tokenizer(text)]
+
+
+def get_field_processors(language_direction):
+    german_to_english = language_direction == LanguageDirection.G2E.name
+    tokenize_de = SpacyTokenizer('de_core_news_sm')
+    tokenize_en = SpacyTokenizer('en_core_web_sm')
+
     src_tokenizer = tokenize_de if german_to_english else tokenize_en
     trg_tokenizer = tokenize_en if german_to_english else tokenize_de
+
+    # batch first set to true as my transformer is expecting that format (that's consistent with the format
+    # used in  computer vision), namely (B, C, H, W) -> batch size, number of channels, height and width
     src_field_processor = Field(tokenize=src_tokenizer, pad_token=PAD_TOKEN, batch_first=True)
     trg_field_processor = Field(tokenize=trg_tokenizer, init_token=BOS_TOKEN, eos_token=EOS_TOKEN, pad_token=PAD_TOKEN, batch_first=True)
 
+    return src_field_processor, trg_field_processor
+
+
+def get_datasets_and_vocabs(dataset_path, language_direction, use_iwslt=True, use_caching_mechanism=True):
+    german_to_english = language_direction == LanguageDirection.G2E.name
+    src_field_processor, trg_field_processor = get_field_processors(language_direction)
+
     fields = [('src', src_field_processor), ('trg', trg_field_processor)]
     MAX_LEN = 100  # filter out examples that have more than MAX_LEN tokens
     filter_pred = lambda x: len(x.src) <= MAX_LEN and len(x.trg) <= MAX_LEN
 
     # Only call once the splits function it is super slow as it constantly has to redo the tokenization
-    prefix = 'de_en' if german_to_english else 'en_de'
-    prefix += '_iwslt' if use_iwslt else '_wmt14'
-    train_cache_path = os.path.join(dataset_path, f'{prefix}_train_cache.csv')
-    val_cache_path = os.path.join(dataset_path, f'{prefix}_val_cache.csv')
-    test_cache_path = os.path.join(dataset_path, f'{prefix}_test_cache.csv')
+    train_cache_path, val_cache_path, test_cache_path = get_cache_paths(dataset_path, language_direction, use_iwslt)
 
     # This simple caching mechanism gave me ~30x speedup on my machine! From ~70s -> ~2.5s!
     ts = time.time()
@@ -180,6 +211,50 @@ def get_datasets_and_vocabs(dataset_path, language_direction, use_iwslt=True, us
     return train_dataset, val_dataset, src_field_processor, trg_field_processor
 
 
+#
+# Vocab (de)serialization - bundling the vocabs with the model so that inference doesn't have to rebuild the datasets
+#
+
+
+def get_vocab_state(field_processor):
+    return {
+        "itos": field_processor.vocab.itos,
+        "unk_token": field_processor.unk_token,
+        "pad_token": field_processor.pad_token,
+        "init_token": field_processor.init_token,
+        "eos_token": field_processor.eos_token
+    }
+
+
+class SerializedVocab:
+    """
+        Lightweight stand-in for torch text's Vocab restored from a model binary. The field processors (numericalization)
+        and the decoding functions only need itos, stoi and the vocab size.
+
+        Note: partial(int, unk_token_id) is just a picklable way to say "map unknown tokens onto the unk token id",
+        which is what torch text's Vocab does as well.
+
+    """
+
+    def __init__(self, itos, unk_token):
+        self.itos = itos
+        self.stoi = defaultdict(functools.partial(int, itos.index(unk_token)), {token: token_id for token_id, token in enumerate(itos)})
+
+    def __len__(self):
+        return len(self.itos)
+
+
+def get_field_processors_from_training_state(training_state):
+    src_field_processor, trg_field_processor = get_field_processors(training_state['language_direction'])
+
+    for field_processor, vocab_state in [(src_field_processor, training_state['src_vocab']), (trg_field_processor, training_state['trg_vocab'])]:
+        for special_token in ['unk_token', 'pad_token', 'init_token', 'eos_token']:
+            assert getattr(field_processor, special_token) == vocab_state[special_token], f'Special token mismatch ({special_token}) between the model binary and the field processor.'
+        field_processor.vocab = SerializedVocab(vocab_state['itos'], vocab_state['unk_token'])
+
+    return src_field_processor, trg_field_processor
+
+
 global longest_src_sentence, longest_trg_sentence
 
 
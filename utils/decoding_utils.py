@@ -2,11 +2,9 @@ import enum
 
 
 import torch
-import numpy as np
 
 
 from .constants import *
-from utils.data_utils import get_masks_and_count_tokens_trg
 
 
 class DecodingMethod(enum.Enum):
@@ -14,61 +12,106 @@ class DecodingMethod(enum.Enum):
     BEAM = 1
 
 
-def greedy_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor, max_target_tokens=100):
+def greedy_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor, max_target_tokens=100, vocab_shortlist=None, max_length_coefficients=None):
     """
     Supports batch (decode multiple source sentences) greedy decoding.
 
-    Decoding could be further optimized to cache old token activations because they can't look ahead and so
-    adding a newly predicted token won't change old token's activations.
+    Decoding is optimized by caching old token activations (keys/values of every decoder self-attention MHA) because
+    they can't look ahead and so adding a newly predicted token won't change old token's activations.
 
     Example: we input <s> and do a forward pass. We get intermediate activations for <s> and at the output at position
     0, after the doing linear layer we get e.g. token <I>. Now we input <s>,<I> but <s>'s activations will remain
     the same. Similarly say we now got <am> at output position 1, in the next step we input <s>,<I>,<am> and so <I>'s
     activations will remain the same as it only looks at/attends to itself and to <s> and so forth.
 
-    """
-
-    device = next(baseline_transformer.parameters()).device
-    pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
+    That's why in every step we only pass in the latest predicted token and let it attend to the cached keys/values.
 
-    # Initial prompt is the beginning/start of the sentence token. Make it compatible shape with source batch => (B,1)
-    target_sentences_tokens = [[BOS_TOKEN] for _ in range(src_representations_batch.shape[0])]
-    trg_token_ids_batch = torch.tensor([[trg_field_processor.vocab.stoi[tokens[0]]] for tokens in target_sentences_tokens], device=device)
+    Sentences which reached the EOS token (or their max length) are removed from the batch so that they don't slow down
+    the remaining ones. The max length is max_target_tokens or, if max_length_coefficients=(a, b) are given,
+    min(a * S + b, max_target_tokens), where S is the number of source tokens of that particular sentence.
 
-    # Set to true for a particular target sentence once it reaches the EOS (end-of-sentence) token
-    is_decoded = [False] * src_representations_batch.shape[0]
+    Optionally we only score the target tokens from the vocab shortlist (see shortlist_utils.py).
 
-    while True:
-        trg_mask, _ = get_masks_and_count_tokens_trg(trg_token_ids_batch, pad_token_id)
-        # Shape = (B*T, V) where T is the current token-sequence length and V target vocab size
-        predicted_log_distributions = baseline_transformer.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask)
+    """
 
-        # Extract only the indices of last token for every target sentence (we take every T-th token)
-        num_of_trg_tokens = len(target_sentences_tokens[0])
-        predicted_log_distributions = predicted_log_distributions[num_of_trg_tokens-1::num_of_trg_tokens]
+    device = next(baseline_transformer.parameters()).device
+    pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
+    eos_token_id = trg_field_processor.vocab.stoi[EOS_TOKEN]
+    batch_size = src_representations_batch.shape[0]
+
+    # Max number of tokens we'll predict for a particular target sentence (not counting the BOS token)
+    max_target_tokens_per_sentence = [max_target_tokens] * batch_size
+    if max_length_coefficients is not None:
+        a, b = max_length_coefficients
+        num_src_tokens_per_sentence = src_mask.view(batch_size, -1).sum(dim=-1).tolist()
+        max_target_tokens_per_sentence = [max(1, min(int(a * num_src_tokens + b), max_target_tokens)) for num_src_tokens in num_src_tokens_per_sentence]
+    longest_target_sentence = max(max_target_tokens_per_sentence)
+
+    # Everything lives on the device and is allocated only once (except when we remove the fully decoded sentences),
+    # token ids are converted into tokens only once at the very end. Notation: B - batch size, T - max target length
+    # Predicted token ids (B, T+1) in the original batch order, initial prompt is the beginning of the sentence token
+    trg_token_ids_batch = torch.full((batch_size, longest_target_sentence + 1), pad_token_id, dtype=torch.long, device=device)
+    trg_token_ids_batch[:, 0] = trg_field_processor.vocab.stoi[BOS_TOKEN]
+    latest_token_ids_batch = trg_token_ids_batch[:, :1]
+    # The latest token can attend to all of the previous (cached) tokens and itself so we only mask the pad tokens
+    # Shape = (B, 1, 1, T+1) - we slice the first t columns, it's the last row of get_masks_and_count_tokens_trg's mask
+    trg_mask_buffer = torch.zeros((batch_size, 1, 1, longest_target_sentence + 1), dtype=torch.bool, device=device)
+    trg_mask_buffer[..., 0] = True
+
+    is_decoded = torch.zeros(batch_size, dtype=torch.bool, device=device)  # sentence reached EOS or its max length
+    max_target_tokens_per_sentence_tensor = torch.tensor(max_target_tokens_per_sentence, device=device)
+    # Sentences which are still being decoded, maps the (active) batch back to the position in the original batch
+    sentence_indices = torch.arange(batch_size, device=device)
+
+    # Checking whether we're done forces the host to wait for the device, so we only do it every few steps (sentences
+    # which are already decoded just keep on going in the meantime, their extra tokens are discarded at the end)
+    num_steps_between_syncs = 8
+
+    # Keys/values of the already decoded tokens, every decode call appends the ones belonging to the newest token.
+    # Source-attending MHA keys/values are computed here only once as source representations don't change.
+    decoder_cache = baseline_transformer.init_decoder_cache(src_representations_batch)
+
+    # With a vocab shortlist (see shortlist_utils.py) the decoder generator only projects into the shortlisted target
+    # tokens, the same shortlist is used for every step so its weight rows get selected only once
+    shortlist_linear = None if vocab_shortlist is None else baseline_transformer.decoder_generator.get_shortlist_linear(vocab_shortlist)
+
+    for num_of_trg_tokens in range(1, longest_target_sentence + 1):
+        # Shape = (B, V) as we only pass in the latest token of every target sentence, V is the target vocab size
+        trg_mask = trg_mask_buffer[..., :num_of_trg_tokens]
+        predicted_log_distributions = baseline_transformer.decode(latest_token_ids_batch, src_representations_batch, trg_mask, src_mask, decoder_cache, 'last', shortlist_linear)
 
         # This is the "greedy" part of the greedy decoding:
         # We find indices of the highest probability target tokens and discard every other possibility
-        most_probable_last_token_indices = torch.argmax(predicted_log_distributions, dim=-1).cpu().numpy()
-
-        # Find target tokens associated with these indices
-        predicted_words = [trg_field_processor.vocab.itos[index] for index in most_probable_last_token_indices]
-
-        for idx, predicted_word in enumerate(predicted_words):
-            target_sentences_tokens[idx].append(predicted_word)
-
-            if predicted_word == EOS_TOKEN:  # once we find EOS token for a particular sentence we flag it
-                is_decoded[idx] = True
-
-        if all(is_decoded) or num_of_trg_tokens == max_target_tokens:
-            break
-
-        # Prepare the input for the next iteration (merge old token ids with the new column of most probable token ids)
-        trg_token_ids_batch = torch.cat((trg_token_ids_batch, torch.unsqueeze(torch.tensor(most_probable_last_token_indices, device=device), 1)), 1)
+        most_probable_last_token_indices = torch.argmax(predicted_log_distributions, dim=-1)
+        if vocab_shortlist is not None:  # map the shortlist indices back into the target vocab ids
+            most_probable_last_token_indices = vocab_shortlist[most_probable_last_token_indices]
+
+        # Record the predictions and prepare the input for the next iteration (only the latest tokens, rest is cached)
+        trg_token_ids_batch[sentence_indices, num_of_trg_tokens] = most_probable_last_token_indices
+        trg_mask_buffer[:, 0, 0, num_of_trg_tokens] = most_probable_last_token_indices != pad_token_id
+        latest_token_ids_batch = most_probable_last_token_indices.unsqueeze(1)
+        is_decoded |= (most_probable_last_token_indices == eos_token_id) | (max_target_tokens_per_sentence_tensor <= num_of_trg_tokens)
+
+        if num_of_trg_tokens % num_steps_between_syncs == 0:
+            if is_decoded.all():
+                break
 
-    # Post process the sentences - remove everything after the EOS token
+            # Remove the fully decoded sentences from the batch
+            if is_decoded.any():
+                active_positions = (~is_decoded).nonzero().squeeze(1)
+                sentence_indices = sentence_indices.index_select(0, active_positions)
+                latest_token_ids_batch = latest_token_ids_batch.index_select(0, active_positions)
+                trg_mask_buffer = trg_mask_buffer.index_select(0, active_positions)
+                is_decoded = is_decoded.index_select(0, active_positions)
+                max_target_tokens_per_sentence_tensor = max_target_tokens_per_sentence_tensor.index_select(0, active_positions)
+                src_representations_batch = src_representations_batch.index_select(0, active_positions)
+                src_mask = src_mask.index_select(0, active_positions)
+                decoder_cache.reorder(active_positions)
+
+    # Post process the sentences - convert ids into tokens and remove everything after the EOS token/max length
     target_sentences_tokens_post = []
-    for target_sentence_tokens in target_sentences_tokens:
+    for token_ids, max_target_tokens_of_sentence in zip(trg_token_ids_batch.tolist(), max_target_tokens_per_sentence):
+        target_sentence_tokens = [trg_field_processor.vocab.itos[token_id] for token_id in token_ids[:max_target_tokens_of_sentence + 1]]
         try:
             target_index = target_sentence_tokens.index(EOS_TOKEN) + 1
         except:
@@ -91,113 +134,126 @@ def get_beam_decoder(translation_config):
     sequence is constructed by multiplying the conditional probabilities (which are numbers smaller than 1) the beam
     search algorithm will prefer shorter sentences which we compensate for using the length penalty.
 
+    All of the hypotheses (beam_size of them for every source sentence in the batch) are kept in tensors and are
+    expanded/pruned with a single topk per decoding step - no Python loops over the hypotheses.
+
     """
     beam_size = translation_config['beam_size']
     length_penalty_coefficient = translation_config['length_penalty_coefficient']
 
-    def beam_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor, max_target_tokens=100):
-        raise Exception('Not yet implemented.')
+    # GNMT's length penalty lp(Y) = ((5 + |Y|) / 6) ^ alpha, hypotheses are compared using log P(Y|X) / lp(Y)
+    def length_penalty(lengths):
+        return ((5. + lengths) / 6.) ** length_penalty_coefficient
+
+    def beam_decoding(baseline_transformer, src_representations_batch, src_mask, trg_field_processor, max_target_tokens=100, vocab_shortlist=None):
         device = next(baseline_transformer.parameters()).device
         pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
+        eos_token_id = trg_field_processor.vocab.stoi[EOS_TOKEN]
+        bos_token_id = trg_field_processor.vocab.stoi[BOS_TOKEN]
 
-        # Initial prompt is the beginning/start of the sentence token. Make it compatible shape with source batch => (B,1)
-        batch_size, S, model_dimension = src_representations_batch.shape
-        target_multiple_hypotheses_tokens = [[BOS_TOKEN] for _ in range(batch_size)]
-        trg_token_ids_batch = torch.tensor([[trg_field_processor.vocab.stoi[tokens[0]]] for tokens in target_multiple_hypotheses_tokens], device=device)
+        batch_size = src_representations_batch.shape[0]
+        vocab_size = len(trg_field_processor.vocab)
+
+        # With a vocab shortlist (see shortlist_utils.py) we only score K target tokens, K - shortlist size, so V becomes
+        # K in the comments below and the shortlist indices have to be mapped back into the target vocab ids
+        pad_index = pad_token_id
+        shortlist_linear = None
+        if vocab_shortlist is not None:
+            vocab_size = vocab_shortlist.shape[0]
+            pad_index = (vocab_shortlist == pad_token_id).nonzero().item()
+            shortlist_linear = baseline_transformer.decoder_generator.get_shortlist_linear(vocab_shortlist)  # once per batch
 
         # Repeat so that source sentence representations are repeated contiguously, say we have [s1, s2] we want
         # [s1, s1, s2, s2] and not [s1, s2, s1, s2] where s1 is single sentence representation with shape=(S, D)
-        # where S - max source token-sequence length, D - model dimension
-        src_representations_batch = src_representations_batch.repeat(1, beam_size, 1).view(beam_size*batch_size, -1, model_dimension)
-        trg_token_ids_batch = trg_token_ids_batch.repeat(beam_size, 1)
-
-        hypotheses_log_probs = torch.zeros((batch_size * beam_size, 1), device=device)
-        had_eos = [[False] for _ in range(hypotheses_log_probs.shape[0])]
-
-        while True:
-            trg_mask, _ = get_masks_and_count_tokens_trg(trg_token_ids_batch, pad_token_id)
-            # Shape = (B*BS*T, V) T - current token-sequence length, V - target vocab size, BS - beam size, B - batch
-            predicted_log_distributions = baseline_transformer.decode(trg_token_ids_batch, src_representations_batch, trg_mask, src_mask)
-
-            # Extract only the indices of last token for every target sentence (we take every T-th token)
-            # Shape = (B*BS, V)
-            num_of_trg_tokens = trg_token_ids_batch.shape[-1]
-            predicted_log_distributions = predicted_log_distributions[num_of_trg_tokens - 1::num_of_trg_tokens]
-
-            # This time extract beam_size number of highest probability tokens (compare to greedy's arg max)
-            # Shape = (B*BS, BS)
-            latest_token_log_probs, most_probable_token_indices = torch.topk(predicted_log_distributions, beam_size, dim=-1, sorted=True)
-
-            # Don't update the hypothesis which had EOS already (pruning)
-            latest_token_log_probs.masked_fill(torch.tensor(had_eos == True), float("-inf"))
-
-            # Calculate probabilities for every beam hypothesis (since we have log prob we add instead of multiply)
-            # Shape = (B*BS, BS)
-            hypotheses_pool_log_probs = hypotheses_log_probs + latest_token_log_probs
-            # Shape = (B, BS, BS)
-            most_probable_token_indices = most_probable_token_indices.view(batch_size, beam_size, beam_size)
-            hypotheses_pool_log_probs = hypotheses_pool_log_probs.view(batch_size, beam_size, beam_size)
-            # Shape = (B, BS*BS)
-            hypotheses_pool_log_probs = torch.flatten(hypotheses_pool_log_probs, start_dim=-1)
-
-            # Figure out indices of beam_size most probably hypothesis for every target sentence in the batch
+        # where S - max source token-sequence length, D - model dimension. Same goes for the decoder cache.
+        # Notation: B - batch size, BS - beam size, V - target vocab size, T - current target token-sequence length
+        hypotheses_source_indices = torch.arange(batch_size, device=device).repeat_interleave(beam_size)
+        decoder_cache = baseline_transformer.init_decoder_cache(src_representations_batch)
+        decoder_cache.reorder(hypotheses_source_indices)
+        src_representations_batch = src_representations_batch.index_select(0, hypotheses_source_indices)
+        src_mask = src_mask.index_select(0, hypotheses_source_indices)
+
+        # Shape = (B*BS, T), every hypothesis starts with the beginning/start of the sentence token
+        trg_token_ids_batch = torch.full((batch_size * beam_size, 1), bos_token_id, dtype=torch.long, device=device)
+
+        # Cumulative log probabilities, lengths and EOS flags of every hypothesis, shape = (B*BS, 1)
+        # Only the first hypothesis of every sentence is "alive" initially, otherwise we'd end up with BS identical beams
+        hypotheses_log_probs = torch.full((batch_size, beam_size), float("-inf"), device=device)
+        hypotheses_log_probs[:, 0] = 0.
+        hypotheses_log_probs = hypotheses_log_probs.view(-1, 1)
+        hypotheses_lengths = torch.zeros((batch_size * beam_size, 1), device=device)
+        had_eos = torch.zeros((batch_size * beam_size, 1), dtype=torch.bool, device=device)
+
+        # Sentences get removed from the (active) batch once all of their hypotheses had EOS, this maps the active
+        # sentences back to their position in the original batch
+        sentence_indices = torch.arange(batch_size, device=device)
+        best_hypotheses = [None] * batch_size
+
+        for _ in range(max_target_tokens):
+            num_active_sentences = sentence_indices.shape[0]
+
+            # Shape = (B*BS, V), we only pass in the latest token of every hypothesis - the rest is cached
+            predicted_log_distributions = baseline_transformer.decode(trg_token_ids_batch[:, -1:], src_representations_batch, None, src_mask, decoder_cache, 'last', shortlist_linear)
+            predicted_log_distributions[:, pad_index] = float("-inf")  # pad is reserved for the finished hypotheses
+
+            # Hypotheses which had EOS already can only be extended with the pad token which doesn't change their score
+            predicted_log_distributions.masked_fill_(had_eos, float("-inf"))
+            predicted_log_distributions[:, pad_index].masked_fill_(had_eos.squeeze(1), 0.)
+
+            # Calculate probabilities for every expanded hypothesis (since we have log prob we add instead of multiply)
+            # and compare them after normalizing with the length penalty. Shape = (B, BS*V)
+            candidates_log_probs = hypotheses_log_probs + predicted_log_distributions
+            candidates_lengths = hypotheses_lengths + (~had_eos).float()
+            candidates_scores = (candidates_log_probs / length_penalty(candidates_lengths)).view(num_active_sentences, -1)
+
+            # Figure out indices of beam_size most probable expanded hypotheses for every target sentence in the batch
             # Shape = (B, BS)
-            new_hypothesis_log_probs, next_hypothesis_indices = torch.topk(hypotheses_pool_log_probs, beam_size, dim=-1, sorted=True)
-
-            # Create new target ids batch
-            hypotheses_log_probs_tmp = torch.empty((batch_size * beam_size, 1))
-
-            T = trg_token_ids_batch.shape[-1]
-            new_trg_token_ids_batch = torch.empty((batch_size * beam_size, T + 1))
-
-            next_hypothesis_indices = next_hypothesis_indices.cpu().numpy()
-            # Prepare new hypotheses for the next iteration
-            for b_idx, indices in enumerate(next_hypothesis_indices):
-                for h_idx, token_index in indices:
-                    row, column = token_index / beam_size, token_index % beam_size
-                    hypothesis_index = b_idx * beam_size + h_idx
-
-                    new_token_id = most_probable_token_indices[b_idx, row, column]
-                    if had_eos[hypothesis_index]:
-                        new_trg_token_ids_batch[hypothesis_index, :-1] = trg_token_ids_batch[hypothesis_index, :]
-                    else:
-                        new_trg_token_ids_batch[hypothesis_index, :-1] = trg_token_ids_batch[b_idx * beam_size + row, :]
-                        new_trg_token_ids_batch[hypothesis_index, -1] = new_token_id
-
-                    if had_eos[hypothesis_index]:
-                        hypotheses_log_probs_tmp[hypothesis_index] = hypotheses_log_probs[hypothesis_index]
-                    else:
-                        hypotheses_log_probs_tmp[hypothesis_index] = new_hypothesis_log_probs[hypothesis_index]
-
-                    if new_token_id == trg_field_processor.vocab.stoi[EOS_TOKEN]:
-                        had_eos[hypothesis_index] = True
-
-            # Update the current hypothesis probabilities
-            hypotheses_log_probs = hypotheses_log_probs_tmp
-            trg_token_ids_batch = new_trg_token_ids_batch
-
-            if all(had_eos) or num_of_trg_tokens == max_target_tokens:
-                break
+            _, candidates_indices = torch.topk(candidates_scores, beam_size, dim=-1, sorted=True)
+            parent_hypotheses_indices = (candidates_indices // vocab_size) + (torch.arange(num_active_sentences, device=device) * beam_size).unsqueeze(1)
+            parent_hypotheses_indices = parent_hypotheses_indices.view(-1)
+            new_token_ids = (candidates_indices % vocab_size).view(-1, 1)
+            if vocab_shortlist is not None:
+                new_token_ids = vocab_shortlist[new_token_ids]
+
+            # Reorder everything so that it follows the surviving hypotheses and append the newly predicted tokens
+            hypotheses_log_probs = candidates_log_probs.view(num_active_sentences, -1).gather(1, candidates_indices).view(-1, 1)
+            hypotheses_lengths = candidates_lengths.index_select(0, parent_hypotheses_indices)
+            had_eos = had_eos.index_select(0, parent_hypotheses_indices) | (new_token_ids == eos_token_id)
+            trg_token_ids_batch = torch.cat((trg_token_ids_batch.index_select(0, parent_hypotheses_indices), new_token_ids), 1)
+            decoder_cache.reorder(parent_hypotheses_indices)
+
+            # Early finishing - once all hypotheses of a sentence had EOS it can't change anymore so we remove it
+            is_decoded = had_eos.view(num_active_sentences, beam_size).all(dim=-1)
+            if is_decoded.any():
+                best_hypotheses_ids = select_best_hypotheses(trg_token_ids_batch, hypotheses_log_probs, hypotheses_lengths, is_decoded)
+                for sentence_index, hypothesis_ids in zip(sentence_indices[is_decoded].tolist(), best_hypotheses_ids):
+                    best_hypotheses[sentence_index] = hypothesis_ids
+
+                if is_decoded.all():
+                    break
+
+                active_hypotheses_indices = (~is_decoded).repeat_interleave(beam_size).nonzero().squeeze(1)
+                sentence_indices = sentence_indices[~is_decoded]
+                src_representations_batch = src_representations_batch.index_select(0, active_hypotheses_indices)
+                src_mask = src_mask.index_select(0, active_hypotheses_indices)
+                trg_token_ids_batch = trg_token_ids_batch.index_select(0, active_hypotheses_indices)
+                hypotheses_log_probs = hypotheses_log_probs.index_select(0, active_hypotheses_indices)
+                hypotheses_lengths = hypotheses_lengths.index_select(0, active_hypotheses_indices)
+                had_eos = had_eos.index_select(0, active_hypotheses_indices)
+                decoder_cache.reorder(active_hypotheses_indices)
+        else:
+            # Reached max_target_tokens, pick the best hypotheses out of the ones we have for the remaining sentences
+            best_hypotheses_ids = select_best_hypotheses(trg_token_ids_batch, hypotheses_log_probs, hypotheses_lengths, torch.ones_like(sentence_indices, dtype=torch.bool))
+            for sentence_index, hypothesis_ids in zip(sentence_indices.tolist(), best_hypotheses_ids):
+                best_hypotheses[sentence_index] = hypothesis_ids
 
         #
-        # Selection and post-processing
+        # Post-processing - convert the ids into tokens and remove everything after the EOS token (pad tokens)
         #
 
-        target_multiple_hypotheses_tokens = []
-        trg_token_ids_batch_numpy = trg_token_ids_batch.cpu().numpy()
-        for hypothesis_ids in trg_token_ids_batch_numpy:
-            target_multiple_hypotheses_tokens.append([trg_field_processor.vocab.itos[token_id] for token_id in hypothesis_ids])
-
-        # Step 1: Select the most probable hypothesis out of beam_size hypotheses for each target sentence
-        hypotheses_log_probs = hypotheses_log_probs.view(batch_size, beam_size)
-        most_probable_hypotheses_indices = torch.argmax(hypotheses_log_probs, dim=-1).cpu().numpy()
-        target_sentences_tokens = []
-        for b_idx, index in enumerate(most_probable_hypotheses_indices):
-            target_sentences_tokens.append(target_multiple_hypotheses_tokens[b_idx * beam_size + index])
-
-        # Step 2: Post process the sentences - remove everything after the EOS token
         target_sentences_tokens_post = []
-        for target_sentence_tokens in target_sentences_tokens:
+        for hypothesis_ids in best_hypotheses:
+            target_sentence_tokens = [trg_field_processor.vocab.itos[token_id] for token_id in hypothesis_ids]
             try:
                 target_index = target_sentence_tokens.index(EOS_TOKEN) + 1
             except:
@@ -208,5 +264,10 @@ def get_beam_decoder(translation_config):
 
         return target_sentences_tokens_post
 
-    return beam_decoding
+    def select_best_hypotheses(trg_token_ids_batch, hypotheses_log_probs, hypotheses_lengths, sentences_mask):
+        # Select the highest scoring hypothesis (after length penalty normalization) for every masked sentence
+        hypotheses_scores = (hypotheses_log_probs / length_penalty(hypotheses_lengths)).view(-1, beam_size)
+        best_hypotheses_indices = torch.argmax(hypotheses_scores, dim=-1) + torch.arange(hypotheses_scores.shape[0], device=hypotheses_scores.device) * beam_size
+        return trg_token_ids_batch.index_select(0, best_hypotheses_indices[sentences_mask]).tolist()
 
+    return beam_decoding
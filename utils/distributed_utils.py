@@ -0,0 +1,96 @@
+"""
+    Multi-process data parallel training (DistributedDataParallel) - every process has a replica of the model, runs
+    forward/backward on its share of the step's batches and the gradients get all-reduced (averaged) during backward,
+    so all of the replicas apply the very same update.
+
+    Uses the gloo backend on CPU so that it's testable on a single box (a process per a few cores), multiple nodes
+    work as well if you launch the training script via torchrun.
+
+"""
+
+
+import os
+import socket
+import datetime
+
+
+import torch
+import torch.distributed as dist
+
+
+def get_free_port():
+    # Let the OS pick a free port for the (single node) process group rendezvous
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def init_distributed_training(rank, world_size):
+    # MASTER_ADDR/MASTER_PORT come from the environment (set by torchrun or by the training script itself). Generous
+    # timeout as the other processes wait for the main one while it runs the validation (BLEU) at the end of an epoch
+    dist.init_process_group('gloo', rank=rank, world_size=world_size, timeout=datetime.timedelta(hours=2))
+
+    # Otherwise every process would use all of the cores and they'd fight over them
+    num_local_processes = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(os.cpu_count() // num_local_processes, 1))
+
+
+def count_trg_tokens(token_ids_batch, pad_token_id):
+    # Same as num_trg_tokens of get_masks_and_count_tokens (non-pad target input tokens) minus building the masks
+    return (token_ids_batch.trg[:, :-1] != pad_token_id).sum().item()
+
+
+def split_into_token_balanced_shards(num_tokens_per_batch, num_shards):
+    # Greedy - the batch with the most tokens goes to the shard with the fewest tokens so far (ties by the index)
+    shards = [[] for _ in range(num_shards)]
+    shard_num_tokens = [0] * num_shards
+    for batch_index in sorted(range(len(num_tokens_per_batch)), key=lambda i: -num_tokens_per_batch[i]):
+        shard_index = min(range(num_shards), key=lambda i: (shard_num_tokens[i], i))
+        shards[shard_index].append(batch_index)
+        shard_num_tokens[shard_index] += num_tokens_per_batch[batch_index]
+
+    return [sorted(shard) for shard in shards]
+
+
+def get_training_steps(token_ids_loader, pad_token_id, rank=0, world_size=1, tokens_per_step=None):
+    """
+        Groups the (bucketed) batches into optimizer steps - a step has (at least) tokens_per_step target tokens, or a
+        single batch per process if tokens_per_step is None, and splits every step's batches between the processes so
+        that each of them gets roughly the same number of target tokens (instead of the same number of sentences).
+
+        Yields (this process' batches, number of target tokens of the whole step). All of the processes iterate over the
+        same batches in the same order (same data, same shuffling seed) so they all agree on the grouping.
+
+        Note: every process needs at least a single batch per step, so if the last few batches of an epoch aren't enough
+        for that they get merged into the previous step (only dropped if the whole epoch has fewer than world_size).
+
+    """
+    def split_step(step_batches, step_num_tokens):
+        shard = split_into_token_balanced_shards(step_num_tokens, world_size)[rank]
+        return [step_batches[batch_index] for batch_index in shard], sum(step_num_tokens)
+
+    # A step is only yielded once the next one is complete, that way the epoch's leftover batches can still join it
+    previous_step = None
+    step_batches, step_num_tokens = [], []
+    for token_ids_batch in token_ids_loader:
+        step_batches.append(token_ids_batch)
+        step_num_tokens.append(count_trg_tokens(token_ids_batch, pad_token_id))
+
+        if len(step_batches) >= world_size and (tokens_per_step is None or sum(step_num_tokens) >= tokens_per_step):
+            if previous_step is not None:
+                yield split_step(*previous_step)
+            previous_step = (step_batches, step_num_tokens)
+            step_batches, step_num_tokens = [], []
+
+    # The last (partial) step of the epoch
+    if len(step_batches) >= world_size:
+        if previous_step is not None:
+            yield split_step(*previous_step)
+        previous_step = (step_batches, step_num_tokens)
+    elif len(step_batches) > 0 and previous_step is not None:
+        previous_step = (previous_step[0] + step_batches, previous_step[1] + step_num_tokens)
+    elif len(step_batches) > 0 and rank == 0:
+        print(f'Warning: dropped {len(step_batches)} batch(es) of the epoch, every one of the {world_size} processes needs at least a single batch per step.')
+
+    if previous_step is not None:
+        yield split_step(*previous_step)
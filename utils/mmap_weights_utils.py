@@ -0,0 +1,172 @@
+"""
+    Memory mapped weights - torch.load deserializes the whole pickle into freshly allocated tensors in every process.
+    This flat format gets mapped into memory instead: nothing is copied, the OS reads the pages lazily (on first touch)
+    and all of the processes that map the same file (e.g. the inference workers) share the same page cache pages.
+
+    File layout: header size (8 bytes, little endian) | JSON header | tensor data (every tensor is 64 byte aligned)
+    The header contains the training metadata (hyperparameters, vocabs... - everything but the state dict) and the
+    dtype/shape/offset of every tensor.
+
+    Reduced precision storage - fp16/bf16 halve the file size (and the page cache usage), such weights get upcast to
+    fp32 lazily i.e. a module's weights get upcast on its first forward call. Note: that fp32 copy is private to the
+    process, so by default fp16/bf16 trade the shared pages for a smaller file. With keep_upcast_weights=False (used by
+    the inference workers) the fp32 weights only exist during the module's forward call instead - every process keeps
+    sharing the reduced precision pages at the cost of upcasting the weights on every forward call.
+
+"""
+
+
+import os
+import enum
+import json
+import struct
+
+
+import numpy as np
+import torch
+from torch import nn
+
+
+from .constants import BINARIES_PATH
+
+
+class StorageDtype(enum.Enum):
+    FLOAT32 = 0,
+    FLOAT16 = 1,
+    BFLOAT16 = 2
+
+
+STORAGE_DTYPES = {
+    StorageDtype.FLOAT32.name: torch.float32,
+    StorageDtype.FLOAT16.name: torch.float16,
+    StorageDtype.BFLOAT16.name: torch.bfloat16
+}
+REDUCED_PRECISION_DTYPES = [torch.float16, torch.bfloat16]
+ALIGNMENT = 64  # bytes, enough for any SIMD load
+HEADER_SIZE_FORMAT = '<Q'
+
+
+def get_mmap_weights_path(model_name, storage_dtype_name):
+    # The artifact is stored alongside the model binary, e.g. iwslt_e2g.pth -> iwslt_e2g_float16.weights
+    return os.path.join(BINARIES_PATH, f'{os.path.splitext(model_name)[0]}_{storage_dtype_name.lower()}.weights')
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_mmap_weights(metadata, state_dict, mmap_weights_path, storage_dtype_name):
+    # Floating point tensors get stored in the storage dtype, the rest (if any) as they are
+    storage_dtype = STORAGE_DTYPES[storage_dtype_name]
+    tensors = dict()
+    tensors_info = dict()
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().to(storage_dtype if tensor.is_floating_point() else tensor.dtype).contiguous()
+        tensors[name] = tensor
+        tensors_info[name] = {"dtype": str(tensor.dtype).replace('torch.', ''), "shape": list(tensor.shape), "offset": offset}
+        offset = align(offset + tensor.numel() * tensor.element_size())
+
+    header = json.dumps({"metadata": metadata, "tensors": tensors_info}).encode('utf-8')
+    data_offset = align(struct.calcsize(HEADER_SIZE_FORMAT) + len(header))
+
+    with open(mmap_weights_path, 'wb') as weights_file:
+        weights_file.write(struct.pack(HEADER_SIZE_FORMAT, len(header)))
+        weights_file.write(header)
+        for name, tensor in tensors.items():
+            weights_file.seek(data_offset + tensors_info[name]['offset'])
+            weights_file.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+
+
+def load_mmap_weights(mmap_weights_path):
+    """
+        Returns a training state (same format as get_training_state's) whose state dict tensors point directly into
+        the memory mapped file. Use assign_mmap_weights to put them into the model (load_state_dict would copy them).
+
+    """
+    with open(mmap_weights_path, 'rb') as weights_file:
+        header_size = struct.unpack(HEADER_SIZE_FORMAT, weights_file.read(struct.calcsize(HEADER_SIZE_FORMAT)))[0]
+        header = json.loads(weights_file.read(header_size).decode('utf-8'))
+    data_offset = align(struct.calcsize(HEADER_SIZE_FORMAT) + header_size)
+
+    # Copy-on-write mapping - we never write into the weights so all of the pages stay shared with the page cache
+    file_bytes = torch.from_numpy(np.memmap(mmap_weights_path, dtype=np.uint8, mode='c'))
+
+    state_dict = dict()
+    for name, tensor_info in header['tensors'].items():
+        dtype = getattr(torch, tensor_info['dtype'])
+        num_bytes = int(np.prod(tensor_info['shape'])) * torch.tensor([], dtype=dtype).element_size()
+        start = data_offset + tensor_info['offset']
+        state_dict[name] = file_bytes[start:start + num_bytes].view(dtype).view(tensor_info['shape'])
+
+    training_state = header['metadata']
+    training_state['mmap_weights'] = True
+    training_state['state_dict'] = state_dict
+    return training_state
+
+
+def upcast_on_first_forward(module, inputs):
+    # Forward pre hook, it's a module level function (and not a closure) so that the model can still be pickled
+    if module.has_reduced_precision_weights:
+        upcast_weights(module)
+
+
+def upcast_for_forward(module, inputs):
+    # Forward pre hook - temporarily replace the module's own reduced precision weights with fp32 copies
+    module.reduced_precision_tensors = dict()
+    for tensors in [module._parameters, module._buffers]:
+        for name, tensor in tensors.items():
+            if tensor is not None and tensor.dtype in REDUCED_PRECISION_DTYPES:
+                module.reduced_precision_tensors[name] = tensor
+                tensors[name] = nn.Parameter(tensor.float(), requires_grad=False) if isinstance(tensor, nn.Parameter) else tensor.float()
+
+
+def restore_after_forward(module, inputs, output):
+    # Forward hook - put the (memory mapped) reduced precision weights back, the fp32 copies get freed
+    for name, tensor in module.reduced_precision_tensors.items():
+        if name in module._parameters:
+            module._parameters[name] = tensor
+        else:
+            module._buffers[name] = tensor
+    module.reduced_precision_tensors = None
+
+
+def upcast_weights(module):
+    # Upcast the reduced precision weights of the module and all of its submodules to fp32
+    for submodule in module.modules():
+        for tensors in [submodule._parameters, submodule._buffers]:
+            for name, tensor in tensors.items():
+                if tensor is not None and tensor.dtype in REDUCED_PRECISION_DTYPES:
+                    tensors[name] = nn.Parameter(tensor.float(), requires_grad=False) if isinstance(tensor, nn.Parameter) else tensor.float()
+        submodule.has_reduced_precision_weights = False
+
+
+def assign_mmap_weights(model, state_dict, keep_upcast_weights=True):
+    # Unlike load_state_dict this doesn't copy the tensors, the model's parameters/buffers become views into the file
+    expected_names = set(model.state_dict().keys())
+    assert set(state_dict.keys()) == expected_names, f'State dict mismatch: {set(state_dict.keys()) ^ expected_names}.'
+
+    for name, tensor in state_dict.items():
+        module_name, _, tensor_name = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[tensor_name] = tensor
+
+    # Reduced precision weights are only upcast for the duration of the forward call of the module which owns them
+    if not keep_upcast_weights:
+        for module in model.modules():
+            if any(tensor.dtype in REDUCED_PRECISION_DTYPES for tensor in list(module.parameters(recurse=False)) + list(module.buffers(recurse=False))):
+                module.register_forward_pre_hook(upcast_for_forward)
+                module.register_forward_hook(restore_after_forward)
+        return model
+
+    # Reduced precision weights get upcast lazily - every module upcasts its weights on its first forward call. It's
+    # done for the whole subtree as some modules use their submodules' weights directly (e.g. the decoder generator)
+    for module in model.modules():
+        module.has_reduced_precision_weights = any(tensor.dtype in REDUCED_PRECISION_DTYPES for tensor in list(module.parameters()) + list(module.buffers()))
+        if module.has_reduced_precision_weights:
+            module.register_forward_pre_hook(upcast_on_first_forward)
+
+    return model
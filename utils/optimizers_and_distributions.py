@@ -1,3 +1,6 @@
+import math
+
+
 import torch
 from torch import nn
 
@@ -76,6 +79,46 @@ class LabelSmoothingDistribution(nn.Module):
         return smooth_target_distributions
 
 
+class LabelSmoothingKLDivLoss(nn.Module):
+    """
+        Same value (and gradients) as nn.KLDivLoss(reduction='sum') between the predicted log distributions and
+        LabelSmoothingDistribution's smooth target distributions, but computed from the target token ids directly.
+
+        The dense (B*T, V) target distribution is never materialized - it only has 3 distinct values (confidence_value,
+        smoothing_value / (V - 2) and 0 for the pad token) so for a non-pad target token g the KL divergence becomes:
+
+            KL = sum_j t_j * log(t_j) - confidence * log_p[g] - smoothing_per_token * (sum_j log_p[j] - log_p[g] - log_p[pad])
+
+        where the first term is the same constant for every (non-pad) target token. Pad target tokens contribute 0.
+    """
+
+    def __init__(self, smoothing_value, pad_token_id, trg_vocab_size):
+        assert 0.0 <= smoothing_value <= 1.0
+
+        super(LabelSmoothingKLDivLoss, self).__init__()
+
+        self.confidence_value = 1.0 - smoothing_value
+        # -2 because the smoothing mass isn't distributed over the pad token index and over the ground truth index
+        self.smoothing_value_per_token = smoothing_value / (trg_vocab_size - 2)
+        self.pad_token_id = pad_token_id
+
+        # sum_j t_j * log(t_j) of the smooth target distribution (0 * log(0) = 0 as in nn.KLDivLoss)
+        def x_log_x(x):
+            return x * math.log(x) if x > 0 else 0.
+        self.target_distribution_term = x_log_x(self.confidence_value) + (trg_vocab_size - 2) * x_log_x(self.smoothing_value_per_token)
+
+    def forward(self, predicted_log_distributions, trg_token_ids_batch):
+        # Shapes: predicted_log_distributions (N, V), trg_token_ids_batch (N, 1)
+        ground_truth_log_probs = predicted_log_distributions.gather(1, trg_token_ids_batch).squeeze(-1)
+        pad_log_probs = predicted_log_distributions[:, self.pad_token_id]
+        smoothed_log_probs = predicted_log_distributions.sum(dim=-1) - ground_truth_log_probs - pad_log_probs
+
+        kl_divergences = self.target_distribution_term - self.confidence_value * ground_truth_log_probs - self.smoothing_value_per_token * smoothed_log_probs
+
+        # If we had a pad token as a target the target distribution is all 0s and so is the KL divergence
+        return kl_divergences.masked_fill(trg_token_ids_batch.squeeze(-1) == self.pad_token_id, 0.).sum()
+
+
 class OneHotDistribution(nn.Module):
     """
         Create a one hot distribution (feel free to ignore used only in playground.py)
@@ -98,3 +141,30 @@ class OneHotDistribution(nn.Module):
         one_hot_distribution.masked_fill_(trg_token_ids_batch == self.pad_token_id, 0.)
 
         return one_hot_distribution
+
+
+# Verify that LabelSmoothingKLDivLoss matches the dense target distribution + nn.KLDivLoss (value and gradients)
+if __name__ == "__main__":
+    pad_token_id = 1
+    trg_vocab_size = 13
+    num_of_trg_tokens = 20
+
+    for dtype, tolerance in [(torch.float64, 1e-9), (torch.float32, 1e-4)]:
+        torch.set_default_dtype(dtype)  # LabelSmoothingDistribution allocates its distributions in the default dtype
+        logits = torch.randn((num_of_trg_tokens, trg_vocab_size), dtype=dtype)
+        trg_token_ids_batch = torch.randint(0, trg_vocab_size, size=(num_of_trg_tokens, 1))
+        trg_token_ids_batch[::4] = pad_token_id  # pad target tokens (their rows must contribute nothing)
+        trg_token_ids_batch[1] = 0  # ground truth token which is next to the pad token
+
+        smooth_target_distributions = LabelSmoothingDistribution(0.1, pad_token_id, trg_vocab_size, device='cpu')(trg_token_ids_batch)
+        losses_and_gradients = []
+        for loss_fn in [lambda log_probs: nn.KLDivLoss(reduction='sum')(log_probs, smooth_target_distributions), lambda log_probs: LabelSmoothingKLDivLoss(0.1, pad_token_id, trg_vocab_size)(log_probs, trg_token_ids_batch)]:
+            logits.grad = None
+            logits.requires_grad_(True)
+            loss = loss_fn(logits.log_softmax(dim=-1))
+            loss.backward()
+            losses_and_gradients.append((loss.detach(), logits.grad.clone()))
+
+        (reference_loss, reference_gradients), (loss, gradients) = losses_and_gradients
+        print(f'{dtype}: loss {loss.item():.9f} vs {reference_loss.item():.9f}, max gradient difference {(gradients - reference_gradients).abs().max().item():.2e}, pad rows have 0 gradients: {gradients[::4].abs().max().item() == 0}')
+        assert torch.allclose(loss, reference_loss, rtol=tolerance, atol=tolerance) and torch.allclose(gradients, reference_gradients, rtol=tolerance, atol=tolerance)
@@ -0,0 +1,47 @@
+"""
+    Int8 dynamic quantization for (CPU) inference.
+
+    Weights of all of the linear layers (MHA projections, point-wise feed forward nets and the decoder generator) are
+    stored as int8 and activations get quantized on the fly (per batch) which makes the matrix multiplications faster
+    and the model ~4x smaller. Embeddings and LayerNorms stay in fp32.
+
+    Note: PyTorch's quantized kernels only run on the CPU.
+
+"""
+
+
+import os
+
+
+import torch
+from torch import nn
+
+
+from .constants import BINARIES_PATH
+
+
+def get_quantized_model_path(model_name):
+    # The quantized artifact is stored alongside the fp32 model binary, e.g. iwslt_e2g.pth -> iwslt_e2g_int8.pth
+    return os.path.join(BINARIES_PATH, f'{os.path.splitext(model_name)[0]}_int8.pth')
+
+
+def quantize_transformer(baseline_transformer):
+    # Returns a quantized copy, the original (fp32) model is left untouched
+    return torch.quantization.quantize_dynamic(baseline_transformer.eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized_transformer(training_state, quantized_transformer, quantized_model_path):
+    # Keep the training metadata of the fp32 model, only swap the state dict (it contains int8 packed weights now)
+    quantized_training_state = {key: value for key, value in training_state.items() if key != 'state_dict'}
+    quantized_training_state['quantized'] = True
+    quantized_training_state['state_dict'] = quantized_transformer.state_dict()
+
+    torch.save(quantized_training_state, quantized_model_path)
+
+
+def load_quantized_transformer(baseline_transformer, quantized_training_state):
+    # The (freshly constructed fp32) model has to be quantized first so that it has the same structure as the artifact
+    quantized_transformer = quantize_transformer(baseline_transformer)
+    quantized_transformer.load_state_dict(quantized_training_state['state_dict'], strict=True)
+
+    return quantized_transformer
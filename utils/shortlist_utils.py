@@ -0,0 +1,123 @@
+"""
+    Lexical shortlist - only a small subset of the target vocabulary is a plausible translation of a given source sentence.
+
+    For every source token we keep a handful of target tokens which most often co-occur with it in the training data
+    (ranked using the Dice coefficient so that frequent words like "the" don't end up being a candidate for everything).
+    During decoding, the decoder generator only scores the union of the candidates of all the source tokens in the batch
+    plus the most frequent target tokens (and the special tokens) instead of the whole target vocabulary.
+
+"""
+
+
+import os
+import time
+import heapq
+from collections import Counter, defaultdict
+
+
+import torch
+
+
+from .constants import BINARIES_PATH, BOS_TOKEN, EOS_TOKEN, PAD_TOKEN
+from .data_utils import get_cache_paths, DatasetType
+
+
+def get_shortlist_path(model_name):
+    # The shortlist is persisted alongside the model binary, e.g. iwslt_e2g.pth -> iwslt_e2g_shortlist.pth
+    return os.path.join(BINARIES_PATH, f'{os.path.splitext(model_name)[0]}_shortlist.pth')
+
+
+def build_lexical_shortlist(train_cache_path, num_candidates_per_token=50, num_frequent_tokens=500):
+    ts = time.time()
+
+    # Count in how many sentence pairs did a particular source/target token (pair) occur
+    src_counts = Counter()
+    trg_counts = Counter()
+    co_occurrence_counts = defaultdict(Counter)
+    with open(train_cache_path, encoding='utf-8') as cache_file:
+        # save_cache interleaves src and trg examples, source is on even lines, target is on odd lines
+        for src_line, trg_line in zip(cache_file, cache_file):
+            src_tokens, trg_tokens = set(src_line.split()), set(trg_line.split())
+            src_counts.update(src_tokens)
+            trg_counts.update(trg_tokens)
+            for src_token in src_tokens:
+                co_occurrence_counts[src_token].update(trg_tokens)
+
+    # Dice coefficient = 2 * c(src, trg) / (c(src) + c(trg)), keep only the best candidates for every source token
+    candidates = {}
+    for src_token, trg_token_counts in co_occurrence_counts.items():
+        candidates[src_token] = heapq.nlargest(
+            num_candidates_per_token,
+            trg_token_counts.keys(),
+            key=lambda trg_token: 2 * trg_token_counts[trg_token] / (src_counts[src_token] + trg_counts[trg_token])
+        )
+
+    print(f'Time it took to build the lexical shortlist: {time.time() - ts:3f} seconds.')
+
+    return {
+        "num_candidates_per_token": num_candidates_per_token,
+        "candidates": candidates,
+        "frequent_trg_tokens": [trg_token for trg_token, _ in trg_counts.most_common(num_frequent_tokens)]
+    }
+
+
+class LexicalShortlist:
+    """
+        Maps the (token string based) shortlist onto the src/trg vocab ids so that picking the shortlist for a batch
+        is just a single lookup followed by torch.unique.
+
+        num_candidates_per_token can be used to use less candidates than what the shortlist was built with
+        (handy for exploring the BLEU/speed trade-off without rebuilding the shortlist).
+
+    """
+
+    def __init__(self, shortlist_state, src_vocab, trg_vocab, device, num_candidates_per_token=None):
+        if num_candidates_per_token is None:
+            num_candidates_per_token = shortlist_state['num_candidates_per_token']
+        eos_token_id = trg_vocab.stoi[EOS_TOKEN]
+
+        # Shape = (source vocab size, number of candidates), unknown/missing candidates just point to the EOS token.
+        # Note: using .get as vocab's stoi is a defaultdict and we don't want to add new entries into it
+        candidates_table = torch.full((len(src_vocab), num_candidates_per_token), eos_token_id, dtype=torch.long)
+        for src_token, trg_tokens in shortlist_state['candidates'].items():
+            src_token_id = src_vocab.stoi.get(src_token)
+            if src_token_id is None:
+                continue
+            trg_token_ids = [trg_vocab.stoi.get(trg_token) for trg_token in trg_tokens[:num_candidates_per_token]]
+            trg_token_ids = [trg_token_id for trg_token_id in trg_token_ids if trg_token_id is not None]
+            candidates_table[src_token_id, :len(trg_token_ids)] = torch.tensor(trg_token_ids, dtype=torch.long)
+        self.candidates_table = candidates_table.to(device)
+
+        # Special tokens (pad is needed by beam search for the finished hypotheses) and the most frequent target tokens
+        special_tokens = [trg_vocab.itos[0], PAD_TOKEN, BOS_TOKEN, EOS_TOKEN]  # itos[0] is the unknown token
+        always_included_tokens = special_tokens + shortlist_state['frequent_trg_tokens']
+        always_included_ids = [trg_vocab.stoi.get(trg_token) for trg_token in always_included_tokens]
+        self.always_included_ids = torch.tensor([trg_token_id for trg_token_id in always_included_ids if trg_token_id is not None], dtype=torch.long, device=device)
+
+    def get_vocab_shortlist(self, src_token_ids_batch):
+        # Union of candidates of all the source tokens in the batch, sorted ids of shape (K,), K - shortlist size
+        candidate_ids = self.candidates_table[src_token_ids_batch].view(-1)
+        return torch.unique(torch.cat((candidate_ids, self.always_included_ids)))
+
+
+def get_lexical_shortlist_state(translation_config):
+    shortlist_path = get_shortlist_path(translation_config['model_name'])
+
+    if os.path.exists(shortlist_path):
+        shortlist_state = torch.load(shortlist_path)
+    else:
+        print(f'Lexical shortlist {shortlist_path} does not exist, building it from the cached training data.')
+        train_cache_path, _, _ = get_cache_paths(
+            translation_config['dataset_path'],
+            translation_config['language_direction'],
+            translation_config['dataset_name'] == DatasetType.IWSLT.name
+        )
+        shortlist_state = build_lexical_shortlist(train_cache_path)
+        torch.save(shortlist_state, shortlist_path)
+
+    return shortlist_state
+
+
+def get_lexical_shortlist(translation_config, src_field_processor, trg_field_processor, device):
+    shortlist_state = get_lexical_shortlist_state(translation_config)
+    return LexicalShortlist(shortlist_state, src_field_processor.vocab, trg_field_processor.vocab, device)
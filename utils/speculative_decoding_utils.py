@@ -0,0 +1,282 @@
+"""
+    Speculative greedy decoding - greedy decoding emits a single token per (full) decoder pass, here a cheap proposer
+    drafts k tokens and the main model verifies all of them with a single decode call.
+
+    Verification: we pass in the latest token followed by the k draft tokens and the main model predicts the next
+    token at every one of those k + 1 positions. Draft tokens are accepted as long as they match the main model's
+    predictions (so the output is the same as greedy_decoding's) and we get one more token for free - the main model's
+    prediction following the last accepted draft token. In the worst case (nothing gets accepted) it's a greedy step.
+
+    Every sentence keeps its own longest accepted prefix so the sentences in the batch advance at different speeds.
+    Same as with continuous batching (see continuous_batching_utils.py) every sentence has its own position and the
+    cached target keys/values are left padded, the rejected draft tokens get dropped from the cache (see
+    RaggedDecoderCache). Fully decoded sentences get removed from the batch.
+
+    Proposers:
+        * NgramProposer - looks up the last few tokens in the source sentence (names, numbers, ... get copied) and in
+          the previous output, and proposes the tokens which followed them. Basically free.
+        * DraftModelProposer - a smaller Transformer (e.g. fewer layers) trained on the same vocabs drafts the tokens.
+
+"""
+
+
+import torch
+
+
+from .constants import *
+
+
+# Marks the left padding (and the right padding of the new tokens) in RaggedDecoderCache's target token ids
+NO_TOKEN_ID = -1
+
+
+class RaggedDecoderCache:
+    """
+        Decoder cache for sentences which advance by a different number of tokens per decode call. Target keys/values
+        of every sentence are aligned to the right (left padded) and the decoder cache's positions hold the position of
+        the next token of every sentence. Target token ids are kept (per sentence) so that we know what's cached.
+
+    """
+
+    def __init__(self, transformer, src_representations_batch, src_mask, pad_token_id):
+        self.transformer = transformer
+        self.src_mask = src_mask
+        self.pad_token_id = pad_token_id
+        self.device = src_mask.device
+
+        batch_size = src_representations_batch.shape[0]
+        self.decoder_cache = transformer.init_decoder_cache(src_representations_batch)
+        self.decoder_cache.positions = torch.zeros(batch_size, dtype=torch.long, device=self.device)
+        self.cached_token_ids = [[] for _ in range(batch_size)]  # tokens whose keys/values are cached, per sentence
+        # Shape = (B, T), cached token ids aligned to the right, NO_TOKEN_ID for the padding
+        self.trg_token_ids_batch = torch.full((batch_size, 0), NO_TOKEN_ID, dtype=torch.long, device=self.device)
+
+    def decode(self, new_token_ids, generator_positions='last'):
+        """
+            Passes the new tokens (list of token id lists, one per sentence) into the decoder and caches them. Sentences
+            with fewer new tokens get right padded - the padding comes after the real tokens so nobody can attend to it
+            (no look forward) and it gets dropped from the cache right away. generator_positions is None (all of the
+            positions, shape (B*N, V)) or 'last' (last new token of every sentence, shape (B, V)).
+
+        """
+        # Notation: B - batch size, T - number of cached tokens, N - max number of new tokens
+        num_new_tokens = [len(token_ids) for token_ids in new_token_ids]
+        max_num_new_tokens = max(num_new_tokens)
+        new_token_ids_batch = torch.tensor([token_ids + [self.pad_token_id] * (max_num_new_tokens - len(token_ids)) for token_ids in new_token_ids], dtype=torch.long, device=self.device)
+        num_new_tokens_batch = torch.tensor(num_new_tokens, device=self.device)
+        is_new_token = torch.arange(max_num_new_tokens, device=self.device) < num_new_tokens_batch.unsqueeze(1)
+
+        # New tokens can't look ahead, nobody can attend to the padding and the pad tokens (same as greedy decoding)
+        num_cached_tokens = self.trg_token_ids_batch.shape[1]
+        self.trg_token_ids_batch = torch.cat((self.trg_token_ids_batch, torch.where(is_new_token, new_token_ids_batch, NO_TOKEN_ID)), dim=1)
+        no_look_forward_mask = torch.tril(torch.ones((max_num_new_tokens, num_cached_tokens + max_num_new_tokens), dtype=torch.bool, device=self.device), diagonal=num_cached_tokens)
+        trg_padding_mask = (self.trg_token_ids_batch != NO_TOKEN_ID) & (self.trg_token_ids_batch != self.pad_token_id)
+        trg_mask = trg_padding_mask.view(len(new_token_ids), 1, 1, -1) & no_look_forward_mask
+
+        is_ragged = min(num_new_tokens) < max_num_new_tokens
+        if generator_positions == 'last' and is_ragged:
+            generator_positions = torch.arange(max_num_new_tokens, device=self.device) == (num_new_tokens_batch - 1).unsqueeze(1)
+
+        predicted_log_distributions = self.transformer.decode(new_token_ids_batch, None, trg_mask, self.src_mask, self.decoder_cache, generator_positions)
+
+        self.cached_token_ids = [cached_token_ids + token_ids for cached_token_ids, token_ids in zip(self.cached_token_ids, new_token_ids)]
+        if is_ragged:
+            self.compact(self.trg_token_ids_batch != NO_TOKEN_ID)
+        else:
+            self.decoder_cache.positions = self.decoder_cache.positions.new_tensor([len(token_ids) for token_ids in self.cached_token_ids])
+
+        return predicted_log_distributions
+
+    def truncate(self, num_tokens_to_keep):
+        # Keep only the first num_tokens_to_keep (list, one per sentence) cached tokens, e.g. drop the rejected drafts
+        if all(num_tokens == len(token_ids) for num_tokens, token_ids in zip(num_tokens_to_keep, self.cached_token_ids)):
+            return
+
+        self.cached_token_ids = [token_ids[:num_tokens] for token_ids, num_tokens in zip(self.cached_token_ids, num_tokens_to_keep)]
+        is_token = self.trg_token_ids_batch != NO_TOKEN_ID
+        num_tokens_to_keep = torch.tensor(num_tokens_to_keep, device=self.device).unsqueeze(1)
+        self.compact(is_token & (is_token.long().cumsum(dim=1) <= num_tokens_to_keep))
+
+    def compact(self, keep_mask):
+        indices = self.decoder_cache.compact_trg(keep_mask)
+        self.trg_token_ids_batch = torch.where(keep_mask.gather(1, indices), self.trg_token_ids_batch.gather(1, indices), NO_TOKEN_ID)
+        # Positions start at 0 (BOS token) so the next position is the number of cached tokens
+        self.decoder_cache.positions = self.decoder_cache.positions.new_tensor([len(token_ids) for token_ids in self.cached_token_ids])
+
+    def reorder(self, indices):
+        self.src_mask = self.src_mask.index_select(0, indices)
+        self.trg_token_ids_batch = self.trg_token_ids_batch.index_select(0, indices)
+        self.cached_token_ids = [self.cached_token_ids[index] for index in indices.tolist()]
+        self.decoder_cache.reorder(indices)
+
+
+class NgramProposer:
+
+    def __init__(self, src_vocab, trg_vocab, max_ngram_size=3):
+        self.max_ngram_size = max_ngram_size
+        self.pad_token_id = trg_vocab.stoi[PAD_TOKEN]
+
+        # Source and target vocabs are different, tokens which exist in both of them (same string) can be copied.
+        # Note: using .get as vocab's stoi is a defaultdict and we don't want to add new entries into it
+        self.src_to_trg_token_ids = [trg_vocab.stoi.get(token, None) for token in src_vocab.itos]
+        self.src_sentences = None
+        self.device = None
+
+    def start(self, src_token_ids_batch, src_mask):
+        self.device = src_token_ids_batch.device
+        num_src_tokens_per_sentence = src_mask.view(src_mask.shape[0], -1).sum(dim=-1).tolist()
+        self.src_sentences = [
+            [self.src_to_trg_token_ids[token_id] for token_id in src_token_ids[:num_src_tokens]]
+            for src_token_ids, num_src_tokens in zip(src_token_ids_batch.tolist(), num_src_tokens_per_sentence)
+        ]
+
+    def propose_for_sentence(self, src_sentence, trg_sentence, num_draft_tokens):
+        # Try the longest n-grams first, the source sentence first and then the previous output
+        for ngram_size in range(min(self.max_ngram_size, len(trg_sentence)), 0, -1):
+            ngram = trg_sentence[-ngram_size:]
+            for reference in [src_sentence, trg_sentence[:-1]]:
+                for i in range(len(reference) - ngram_size):
+                    if reference[i:i+ngram_size] == ngram:
+                        draft = reference[i+ngram_size:i+ngram_size+num_draft_tokens]
+                        if None in draft:  # source tokens which don't exist in the target vocab
+                            draft = draft[:draft.index(None)]
+                        if len(draft) > 0:
+                            return draft
+        return []
+
+    def propose(self, trg_token_ids, num_draft_tokens):
+        # trg_token_ids - the output so far (list of token id lists, one per sentence), returns shape (B, K)
+        drafts = [self.propose_for_sentence(src_sentence, trg_sentence, num_draft_tokens) for src_sentence, trg_sentence in zip(self.src_sentences, trg_token_ids)]
+
+        # Sentences with shorter (or no) drafts are padded with pad tokens, those (almost) never get accepted
+        num_draft_tokens = max(len(draft) for draft in drafts)
+        drafts = [draft + [self.pad_token_id] * (num_draft_tokens - len(draft)) for draft in drafts]
+        return torch.tensor(drafts, dtype=torch.long, device=self.device).view(len(drafts), num_draft_tokens)
+
+    def reorder(self, indices):
+        self.src_sentences = [self.src_sentences[index] for index in indices.tolist()]
+
+
+class DraftModelProposer:
+
+    def __init__(self, draft_transformer, pad_token_id):
+        self.draft_transformer = draft_transformer
+        self.pad_token_id = pad_token_id
+        self.ragged_decoder_cache = None
+
+    def start(self, src_token_ids_batch, src_mask):
+        src_representations_batch = self.draft_transformer.encode(src_token_ids_batch, src_mask)
+        self.ragged_decoder_cache = RaggedDecoderCache(self.draft_transformer, src_representations_batch, src_mask, self.pad_token_id)
+
+    def propose(self, trg_token_ids, num_draft_tokens):
+        if num_draft_tokens <= 0:
+            return torch.zeros((len(trg_token_ids), 0), dtype=torch.long, device=self.ragged_decoder_cache.device)
+
+        # Roll back the draft tokens which got rejected - every sentence keeps its longest cached prefix that's still
+        # part of its output. The latest output token is always passed in as we need the prediction following it.
+        num_valid_tokens = []
+        for cached_token_ids, token_ids in zip(self.ragged_decoder_cache.cached_token_ids, trg_token_ids):
+            num_common_tokens = 0
+            while num_common_tokens < min(len(cached_token_ids), len(token_ids) - 1) and cached_token_ids[num_common_tokens] == token_ids[num_common_tokens]:
+                num_common_tokens += 1
+            num_valid_tokens.append(num_common_tokens)
+        self.ragged_decoder_cache.truncate(num_valid_tokens)
+
+        # Regular (cached) greedy decoding with the draft model, the first call also catches up with the output
+        new_token_ids = [token_ids[num_tokens:] for token_ids, num_tokens in zip(trg_token_ids, num_valid_tokens)]
+        draft_token_ids = []
+        for _ in range(num_draft_tokens):
+            predicted_log_distributions = self.ragged_decoder_cache.decode(new_token_ids, 'last')
+            most_probable_token_ids = torch.argmax(predicted_log_distributions, dim=-1)
+            draft_token_ids.append(most_probable_token_ids)
+            new_token_ids = [[token_id] for token_id in most_probable_token_ids.tolist()]
+
+        return torch.stack(draft_token_ids, dim=1)
+
+    def reorder(self, indices):
+        self.ragged_decoder_cache.reorder(indices)
+
+
+def speculative_greedy_decoding(baseline_transformer, src_token_ids_batch, src_representations_batch, src_mask, trg_field_processor, proposer, num_draft_tokens=4, max_target_tokens=100, stats=None):
+    """
+        Same output as greedy_decoding (up to floating point noise in case of near ties) but usually with fewer calls to
+        the (main) decoder. Pass in a stats dict to accumulate the acceptance rate related counters.
+
+    """
+    device = next(baseline_transformer.parameters()).device
+    pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
+    eos_token_id = trg_field_processor.vocab.stoi[EOS_TOKEN]
+    batch_size = src_representations_batch.shape[0]
+
+    # Notation: B - batch size, K - number of draft tokens, V - target vocab size
+    # Output so far per sentence, the keys/values of all but the latest token are cached
+    trg_token_ids = [[trg_field_processor.vocab.stoi[BOS_TOKEN]] for _ in range(batch_size)]
+    ragged_decoder_cache = RaggedDecoderCache(baseline_transformer, src_representations_batch, src_mask, pad_token_id)
+    proposer.start(src_token_ids_batch, src_mask)
+
+    # Sentences which are still being decoded, maps the (active) batch back to the position in the original batch
+    sentence_indices = list(range(batch_size))
+    predicted_token_ids = [None] * batch_size
+    if stats is not None:
+        for counter in ['num_drafted_tokens', 'num_accepted_tokens', 'num_decoder_calls', 'num_sentence_decoder_calls', 'num_generated_tokens']:
+            stats.setdefault(counter, 0)
+
+    while True:
+        # Shape = (B, K), the verification pass predicts K + 1 tokens and we don't want to go over max_target_tokens
+        # (sentences which are further ahead can overshoot it, they get truncated during post processing)
+        num_generated_tokens = min(len(token_ids) for token_ids in trg_token_ids) - 1
+        draft_token_ids = proposer.propose(trg_token_ids, min(num_draft_tokens, max_target_tokens - num_generated_tokens - 1))
+        num_drafted = draft_token_ids.shape[1]
+
+        # Verification - pass in the latest token followed by the draft tokens (all of the previous ones are cached)
+        new_token_ids = [token_ids[-1:] + draft for token_ids, draft in zip(trg_token_ids, draft_token_ids.tolist())]
+        predicted_log_distributions = ragged_decoder_cache.decode(new_token_ids, generator_positions=None)
+        most_probable_token_ids = torch.argmax(predicted_log_distributions, dim=-1).view(len(sentence_indices), num_drafted + 1)
+
+        # Every sentence accepts its draft tokens as long as they match what the main model would've predicted itself
+        num_accepted_per_sentence = (draft_token_ids == most_probable_token_ids[:, :num_drafted]).long().cumprod(dim=1).sum(dim=1).tolist()
+
+        # The latest token and the accepted draft tokens stay cached, the rejected ones get dropped. The output gets the
+        # accepted draft tokens (which are the same as the main model's predictions) plus one more prediction.
+        ragged_decoder_cache.truncate([len(token_ids) + num_accepted for token_ids, num_accepted in zip(trg_token_ids, num_accepted_per_sentence)])
+        generated_token_ids = [token_ids[:num_accepted + 1] for token_ids, num_accepted in zip(most_probable_token_ids.tolist(), num_accepted_per_sentence)]
+        trg_token_ids = [token_ids + generated for token_ids, generated in zip(trg_token_ids, generated_token_ids)]
+
+        if stats is not None:
+            stats['num_drafted_tokens'] += num_drafted * len(sentence_indices)
+            stats['num_accepted_tokens'] += sum(num_accepted_per_sentence)
+            stats['num_decoder_calls'] += 1
+            stats['num_sentence_decoder_calls'] += len(sentence_indices)  # greedy decoding generates 1 token per these
+            stats['num_generated_tokens'] += sum(len(generated) for generated in generated_token_ids)
+
+        # Remove the fully decoded sentences from the batch
+        active_positions = []
+        for position, (sentence_index, token_ids, generated) in enumerate(zip(sentence_indices, trg_token_ids, generated_token_ids)):
+            if eos_token_id in generated or len(token_ids) - 1 >= max_target_tokens:
+                predicted_token_ids[sentence_index] = token_ids
+            else:
+                active_positions.append(position)
+
+        if len(active_positions) == 0:
+            break
+
+        if len(active_positions) < len(sentence_indices):
+            sentence_indices = [sentence_indices[position] for position in active_positions]
+            trg_token_ids = [trg_token_ids[position] for position in active_positions]
+            active_positions = torch.tensor(active_positions, device=device)
+            ragged_decoder_cache.reorder(active_positions)
+            proposer.reorder(active_positions)
+
+    # Post process the sentences - convert ids into tokens and remove everything after the EOS token/max length
+    target_sentences_tokens_post = []
+    for token_ids in predicted_token_ids:
+        target_sentence_tokens = [trg_field_processor.vocab.itos[token_id] for token_id in token_ids[:max_target_tokens + 1]]
+        try:
+            target_index = target_sentence_tokens.index(EOS_TOKEN) + 1
+        except:
+            target_index = None
+
+        target_sentence_tokens = target_sentence_tokens[:target_index]
+        target_sentences_tokens_post.append(target_sentence_tokens)
+
+    return target_sentences_tokens_post
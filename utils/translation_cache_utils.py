@@ -0,0 +1,126 @@
+"""
+    Translation result cache - repeated sentences (UI strings, boilerplate...) don't have to be translated again.
+
+    A translation is keyed by the model binary's hash, the decoding config and the (tokenized) source sentence, so
+    changing the model or e.g. the beam size never returns stale translations.
+
+    There are 2 tiers: a bounded in-memory LRU and an optional persistent one (SQLite file) which survives restarts.
+    Translations found on disk get promoted into the memory tier.
+
+"""
+
+
+import os
+import json
+import sqlite3
+import hashlib
+from collections import OrderedDict
+
+
+# Every config entry that can change the translation of a sentence
+DECODING_CONFIG_KEYS = ['decoding_method', 'beam_size', 'length_penalty_coefficient', 'max_length_a', 'max_length_b', 'use_lexical_shortlist', 'quantize', 'attention_backend', 'mmap_weights_dtype']
+
+
+def get_checkpoint_hash(model_path):
+    """
+        sha256 of the model binary. Hashing a big binary takes a while so the hash gets stored next to it (e.g.
+        iwslt_e2g.pth -> iwslt_e2g.pth.sha256) together with the binary's size and modification time, and the binary is
+        only hashed again once those change.
+
+    """
+    model_stat = os.stat(model_path)
+    fingerprint = {"size": model_stat.st_size, "mtime_ns": model_stat.st_mtime_ns}
+    hash_path = f'{model_path}.sha256'
+
+    try:
+        with open(hash_path) as hash_file:
+            stored_hash = json.load(hash_file)
+        if stored_hash['fingerprint'] == fingerprint:
+            return stored_hash['sha256']
+    except (OSError, ValueError, KeyError, TypeError):  # missing/corrupted file, hash the binary again
+        pass
+
+    sha256 = hashlib.sha256()
+    with open(model_path, 'rb') as model_file:
+        for chunk in iter(lambda: model_file.read(2**20), b''):
+            sha256.update(chunk)
+
+    try:
+        with open(hash_path, 'w') as hash_file:
+            json.dump({"fingerprint": fingerprint, "sha256": sha256.hexdigest()}, hash_file)
+    except OSError:  # e.g. read-only binaries directory, we'll simply hash it again the next time
+        pass
+
+    return sha256.hexdigest()
+
+
+class TranslationCache:
+
+    def __init__(self, checkpoint_hash, translation_config, max_entries=10000, disk_cache_path=None):
+        self.max_entries = max_entries
+        self.memory_cache = OrderedDict()  # most recently used translations are at the end
+
+        # Everything but the source sentence is fixed for a given model/decoding config so hash it only once
+        decoding_config = {key: translation_config.get(key) for key in DECODING_CONFIG_KEYS}
+        self.key_prefix = json.dumps([checkpoint_hash, decoding_config], sort_keys=True)
+
+        self.disk_cache = None
+        if disk_cache_path is not None:
+            # Translation (in the server) happens in a worker thread, we never access the cache concurrently though
+            self.disk_cache = sqlite3.connect(disk_cache_path, check_same_thread=False)
+            self.disk_cache.execute('CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, target_sentence_tokens TEXT)')
+
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    def get_key(self, source_sentence_tokens):
+        # Tokenization already normalizes the whitespace
+        return hashlib.sha256(json.dumps([self.key_prefix, source_sentence_tokens]).encode('utf-8')).hexdigest()
+
+    def get(self, source_sentence_tokens):
+        # Returns None if we don't have the translation
+        key = self.get_key(source_sentence_tokens)
+
+        if key in self.memory_cache:
+            self.memory_cache.move_to_end(key)
+            self.stats['memory_hits'] += 1
+            return self.memory_cache[key]
+
+        if self.disk_cache is not None:
+            row = self.disk_cache.execute('SELECT target_sentence_tokens FROM translations WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                target_sentence_tokens = json.loads(row[0])
+                self.put_into_memory(key, target_sentence_tokens)
+                self.stats['disk_hits'] += 1
+                return target_sentence_tokens
+
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, source_sentences_tokens, target_sentences_tokens):
+        # Batched as every disk write (commit) is expensive
+        keys = [self.get_key(source_sentence_tokens) for source_sentence_tokens in source_sentences_tokens]
+        for key, target_sentence_tokens in zip(keys, target_sentences_tokens):
+            self.put_into_memory(key, target_sentence_tokens)
+
+        if self.disk_cache is not None:
+            with self.disk_cache:  # commits the transaction
+                self.disk_cache.executemany(
+                    'INSERT OR REPLACE INTO translations VALUES (?, ?)',
+                    [(key, json.dumps(target_sentence_tokens)) for key, target_sentence_tokens in zip(keys, target_sentences_tokens)]
+                )
+
+    def put_into_memory(self, key, target_sentence_tokens):
+        self.memory_cache[key] = target_sentence_tokens
+        self.memory_cache.move_to_end(key)
+        while len(self.memory_cache) > self.max_entries:
+            self.memory_cache.popitem(last=False)  # the least recently used one
+            self.stats['evictions'] += 1
+
+    def get_stats(self):
+        num_lookups = self.stats['memory_hits'] + self.stats['disk_hits'] + self.stats['misses']
+        hit_rate = (self.stats['memory_hits'] + self.stats['disk_hits']) / num_lookups if num_lookups > 0 else 0.
+        return {**self.stats, "hit_rate": hit_rate, "memory_entries": len(self.memory_cache)}
+
+    def close(self):
+        if self.disk_cache is not None:
+            self.disk_cache.close()
@@ -3,14 +3,12 @@ import os
 import time
 
 
-import git
 import torch
-from nltk.translate.bleu_score import corpus_bleu
 
 
 from .constants import BINARIES_PATH, PAD_TOKEN
 from .decoding_utils import greedy_decoding
-from .data_utils import get_masks_and_count_tokens_src
+from .data_utils import get_masks_and_count_tokens_src, get_vocab_state
 
 
 def get_available_binary_name():
@@ -31,7 +29,8 @@ def get_available_binary_name():
         return f'{prefix}_000000.pth'
 
 
-def get_training_state(training_config, model):
+# Bundles everything that's needed for inference (vocabs, hyperparameters) so that we don't have to rebuild the datasets
+def get_training_state(training_config, model, src_field_processor, trg_field_processor):
     training_state = {
         # "commit_hash": git.Repo(search_parent_directories=True).head.object.hexsha,
         "dataset_name": training_config['dataset_name'],
@@ -40,6 +39,10 @@ def get_training_state(training_config, model):
         "num_of_epochs": training_config['num_of_epochs'],
         "batch_size": training_config['batch_size'],
 
+        "model_hyperparameters": training_config['model_hyperparameters'],
+        "src_vocab": get_vocab_state(src_field_processor),
+        "trg_vocab": get_vocab_state(trg_field_processor),
+
         "state_dict": model.state_dict()
     }
 
@@ -54,12 +57,16 @@ def print_model_metadata(training_state):
         if key != 'state_dict':  # don't print state_dict it's a bunch of numbers...
             if key == 'language_direction':  # convert into human readable format
                 value = 'English to German' if value == 'E2G' else 'German to English'
+            if key in ['src_vocab', 'trg_vocab']:  # same goes for the vocabs, their size is enough
+                value = f'{len(value["itos"])} tokens'
             print(f'{key}: {value}')
     print(f'{"*" * len(header)}\n')
 
 
-# Calculate the BLEU-4 score
-def calculate_bleu_score(transformer, token_ids_loader, trg_field_processor):
+# Calculate the BLEU-4 score (optionally restricting the decoder to the lexical shortlist, see shortlist_utils.py)
+def calculate_bleu_score(transformer, token_ids_loader, trg_field_processor, lexical_shortlist=None):
+    from nltk.translate.bleu_score import corpus_bleu  # imported lazily, translation doesn't need nltk
+
     with torch.no_grad():
         pad_token_id = trg_field_processor.vocab.stoi[PAD_TOKEN]
 
@@ -76,7 +83,8 @@ def calculate_bleu_score(transformer, token_ids_loader, trg_field_processor):
             src_mask, _ = get_masks_and_count_tokens_src(src_token_ids_batch, pad_token_id)
             src_representations_batch = transformer.encode(src_token_ids_batch, src_mask)
 
-            predicted_sentences = greedy_decoding(transformer, src_representations_batch, src_mask, trg_field_processor)
+            vocab_shortlist = None if lexical_shortlist is None else lexical_shortlist.get_vocab_shortlist(src_token_ids_batch)
+            predicted_sentences = greedy_decoding(transformer, src_representations_batch, src_mask, trg_field_processor, vocab_shortlist=vocab_shortlist)
             predicted_sentences_corpus.extend(predicted_sentences)  # add them to the corpus of translations
 
             # Get the token and not id version of GT (ground-truth) sentences
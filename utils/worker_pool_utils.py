@@ -0,0 +1,138 @@
+"""
+    Multi-process CPU inference - a single process can't keep a many-core machine busy as PyTorch's intra-op threading
+    doesn't scale well on the small matrices of a (512 dim) Transformer. Instead we run N worker processes with a few
+    threads each (e.g. 16 workers x 4 threads on a 64 core box) and dispatch whole batches to them.
+
+    Workers don't copy the model - the weights are moved into shared memory and every worker maps the very same
+    (physical) pages, memory mapped weights (see mmap_weights_utils.py) get mapped by every worker itself instead.
+    Note: the int8 quantized model's packed weights are the exception, they get copied.
+
+    Workers are started via a fork server (a fresh process) - forking the main process directly deadlocks as soon as
+    the main process used OpenMP threads (e.g. translated something) and the child tries to use them as well.
+
+    Note: CPU only and Linux/macOS only (forkserver start method).
+
+"""
+
+
+import os
+import queue
+import traceback
+
+
+import torch
+import torch.multiprocessing as mp
+
+
+def get_worker_cores(worker_id, num_threads_per_worker):
+    # Cores this process is allowed to run on (respects taskset/cgroups), every worker gets its own (wrapping around)
+    available_cores = sorted(os.sched_getaffinity(0))
+    return {available_cores[(worker_id * num_threads_per_worker + i) % len(available_cores)] for i in range(num_threads_per_worker)}
+
+
+def worker_loop(worker_id, translate_fn, num_threads_per_worker, pin_to_cores, task_queue, result_queue):
+    # Every worker gets a few intra-op threads, otherwise they'd all try to use all of the cores and fight over them
+    try:
+        torch.set_num_threads(num_threads_per_worker)
+        if pin_to_cores and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, get_worker_cores(worker_id, num_threads_per_worker))
+    except Exception:
+        result_queue.put((None, None, traceback.format_exc()))
+        return
+    result_queue.put((None, None, None))  # signal that the worker is ready (translate_fn got unpickled)
+
+    with torch.no_grad():
+        while True:
+            task = task_queue.get()
+            if task is None:  # poison pill - the pool is shutting down
+                break
+
+            batch_id, source_sentences_tokens = task
+            try:
+                result_queue.put((batch_id, translate_fn(source_sentences_tokens), None))
+            except Exception:
+                result_queue.put((batch_id, None, traceback.format_exc()))
+
+
+class InferenceWorkerPool:
+    """
+        translate_fn maps a batch (list of source sentence tokens) into a list of target sentence tokens. It gets pickled
+        (only once per worker) so use e.g. functools.partial of a module level function instead of a closure.
+
+        Workers pull the batches from a shared queue so the faster ones (shorter sentences) simply take more of them.
+
+        Exceptions raised in the workers are sent back and re-raised here. Workers which die without a word (OOM killed,
+        failed to unpickle translate_fn, ...) are noticed as well - the pool gets terminated and an exception is raised.
+
+    """
+
+    # How often (in seconds) we check whether the workers are still alive while waiting for their results
+    poll_interval = 1.
+
+    def __init__(self, translate_fn, num_workers, num_threads_per_worker=1, pin_to_cores=False):
+        self.num_workers = num_workers
+        context = mp.get_context('forkserver')
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+
+        self.workers = [
+            context.Process(target=worker_loop, args=(worker_id, translate_fn, num_threads_per_worker, pin_to_cores, self.task_queue, self.result_queue), daemon=True)
+            for worker_id in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+        # Wait for all of the workers to start up, that way the startup cost doesn't hide in the first batches
+        for _ in range(num_workers):
+            _, _, worker_traceback = self.get_result()
+            if worker_traceback is not None:
+                self.terminate()
+                raise Exception(f'Inference worker failed to start:\n{worker_traceback}')
+
+    def get_result(self):
+        # Workers only exit once the pool gets closed, so a dead worker means that it crashed (and its batch is lost)
+        while True:
+            try:
+                return self.result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                dead_workers = [(worker_id, worker.exitcode) for worker_id, worker in enumerate(self.workers) if not worker.is_alive()]
+                if len(dead_workers) > 0:
+                    self.terminate()
+                    description = ', '.join(f'worker {worker_id} (exit code {exitcode}{", killed by a signal e.g. OOM" if exitcode < 0 else ""})' for worker_id, exitcode in dead_workers)
+                    raise Exception(f'Inference worker(s) died unexpectedly: {description}.')
+
+    def translate_batches(self, batches):
+        # Returns the translations of every batch in the same order as the batches
+        for batch_id, source_sentences_tokens in enumerate(batches):
+            self.task_queue.put((batch_id, source_sentences_tokens))
+
+        results = [None] * len(batches)
+        error = None
+        for _ in range(len(batches)):
+            batch_id, target_sentences_tokens, worker_traceback = self.get_result()
+            results[batch_id] = target_sentences_tokens
+            error = worker_traceback if error is None else error
+
+        if error is not None:
+            raise Exception(f'Inference worker failed:\n{error}')
+        return results
+
+    def terminate(self):
+        # The pool can't be used anymore after this
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            worker.join()
+
+    def close(self):
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()